@@ -0,0 +1,258 @@
+"""
+语义答案缓存
+/ask 命中时跳过大模型调用：键为 查询向量 + 查询文本 + 检索到的上下文（chunk ID 与内容哈希），
+上下文完全一致、查询向量余弦相似度达到阈值且规范化后的查询文本编辑距离不超过上限时直接返回缓存答案
+"""
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import Config
+from embedding_service import normalize_query
+from vector_store import add_change_listener
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    """缓存条目"""
+
+    __slots__ = ("vector", "query", "answer", "packing", "context_key", "chunk_ids", "sources", "expires_at")
+
+    def __init__(self, vector, query, answer, packing, context_key, chunk_ids, sources, expires_at):
+        self.vector = vector
+        self.query = query
+        self.answer = answer
+        self.packing = packing
+        self.context_key = context_key
+        self.chunk_ids = chunk_ids
+        self.sources = sources
+        self.expires_at = expires_at
+
+
+class SemanticAnswerCache:
+    """
+    语义答案缓存
+
+    - 查找：只在上下文（chunk ID + 内容哈希）完全相同的条目中比较查询向量的余弦相似度，
+      并要求规范化后的查询文本编辑距离不超过 max_edits——同一文档上的不同问题
+      （如"续航多久"与"充电多快"）检索到相同上下文、向量相似度也常在 0.95 以上，只靠向量会答非所问
+    - 失效：chunk 被删除/覆盖，或同一来源（ANSWER_CACHE_SOURCE_KEY 对应的 metadata）
+      有新内容写入时，依赖它们的条目立即删除；另有 TTL 兜底
+    - 其他进程（多 worker、多实例）的写入监听不到：上下文取自本次实时检索，
+      被删除的 chunk 不会再被检索到、被覆盖的 chunk 内容哈希不同，都不会命中旧条目
+    """
+
+    def __init__(self, threshold: float = None, ttl: float = None, max_size: int = None,
+                 source_key: str = None, max_edits: int = None):
+        """
+        初始化答案缓存
+
+        Args:
+            threshold: 查询向量余弦相似度阈值
+            max_edits: 规范化查询文本允许的最大编辑距离（0 表示必须完全相同）
+            ttl: 过期时间（秒）
+            max_size: 最大条目数
+            source_key: 标识内容来源的 metadata 字段（如 filterKeyForDel）
+        """
+        self.threshold = threshold if threshold is not None else Config.ANSWER_CACHE_THRESHOLD
+        self.ttl = ttl if ttl is not None else Config.ANSWER_CACHE_TTL
+        self.max_size = max_size or Config.ANSWER_CACHE_SIZE
+        self.source_key = source_key or Config.ANSWER_CACHE_SOURCE_KEY
+        self.max_edits = max_edits if max_edits is not None else Config.ANSWER_CACHE_MAX_EDITS
+
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._by_context: Dict[tuple, List[str]] = {}
+        self._by_chunk: Dict[str, set] = {}
+        self._by_source: Dict[str, set] = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        """转为单位向量，点积即余弦相似度"""
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _sources_of(self, documents) -> set:
+        """提取文档的来源标识"""
+        sources = set()
+        for doc in documents or []:
+            value = (doc.metadata or {}).get(self.source_key)
+            if value is not None:
+                sources.add(str(value))
+        return sources
+
+    @staticmethod
+    def _within_edits(a: str, b: str, limit: int) -> bool:
+        """编辑距离（Levenshtein）是否不超过 limit，某一行最小值超过 limit 时提前结束"""
+        if abs(len(a) - len(b)) > limit:
+            return False
+        if a == b:
+            return True
+        previous = list(range(len(b) + 1))
+        for i, char in enumerate(a, start=1):
+            current = [i]
+            for j, other in enumerate(b, start=1):
+                current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other)))
+            if min(current) > limit:
+                return False
+            previous = current
+        return previous[-1] <= limit
+
+    @staticmethod
+    def _context_key(documents) -> Optional[tuple]:
+        """上下文键：(chunk ID, 内容哈希) 排序后的元组，有文档缺少 ID 时返回 None"""
+        if not documents or not all(doc.id for doc in documents):
+            return None
+        return tuple(sorted(
+            (doc.id, hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()) for doc in documents
+        ))
+
+    def lookup(self, query: str, query_vector, documents) -> Optional[Tuple[str, Optional[Dict]]]:
+        """
+        查找缓存答案
+
+        Args:
+            query: 查询文本
+            query_vector: 查询向量
+            documents: 本次检索到的上下文文档（需带 id）
+
+        Returns:
+            命中时返回 (答案, 写入时的上下文组装统计)，否则 None
+        """
+        context_key = self._context_key(documents)
+        vector = self._normalize(query_vector)
+        query = normalize_query(query)
+        now = time.monotonic()
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._by_context.get(context_key, [])):
+                entry = self._entries[entry_id]
+                if entry.expires_at < now:
+                    self._remove(entry_id)
+                    continue
+                score = float(np.dot(entry.vector, vector))
+                if score >= best_score and self._within_edits(entry.query, query, self.max_edits):
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self._hits += 1
+            entry = self._entries[best_id]
+            return entry.answer, entry.packing
+
+    def store(self, query: str, query_vector, documents, answer: str, packing: Dict = None):
+        """
+        写入缓存
+
+        Args:
+            query: 查询文本
+            query_vector: 查询向量
+            documents: 本次检索到的上下文文档（需带 id）
+            answer: 大模型答案
+            packing: 上下文组装统计（命中时原样返回，保持响应结构一致）
+        """
+        context_key = self._context_key(documents)
+        if context_key is None:
+            return
+        entry = _Entry(
+            vector=self._normalize(query_vector),
+            query=normalize_query(query),
+            answer=answer,
+            packing=packing,
+            context_key=context_key,
+            chunk_ids={doc.id for doc in documents},
+            sources=self._sources_of(documents),
+            expires_at=time.monotonic() + self.ttl
+        )
+        entry_id = uuid.uuid4().hex
+        with self._lock:
+            self._entries[entry_id] = entry
+            self._by_context.setdefault(entry.context_key, []).append(entry_id)
+            for chunk_id in entry.chunk_ids:
+                self._by_chunk.setdefault(chunk_id, set()).add(entry_id)
+            for source in entry.sources:
+                self._by_source.setdefault(source, set()).add(entry_id)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, entry_id: str):
+        """删除条目及其索引（调用方持有锁）"""
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        group = self._by_context.get(entry.context_key)
+        if group is not None:
+            group.remove(entry_id)
+            if not group:
+                del self._by_context[entry.context_key]
+        for index, keys in ((self._by_chunk, entry.chunk_ids), (self._by_source, entry.sources)):
+            for key in keys:
+                ids = index.get(key)
+                if ids is not None:
+                    ids.discard(entry_id)
+                    if not ids:
+                        del index[key]
+
+    def invalidate(self, chunk_ids: List[str] = None, sources: set = None) -> int:
+        """删除依赖指定 chunk 或来源的条目，返回删除数量"""
+        with self._lock:
+            targets = set()
+            for chunk_id in chunk_ids or []:
+                targets |= self._by_chunk.get(chunk_id, set())
+            for source in sources or []:
+                targets |= self._by_source.get(source, set())
+            for entry_id in targets:
+                self._remove(entry_id)
+            self._invalidations += len(targets)
+        if targets:
+            logger.debug(f"答案缓存失效 {len(targets)} 条")
+        return len(targets)
+
+    def on_store_change(self, event: str, ids: list, documents: list = None):
+        """向量库变更监听器（见 vector_store.add_change_listener）"""
+        self.invalidate(chunk_ids=ids, sources=self._sources_of(documents))
+
+    def stats(self) -> Dict:
+        """返回命中统计"""
+        with self._lock:
+            hits, misses = self._hits, self._misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "threshold": self.threshold,
+                "max_edits": self.max_edits,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+                "invalidations": self._invalidations,
+            }
+
+
+# 全局单例
+_answer_cache: Optional[SemanticAnswerCache] = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> Optional[SemanticAnswerCache]:
+    """获取答案缓存单例（ANSWER_CACHE_ENABLED=False 时返回 None）"""
+    global _answer_cache
+    if not Config.ANSWER_CACHE_ENABLED:
+        return None
+    if _answer_cache is None:
+        with _answer_cache_lock:
+            if _answer_cache is None:
+                _answer_cache = SemanticAnswerCache()
+                add_change_listener(_answer_cache.on_store_change)
+    return _answer_cache
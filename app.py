@@ -1,17 +1,28 @@
 import atexit
 import json
+import time
 
 from flask import Flask, request, jsonify
-from langchain_core.documents import Document
 
+from config import Config
 from nacos_service import NacosService
-from spark_api import SparkAPI
-from vector_store import VectorStore, process_text, delete_text_by_metadata
+from spark_api import SparkError, get_spark_client
+from vector_store import VectorStore, process_text, upsert_text, delete_text_by_metadata, delete_by_keys
 from reranker_service import get_reranker_service
+from embedding_service import get_embedding_service
+from ingest_queue import get_ingest_queue
+from bulk_ingest import bulk_add_texts, ingest_stream
+from answer_cache import get_answer_cache
+from context_packer import get_context_packer, pack_context
+from lexical_index import get_lexical_index
+from flat_search import get_flat_index
+from retrieval import retrieve, retrieval_options
 
 app = Flask(__name__)
-spark = SparkAPI()
+spark = get_spark_client()
 vector_store = VectorStore()
+# 启动时加载关键词索引并注册变更监听，之后的写入/删除增量维护
+lexical_index = get_lexical_index()
 
 # 初始化并注册Nacos服务
 nacos_service = NacosService()
@@ -21,7 +32,13 @@ from flask import Response, stream_with_context, request
 
 @app.route('/ask-stream', methods=['POST'])  # 新建流式接口
 def stream_qa():
-    """流式问答接口"""
+    """
+    流式问答接口
+
+    大模型连接（TLS 握手 + 鉴权）与向量检索并行建立；检索完成后先发送
+    event: sources（检索到的文档 ID/分数/metadata 及检索耗时），再逐块发送答案
+    """
+    started = time.perf_counter()
     data = request.get_json()
 
     # 参数校验（与原有逻辑一致）
@@ -32,29 +49,48 @@ def stream_qa():
         query = data['query']
         top_k = int(data.get('top_k', 3))
         function = data.get('function', 'qa')
+        options = retrieval_options(data)
 
         # 流式生成器核心逻辑
         def generate():
-            # 向量检索部分保持同步
-            if function == 'qa':
-                results = vector_store.similarity_search_with_score(query=query, k=top_k)
-                if not results:
-                    yield "data: 暂无相关数据，无法回答问题。\n\n"
-                    return
-                context = "\n".join([doc.page_content for doc, _ in results])
-                prompt = f"基于以下上下文回答问题：\n{context}\n\n问题：{query}\n答案："
-            elif function == 'translate':
-                prompt = f"请将以下内容翻译成中文：\n{query}\n翻译："
-            else:
+            if function not in ('qa', 'translate'):
                 yield "data: {\"error\": \"Invalid function\"}\n\n"
                 return
 
-            # 调用支持流式输出的 LLM 接口（假设 spark.stream_response 返回生成器）
-            for chunk in spark.stream_response(prompt):  # 需确保该方法是流式API
-                yield f"data: {json.dumps({'answer': chunk})}\n\n"  # SSE 格式
+            # 先在后台建立大模型连接，与检索并行；结束（含客户端断开）时确保释放
+            llm_stream = spark.prepare_stream(started)
+            try:
+                if function == 'qa':
+                    results, timings = retrieve(query, top_k, **options)
+                    app.logger.debug(f"流式问答检索耗时: {timings}")
+                    if not results:
+                        yield "data: 暂无相关数据，无法回答问题。\n\n"
+                        return
+                    context, packing = pack_context(results)
+                    sources = [
+                        {"id": doc.id, "score": round(score, 4), "metadata": doc.metadata}
+                        for doc, score in results
+                    ]
+                    event = {'sources': sources, 'timings': timings, 'context': packing}
+                    yield f"event: sources\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+                    prompt = f"基于以下上下文回答问题：\n{context}\n\n问题：{query}\n答案："
+                else:
+                    prompt = f"请将以下内容翻译成中文：\n{query}\n翻译："
+
+                # 使用提前建立的连接发送请求（每个请求独立会话）
+                try:
+                    for chunk in llm_stream.stream(prompt):
+                        yield f"data: {json.dumps({'answer': chunk})}\n\n"  # SSE 格式
+                except SparkError as e:
+                    app.logger.error(f"流式请求大模型失败: {str(e)}")
+                    yield f"data: {json.dumps({'error': 'LLM request failed'})}\n\n"
+            finally:
+                llm_stream.close()
 
         return Response(stream_with_context(generate()), mimetype="text/event-stream")
 
+    except ValueError as e:
+        return jsonify({"error": f"Invalid parameter: {str(e)}"}), 400
     except Exception as e:
         app.logger.error(f"流式请求失败: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
@@ -72,19 +108,28 @@ def ask_question():
         top_k = int(data.get('top_k', 3))  # 默认获取3条相关结果
         function = data.get('function', 'qa')  # 默认功能是问答
 
+        answer_cache = None
+        timings = {}
+        packing = None
         if function == 'qa':
-            # 1. 向量检索
-            results = vector_store.similarity_search_with_score(
-                query=query,
-                k=top_k
-            )
+            # 1. 向量检索（查询向量只计算一次，检索与答案缓存共用；可选两阶段重排）
+            query_vector = get_embedding_service().embed_query(query)
+            results, timings = retrieve(query, top_k, query_vector=query_vector, **retrieval_options(data))
 
             # 如果没有检索到结果，返回提示
             if not results:
-                return jsonify({"answer": "暂无相关数据，无法回答问题。"})
+                return jsonify({"answer": "暂无相关数据，无法回答问题。", "timings": timings})
 
-            # 2. 拼接上下文
-            context = "\n".join([doc.page_content for doc, _ in results])
+            # 语义答案缓存：相似问题 + 相同上下文直接返回
+            answer_cache = get_answer_cache()
+            if answer_cache is not None:
+                cached = answer_cache.lookup(query, query_vector, [doc for doc, _ in results])
+                if cached is not None:
+                    answer, packing = cached
+                    return jsonify({"answer": answer, "cached": True, "timings": timings, "context": packing})
+
+            # 2. 组装上下文（合并重叠块、去重、按 token 预算装入）
+            context, packing = pack_context(results)
 
             # 3. 构造提示词
             prompt = f"基于以下上下文回答问题：\n{context}\n\n问题：{query}\n答案："
@@ -97,8 +142,12 @@ def ask_question():
             return jsonify({"error": "Invalid function. Supported functions are 'qa' and 'translate'."}), 400
 
         # 4. 调用大模型
+        llm_started = time.perf_counter()
         response = spark.get_response(prompt)
-        return jsonify({"answer": response})
+        timings["llm_ms"] = round((time.perf_counter() - llm_started) * 1000, 2)
+        if answer_cache is not None:
+            answer_cache.store(query, query_vector, [doc for doc, _ in results], response, packing)
+        return jsonify({"answer": response, "cached": False, "timings": timings, "context": packing})
 
     except ValueError as e:
         return jsonify({"error": f"Invalid parameter: {str(e)}"}), 400
@@ -109,7 +158,12 @@ def ask_question():
 
 @app.route('/add', methods=['POST'])
 def add_text():
-    """添加文本到向量库（支持单条）"""
+    """
+    添加文本到向量库（支持单条）
+
+    请求体 "async": true（或配置 INGEST_ASYNC=True）时异步入库，
+    立即返回 job_id，可通过 /jobs/<job_id> 查询进度
+    """
     data = request.get_json()
     if not data or 'text' not in data:
         return jsonify({"error": "Missing 'text' field"}), 400
@@ -121,6 +175,11 @@ def add_text():
         if not isinstance(metadata, dict):
             return jsonify({"error": "metadata must be a dictionary"}), 400
 
+        # 异步模式：入队后立即返回
+        if data.get('async', Config.INGEST_ASYNC):
+            job_id = get_ingest_queue().submit(text=data['text'], metadata=metadata)
+            return jsonify({"status": "queued", "job_id": job_id}), 202
+
         # 处理文本
         process_text(text=data['text'], metadata=metadata)
         return jsonify({"status": "success", "count": 1}), 201
@@ -130,35 +189,126 @@ def add_text():
         return jsonify({"error": "Internal server error"}), 500
 
 
-# 如果要支持批量添加，可以修改/add接口：
+@app.route('/upsert', methods=['POST'])
+def upsert():
+    """
+    幂等写入（按 key 覆盖）
+
+    请求体:
+    {
+        "key": "content_18",  // 可选，缺省时取 metadata.filterKey
+        "text": "...",
+        "metadata": {"filterKey": "content_18", ...}
+    }
+    块 ID 由 key + 块序号生成，只重新向量化内容变化的块，并删除多余的旧块
+    """
+    data = request.get_json()
+    if not data or 'text' not in data:
+        return jsonify({"error": "Missing 'text' field"}), 400
+
+    metadata = data.get('metadata', {})
+    if not isinstance(metadata, dict):
+        return jsonify({"error": "metadata must be a dictionary"}), 400
+    key = data.get('key', metadata.get('filterKey'))
+    if not isinstance(key, str) or not key:
+        return jsonify({"error": "Missing 'key' field (or metadata.filterKey)"}), 400
+
+    try:
+        result = upsert_text(key=key, text=data['text'], metadata=metadata)
+        return jsonify({"status": "success", "key": key, **result})
+
+    except Exception as e:
+        app.logger.error(f"upsert 失败: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """查询异步入库任务状态"""
+    job = get_ingest_queue().get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+
 @app.route('/add_batch', methods=['POST'])
 def add_batch():
+    """
+    批量添加文本到向量库
+
+    按 CHUNK_STRATEGY 并行分块后大批量向量化、分片写入，返回逐条结果
+    """
     data = request.get_json()
     if not data or 'texts' not in data:
         return jsonify({"error": "Missing 'texts' array"}), 400
 
-    try:
-        texts = data['texts']
-        metadatas = data.get('metadatas', [{}] * len(texts))
+    texts = data['texts']
+    metadatas = data.get('metadatas')
+    if not isinstance(texts, list):
+        return jsonify({"error": "'texts' must be a list"}), 400
+    if metadatas is not None and (not isinstance(metadatas, list) or len(metadatas) != len(texts)):
+        return jsonify({"error": "'metadatas' must be a list with the same length as 'texts'"}), 400
 
-        # 转换为Document列表
-        docs = [
-            Document(page_content=text, metadata=meta)
-            for text, meta in zip(texts, metadatas)
-        ]
-
-        vector_store.add_documents(docs)
-        vector_store.persist()
-        return jsonify({"status": "success", "count": len(docs)})
+    try:
+        results = bulk_add_texts(texts, metadatas)
+        succeeded = sum(1 for r in results if r["status"] == "success")
+        if succeeded == len(results):
+            status = "success"
+        elif succeeded:
+            status = "partial"
+        else:
+            status = "failed"
+        return jsonify({
+            "status": status,
+            "count": succeeded,
+            "chunks": sum(r["chunks"] for r in results if r["status"] == "success"),
+            "results": results
+        })
 
     except Exception as e:
         app.logger.error(f"批量添加失败: {str(e)}")
         return jsonify({"error": "Batch add failed"}), 500
 
 
+@app.route('/add_stream', methods=['POST'])
+def add_stream():
+    """
+    流式批量入库（NDJSON）
+
+    请求体每行一个 JSON 对象，如 {"text": "...", "metadata": {...}}；
+    边读边处理，内存占用与请求体大小无关。
+    Query 参数 text_field / metadata_field 可指定字段名。
+    """
+    text_field = request.args.get('text_field', 'text')
+    metadata_field = request.args.get('metadata_field', 'metadata')
+
+    try:
+        result = ingest_stream(request.stream, text_field=text_field, metadata_field=metadata_field)
+        # 与 /add_batch 一致：全部成功 success，部分成功 partial，全部失败 failed
+        if not result["failed_docs"] and not result["failed_chunks"]:
+            status = "success"
+        elif result["chunks"]:
+            status = "partial"
+        else:
+            status = "failed"
+        return jsonify({"status": status, **result})
+
+    except Exception as e:
+        app.logger.error(f"流式入库失败: {str(e)}")
+        return jsonify({"error": "Stream add failed"}), 500
+
+
 @app.route('/search', methods=['POST'])
 def search_text():
-    """相似文本搜索（返回相关性分数）"""
+    """
+    相似文本搜索（返回相关性分数）
+
+    可选两阶段检索：{"rerank": true, "rerank_factor": 4, "min_score": 0.3}
+    先从 Chroma 多取 rerank_factor*top_k 条，再用 Reranker 精排并按分数截断
+
+    可选混合检索：{"hybrid": true}
+    向量检索与 BM25 关键词检索结果按 RRF 融合，适合型号、产品名等精确词查询
+    """
     data = request.get_json()
     if not data or 'query' not in data:
         return jsonify({"error": "Missing 'query' field"}), 400
@@ -166,28 +316,23 @@ def search_text():
     try:
         top_k = int(data.get('top_k', 5))
         
-        # 使用 similarity_search_with_score，返回 (doc, distance) 对
-        # Chroma 默认使用 L2 距离，距离越小越相似
-        results_with_scores = vector_store.similarity_search_with_score(
-            query=data['query'],
-            k=top_k,
-            filter=data.get('filter')  # 支持元数据过滤
+        # 分数为 0-1，越大越相关（未重排时由 L2 距离换算，重排时为 Reranker 分数）
+        results, timings = retrieve(
+            data['query'],
+            top_k,
+            filter=data.get('filter'),  # 支持元数据过滤
+            **retrieval_options(data)
         )
 
-        # 将距离转换为相关性分数 (0-1，越大越相关)
-        # 使用 max(0, 1 - distance/2) 确保分数在 0-1 范围
-        # L2 距离通常在 0-2 之间（归一化向量的情况下）
         formatted = []
-        for doc, distance in results_with_scores:
-            # 距离转相关性：distance=0 -> score=1, distance=2 -> score=0
-            score = max(0.0, min(1.0, 1.0 - distance / 2.0))
+        for doc, score in results:
             formatted.append({
-            "text": doc.page_content,
+                "text": doc.page_content,
                 "metadata": {**doc.metadata, "score": round(score, 4)},
                 "score": round(score, 4)
             })
 
-        return jsonify({"results": formatted})
+        return jsonify({"results": formatted, "timings": timings})
 
     except ValueError as e:
         return jsonify({"error": f"Invalid parameter: {str(e)}"}), 400
@@ -205,14 +350,47 @@ def delete_text():
 
     try:
         # 执行删除
-        delete_text_by_metadata(filter=data['filter'])
-        return jsonify({"status": "success"})
+        deleted = delete_text_by_metadata(filter=data['filter'])
+        return jsonify({"status": "success", "deleted": deleted})
 
     except Exception as e:
         app.logger.error(f"删除失败: {str(e)}")
         return jsonify({"error": "Delete failed"}), 500
 
 
+@app.route('/delete_batch', methods=['POST'])
+def delete_batch():
+    """
+    按多个删除键批量删除
+
+    请求体:
+    {
+        "keys": ["content_18_isComment_false", "content_19_isComment_false"],
+        "field": "filterKeyForDel"  // 可选，默认 filterKeyForDel
+    }
+    """
+    data = request.get_json()
+    if not data or 'keys' not in data:
+        return jsonify({"error": "Missing 'keys' field"}), 400
+
+    keys = data['keys']
+    field = data.get('field', 'filterKeyForDel')
+    if not isinstance(keys, list) or not keys:
+        return jsonify({"error": "'keys' must be a non-empty list"}), 400
+    if not all(isinstance(key, (str, int, float)) and not isinstance(key, bool) for key in keys):
+        return jsonify({"error": "'keys' must contain only strings or numbers"}), 400
+    if not isinstance(field, str) or not field:
+        return jsonify({"error": "'field' must be a non-empty string"}), 400
+
+    try:
+        deleted = delete_by_keys(field, keys)
+        return jsonify({"status": "success", "keys": len(set(keys)), "deleted": deleted})
+
+    except Exception as e:
+        app.logger.error(f"批量删除失败: {str(e)}")
+        return jsonify({"error": "Delete failed"}), 500
+
+
 @app.route('/rerank', methods=['POST'])
 def rerank():
     """
@@ -223,7 +401,8 @@ def rerank():
     {
         "query": "查询文本",
         "documents": ["文档1", "文档2", ...],
-        "topK": 5  // 可选，默认5
+        "topK": 5,  // 可选，默认5
+        "cascadeDepth": 20  // 可选，级联模式下交给主模型的候选数，0 表示不级联
     }
     
     Response:
@@ -249,6 +428,9 @@ def rerank():
         query = data['query']
         documents = data['documents']
         top_k = int(data.get('topK', 5))
+        cascade_depth = data.get('cascadeDepth')
+        if cascade_depth is not None:
+            cascade_depth = int(cascade_depth)
         
         # 参数验证
         if not isinstance(documents, list):
@@ -258,13 +440,14 @@ def rerank():
         
         # 调用 Reranker 服务
         reranker_service = get_reranker_service()
-        results = reranker_service.rerank(
+        results, stats = reranker_service.rerank_with_stats(
             query=query,
             documents=documents,
-            top_k=top_k
+            top_k=top_k,
+            cascade_depth=cascade_depth
         )
         
-        return jsonify({"results": results})
+        return jsonify({"results": results, "stats": stats})
         
     except ValueError as e:
         return jsonify({"error": f"Invalid parameter: {str(e)}"}), 400
@@ -272,6 +455,41 @@ def rerank():
         app.logger.error(f"重排序失败: {str(e)}")
         return jsonify({"error": "Rerank failed", "detail": str(e)}), 500
 
+
+@app.route('/admin/shards', methods=['GET'])
+def admin_shards():
+    """
+    分片状态（各分片文档数、检索次数、延迟）
+
+    可选参数 ?value=content_18：查看该分片键取值会被路由到哪个分片
+    """
+    try:
+        result = vector_store.stats()
+        value = request.args.get('value')
+        if value is not None:
+            shard = vector_store.shard_of(value, {vector_store.shard_key: value})
+            result["route"] = {"value": value, "shard": vector_store.names[shard]}
+        return jsonify(result)
+
+    except Exception as e:
+        app.logger.error(f"获取分片状态失败: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """运行指标接口（嵌入批处理、延迟等）"""
+    return jsonify({
+        "embedding": get_embedding_service().stats(),
+        "ingest": get_ingest_queue().stats(),
+        "spark": spark.stats(),
+        "reranker": get_reranker_service().stats(),
+        "answer_cache": get_answer_cache().stats() if get_answer_cache() else None,
+        "context_packing": get_context_packer().stats() if get_context_packer() else None,
+        "lexical_index": lexical_index.stats() if lexical_index else None,
+        "flat_search": get_flat_index().stats() if get_flat_index() else None
+    })
+
 # 用.\.venv\Scripts\python.exe app.py启动
 if __name__ == '__main__':
     nacos_service = NacosService()
@@ -0,0 +1,205 @@
+"""
+动态微批处理模块
+把多个并发调用方的小请求合并成一次批量计算（一次模型前向），再把结果分发回各调用方
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+from metrics import LatencyRecorder
+
+logger = logging.getLogger(__name__)
+
+
+class _BatchRequest:
+    """单个调用方提交的请求"""
+
+    __slots__ = ("items", "future", "enqueued_at")
+
+    def __init__(self, items: List[Any]):
+        self.items = items
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    动态微批处理器
+
+    原理：调用方把输入放入队列后阻塞等待；后台线程取出第一个请求后，
+    在 max_wait_ms 时间窗内继续收集其他请求，直到凑满 max_batch_size
+    或超时，然后调用 handler 一次性处理整批输入，按顺序切分结果返回。
+
+    handler 约定：接收输入列表，返回等长的结果列表。
+    """
+
+    def __init__(self, handler: Callable[[List[Any]], List[Any]],
+                 max_batch_size: int = 64, max_wait_ms: float = 5.0,
+                 name: str = "batcher", workers: int = 1):
+        """
+        初始化微批处理器
+
+        Args:
+            handler: 批处理函数，输入列表 -> 等长结果列表
+            max_batch_size: 单批最多合并的输入条数（单个超大请求不会被拆分）
+            max_wait_ms: 收集同批请求的最长等待时间（毫秒），0 表示只合并已排队的请求
+            name: 名称，用于线程名和日志
+            workers: 后台处理线程数（模型推理类任务保持 1 即可）
+        """
+        self.handler = handler
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.name = name
+        self.workers = max(1, workers)
+
+        self._queue: "queue.Queue[_BatchRequest]" = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        self._worker_pid: Optional[int] = None
+        self._start_lock = threading.Lock()
+
+        # 统计
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._batches = 0
+        self._items = 0
+        self._max_batch_seen = 0
+        self._batch_sizes = LatencyRecorder()
+        self._compute_latency = LatencyRecorder()
+        self._queue_latency = LatencyRecorder()
+
+    def _workers_alive(self) -> bool:
+        """当前进程内的后台线程是否全部存活"""
+        return self._worker_pid == os.getpid() and all(t.is_alive() for t in self._threads)
+
+    def _ensure_worker(self):
+        """延迟启动后台线程（进程 fork 后自动重建）"""
+        if self._threads and self._workers_alive():
+            return
+        with self._start_lock:
+            if self._threads and self._workers_alive():
+                return
+            pid = os.getpid()
+            if self._worker_pid != pid:
+                # fork 后父进程的队列和线程不可用，重新创建
+                self._queue = queue.Queue()
+                self._threads = []
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._run,
+                    name=f"{self.name}-worker-{len(self._threads)}",
+                    daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            self._worker_pid = pid
+
+    def submit(self, items: List[Any], timeout: Optional[float] = None) -> List[Any]:
+        """
+        提交一组输入并阻塞等待结果
+
+        Args:
+            items: 输入列表
+            timeout: 等待超时（秒），None 表示一直等待
+
+        Returns:
+            与 items 等长、顺序一致的结果列表
+        """
+        if not items:
+            return []
+        return self.submit_async(items).result(timeout=timeout)
+
+    def submit_async(self, items: List[Any]) -> Future:
+        """提交一组输入，立即返回 Future（结果为与 items 等长的列表）"""
+        self._ensure_worker()
+        request = _BatchRequest(list(items))
+        self._queue.put(request)
+        return request.future
+
+    def _collect(self) -> List[_BatchRequest]:
+        """收集一批请求"""
+        first = self._queue.get()
+        batch = [first]
+        size = len(first.items)
+        deadline = time.perf_counter() + self.max_wait
+
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    request = self._queue.get(timeout=remaining)
+                else:
+                    request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.items)
+        return batch
+
+    def _run(self):
+        """后台线程主循环"""
+        while True:
+            batch = self._collect()
+            inputs = [item for request in batch for item in request.items]
+
+            started = time.perf_counter()
+            try:
+                outputs = self.handler(inputs)
+                if len(outputs) != len(inputs):
+                    raise RuntimeError(
+                        f"{self.name} handler 返回 {len(outputs)} 条结果，期望 {len(inputs)} 条"
+                    )
+            except Exception as e:
+                logger.error(f"{self.name} 批处理失败: {e}")
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+
+            offset = 0
+            for request in batch:
+                count = len(request.items)
+                request.future.set_result(outputs[offset:offset + count])
+                offset += count
+
+            self._record(batch, len(inputs), started, finished)
+
+    def _record(self, batch: List[_BatchRequest], size: int, started: float, finished: float):
+        """记录批次统计"""
+        with self._stats_lock:
+            self._requests += len(batch)
+            self._batches += 1
+            self._items += size
+            self._max_batch_seen = max(self._max_batch_seen, size)
+        self._batch_sizes.record(size)
+        self._compute_latency.record((finished - started) * 1000)
+        for request in batch:
+            self._queue_latency.record((started - request.enqueued_at) * 1000)
+
+    def queue_depth(self) -> int:
+        """当前排队中的请求数"""
+        return self._queue.qsize()
+
+    def stats(self) -> Dict:
+        """返回批处理统计"""
+        with self._stats_lock:
+            requests = self._requests
+            batches = self._batches
+            items = self._items
+            max_batch_seen = self._max_batch_seen
+        return {
+            "requests": requests,
+            "batches": batches,
+            "items": items,
+            "avg_batch_size": round(items / batches, 2) if batches else 0.0,
+            "avg_requests_per_batch": round(requests / batches, 2) if batches else 0.0,
+            "max_batch_size": max_batch_seen,
+            "queue_depth": self.queue_depth(),
+            "batch_size": self._batch_sizes.snapshot(),
+            "compute_ms": self._compute_latency.snapshot(),
+            "queue_wait_ms": self._queue_latency.snapshot(),
+        }
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+字符分块器基准测试
+
+对比 CharTextSplitter（线性时间单例）与 langchain 的 RecursiveCharacterTextSplitter
+在同一语料上的吞吐、块数与块长分布。不加载模型、不访问向量库。
+
+用法:
+    python bench_splitter.py                              # 合成中文语料（默认 20MB）
+    python bench_splitter.py --synthetic-mb 100
+    python bench_splitter.py data.jsonl --text-field body # NDJSON 语料
+    python bench_splitter.py corpus.txt                   # 纯文本语料（连续两个空行分隔文档）
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from typing import List
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from config import Config
+from text_splitter import CHUNK_SEPARATORS, CharTextSplitter
+
+_SENTENCES = [
+    "小米17 Pro Max 的续航表现非常出色",
+    "屏幕亮度很高，户外阳光下也能看清",
+    "价格偏贵，但做工和手感都不错",
+    "夜景模式相比上一代提升明显",
+    "系统动画流畅，偶尔会有发热",
+    "Version 2.1 修复了蓝牙断连的问题",
+    "客服回复很快……问题当天就解决了",
+    "快递包装完好，第二天就到了",
+]
+
+
+def synthetic_corpus(megabytes: float, seed: int = 42) -> List[str]:
+    """生成合成中文评论语料：短评、长评、无分隔符长串混合"""
+    rng = random.Random(seed)
+    target = int(megabytes * 1024 * 1024 / 3)  # 汉字 UTF-8 约 3 字节
+    texts, total = [], 0
+    while total < target:
+        kind = rng.random()
+        if kind < 0.6:
+            sentences = rng.randint(1, 8)
+        elif kind < 0.95:
+            sentences = rng.randint(20, 400)
+        else:
+            texts.append("数据" * rng.randint(200, 2000))
+            total += len(texts[-1])
+            continue
+        parts = []
+        for _ in range(sentences):
+            parts.append(rng.choice(_SENTENCES) + rng.choice("。！？；，"))
+            if rng.random() < 0.05:
+                parts.append(rng.choice(["\n", "\n\n"]))
+        texts.append("".join(parts))
+        total += len(texts[-1])
+    return texts
+
+
+def load_corpus(path: str, text_field: str) -> List[str]:
+    """读取语料：.jsonl/.ndjson 按行取 text_field，其余按连续两个空行分文档"""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".ndjson")):
+            return [json.loads(line)[text_field] for line in f if line.strip()]
+        return [part for part in f.read().split("\n\n\n") if part.strip()]
+
+
+def run(name: str, splitter, texts: List[str], repeat: int) -> dict:
+    """多次切分整份语料，取最快一次"""
+    best, chunks = float("inf"), []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        chunks = [chunk for text in texts for chunk in splitter.split_text(text)]
+        best = min(best, time.perf_counter() - started)
+    chars = sum(len(text) for text in texts)
+    lengths = [len(chunk) for chunk in chunks] or [0]
+    return {
+        "splitter": name,
+        "seconds": round(best, 3),
+        "mchars_per_sec": round(chars / best / 1e6, 2) if best else 0.0,
+        "chunks": len(chunks),
+        "avg_len": round(statistics.mean(lengths), 1),
+        "max_len": max(lengths),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="字符分块器基准测试")
+    parser.add_argument("path", nargs="?", help="语料文件（.jsonl 或纯文本），缺省时使用合成语料")
+    parser.add_argument("--text-field", default="text", help="NDJSON 正文字段名（默认 text）")
+    parser.add_argument("--synthetic-mb", type=float, default=20, help="合成语料大小（MB，默认 20）")
+    parser.add_argument("--chunk-size", type=int, default=Config.CHUNK_SIZE, help="每块最大字符数")
+    parser.add_argument("--chunk-overlap", type=int, default=Config.CHUNK_OVERLAP, help="重叠字符数")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数（取最快一次）")
+    args = parser.parse_args()
+
+    texts = load_corpus(args.path, args.text_field) if args.path else synthetic_corpus(args.synthetic_mb)
+    chars = sum(len(text) for text in texts)
+    print(f"语料: {len(texts)} 篇, {chars / 1e6:.2f}M 字符, "
+          f"chunk_size={args.chunk_size}, chunk_overlap={args.chunk_overlap}")
+
+    splitters = [
+        ("CharTextSplitter", CharTextSplitter(args.chunk_size, args.chunk_overlap)),
+        ("RecursiveCharacterTextSplitter", RecursiveCharacterTextSplitter(
+            chunk_size=args.chunk_size,
+            chunk_overlap=args.chunk_overlap,
+            length_function=len,
+            separators=CHUNK_SEPARATORS,
+        )),
+    ]
+    results = [run(name, splitter, texts, args.repeat) for name, splitter in splitters]
+
+    print(f"{'splitter':<32}{'seconds':>10}{'Mchar/s':>10}{'chunks':>10}{'avg_len':>10}{'max_len':>10}")
+    for r in results:
+        print(f"{r['splitter']:<32}{r['seconds']:>10}{r['mchars_per_sec']:>10}"
+              f"{r['chunks']:>10}{r['avg_len']:>10}{r['max_len']:>10}")
+    if results[0]["seconds"]:
+        print(f"加速比: {results[1]['seconds'] / results[0]['seconds']:.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
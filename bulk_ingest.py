@@ -0,0 +1,423 @@
+"""
+批量入库流水线
+- bulk_add_texts: /add_batch 使用，多线程分块 -> 大批量向量化 -> 分片写入 Chroma，返回逐条结果
+- ingest_stream: /add_stream 与离线导入脚本使用，NDJSON 流式解析，常量内存
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from config import Config
+from vector_store import add_embedded_documents, delete_documents, fill_vectors, split_text_with_vectors
+
+logger = logging.getLogger(__name__)
+
+# 全局分块线程池
+_split_pool: Optional[ThreadPoolExecutor] = None
+_split_pool_lock = threading.Lock()
+
+
+def get_split_pool() -> ThreadPoolExecutor:
+    """获取分块线程池单例（线程数默认等于 CPU 核数）"""
+    global _split_pool
+    if _split_pool is None:
+        with _split_pool_lock:
+            if _split_pool is None:
+                workers = Config.BULK_SPLIT_WORKERS or os.cpu_count() or 4
+                _split_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bulk-split")
+    return _split_pool
+
+
+def _safe_split(text, metadata):
+    """分块，返回 ((块列表, 块向量列表), None)，异常作为结果返回而不是抛出"""
+    try:
+        if not isinstance(text, str):
+            raise ValueError("text must be a string")
+        if metadata is not None and not isinstance(metadata, dict):
+            raise ValueError("metadata must be a dictionary")
+        return split_text_with_vectors(text, metadata), None
+    except Exception as e:
+        return None, str(e)
+
+
+def bulk_add_texts(texts: List[str], metadatas: List[dict] = None,
+                   slice_size: int = None) -> List[Dict]:
+    """
+    批量入库
+
+    1. 在线程池上并行按 CHUNK_STRATEGY 分块
+    2. 所有 chunk 按 slice_size 分片：每片一次向量化（经嵌入服务大批量计算）
+    3. 每片一次写入 Chroma；写入与下一片的向量化重叠执行
+    4. 某条文本的块跨多个分片时，任一分片失败则删除它在其他分片中已写入的块，
+       失败的条目不留下部分数据，可原样重试
+
+    Args:
+        texts: 文本列表
+        metadatas: 元数据列表（与 texts 等长，可为 None）
+        slice_size: 每片 chunk 数，默认 Config.BULK_SLICE_SIZE
+
+    Returns:
+        与 texts 等长的逐条结果：{"index", "status": "success"/"failed", "chunks", "error"}
+    """
+    slice_size = slice_size or Config.BULK_SLICE_SIZE
+    metadatas = metadatas if metadatas is not None else [{} for _ in texts]
+    started = time.perf_counter()
+
+    # 1. 并行分块
+    split_results = list(get_split_pool().map(_safe_split, texts, metadatas))
+
+    results = []
+    chunks = []
+    owners = []  # 每个 chunk 所属的原始文本下标
+    precomputed = []  # 分块时已得到的块向量（语义分块），None 表示待向量化
+    for index, (item, error) in enumerate(split_results):
+        if error is not None:
+            results.append({"index": index, "status": "failed", "chunks": 0, "error": error})
+            continue
+        item_chunks, item_vectors = item
+        results.append({"index": index, "status": "success", "chunks": len(item_chunks), "error": None})
+        chunks.extend(item_chunks)
+        precomputed.extend(item_vectors)
+        owners.extend([index] * len(item_chunks))
+
+    # 2/3. 分片向量化 + 写入（写入在单独线程，与下一片向量化并行）
+    chunk_ids = [str(uuid.uuid4()) for _ in chunks]
+
+    def write_slice(start, docs, vectors):
+        try:
+            add_embedded_documents(docs, vectors, ids=chunk_ids[start:start + len(docs)])
+        except Exception as e:
+            logger.error(f"批量写入失败，分片起点 {start}: {e}")
+            return start, len(docs), str(e)
+        return start, len(docs), None
+
+    outcomes = []
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="bulk-write") as writer:
+        pending = None
+        for start in range(0, len(chunks), slice_size):
+            docs = chunks[start:start + slice_size]
+            try:
+                vectors = fill_vectors(docs, precomputed[start:start + slice_size])
+            except Exception as e:
+                logger.error(f"批量向量化失败，分片起点 {start}: {e}")
+                outcomes.append((start, len(docs), str(e)))
+                continue
+            if pending is not None:
+                outcomes.append(pending.result())
+            pending = writer.submit(write_slice, start, docs, vectors)
+        if pending is not None:
+            outcomes.append(pending.result())
+
+    for start, count, error in outcomes:
+        if error is None:
+            continue
+        for index in set(owners[start:start + count]):
+            results[index].update(status="failed", error=error)
+
+    # 4. 回滚失败条目已写入的块（失败分片本身也可能已写入部分分片集合）
+    failed = {index for index in owners if results[index]["status"] == "failed"}
+    if failed:
+        try:
+            removed = delete_documents([chunk_id for chunk_id, index in zip(chunk_ids, owners) if index in failed])
+            logger.warning(f"批量入库回滚 {len(failed)} 条失败文本已写入的块: {removed} 个")
+        except Exception as e:
+            logger.error(f"批量入库回滚失败: {e}")
+            for index in failed:
+                results[index]["error"] += f" (rollback failed: {e})"
+
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"批量入库完成: {len(texts)} 条文本，{len(chunks)} 个块，耗时 {elapsed:.2f}s"
+    )
+    return results
+
+
+class IngestProgress:
+    """流式入库进度（线程安全）"""
+
+    MAX_ERRORS = 100  # 只保留前 100 条错误详情
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.docs = 0
+        self.chunks = 0
+        self.failed_docs = 0
+        self.failed_chunks = 0
+        self.errors: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def add_error(self, line: int, error: str):
+        """记录一条失败文档"""
+        with self._lock:
+            self.failed_docs += 1
+            if len(self.errors) < self.MAX_ERRORS:
+                self.errors.append({"line": line, "error": error})
+
+    def add_chunks(self, written: int = 0, failed: int = 0):
+        """记录写入成功/失败的块数"""
+        with self._lock:
+            self.chunks += written
+            self.failed_chunks += failed
+
+    def to_dict(self) -> Dict:
+        """进度快照（含 docs/sec）"""
+        elapsed = time.perf_counter() - self.started
+        return {
+            "docs": self.docs,
+            "chunks": self.chunks,
+            "failed_docs": self.failed_docs,
+            "failed_chunks": self.failed_chunks,
+            "elapsed_seconds": round(elapsed, 3),
+            "docs_per_sec": round(self.docs / elapsed, 2) if elapsed > 0 else 0.0,
+            "errors": list(self.errors),
+        }
+
+
+_STREAM_END = object()
+
+
+def parse_record(record: dict, text_field: str = "text", metadata_field: str = "metadata"):
+    """
+    从一条 NDJSON 记录中取出 (text, metadata)
+
+    metadata_field 存在且为字典时直接使用；否则把除正文外的标量字段作为元数据
+    （例如 requests.jsonl 形如 {"request_id", "title", "body"}，用 text_field="body"）
+    """
+    if not isinstance(record, dict):
+        raise ValueError("record must be a JSON object")
+    text = record.get(text_field)
+    if not isinstance(text, str) or not text:
+        raise ValueError(f"missing '{text_field}' field")
+    metadata = record.get(metadata_field)
+    if metadata is None:
+        metadata = {
+            key: value for key, value in record.items()
+            if key != text_field and isinstance(value, (str, int, float, bool))
+        }
+    if not isinstance(metadata, dict):
+        raise ValueError(f"'{metadata_field}' must be a dictionary")
+    return text, metadata
+
+
+def ingest_stream(lines, text_field: str = "text", metadata_field: str = "metadata",
+                  batch_size: int = None, slice_size: int = None,
+                  progress_interval: float = None, on_progress=None) -> Dict:
+    """
+    流式入库（NDJSON）
+
+    解析 -> 分块 -> 向量化 -> 写入 四个阶段流水线并行，阶段之间使用有界队列，
+    内存占用与输入总量无关。与 bulk_add_texts 一样按文档原子：一篇文档的任一块
+    向量化或写入失败时整篇记为失败，并删除它已写入的块。某个阶段线程异常时，
+    其余文档记为失败，流水线照常结束，不会阻塞调用方。
+
+    Args:
+        lines: 可迭代的行（str 或 bytes），每行一个 JSON 对象
+        text_field: 正文字段名
+        metadata_field: 元数据字段名
+        batch_size: 每批解析的文档数，默认 Config.STREAM_BATCH_SIZE
+        slice_size: 每次向量化/写入的 chunk 数，默认 Config.BULK_SLICE_SIZE
+        progress_interval: 进度回调间隔（秒），默认 Config.STREAM_PROGRESS_INTERVAL
+        on_progress: 进度回调，参数为进度字典；默认写日志
+
+    Returns:
+        最终进度统计（文档数、块数、失败数、docs/sec 等）
+    """
+    batch_size = batch_size or Config.STREAM_BATCH_SIZE
+    slice_size = slice_size or Config.BULK_SLICE_SIZE
+    progress_interval = progress_interval if progress_interval is not None else Config.STREAM_PROGRESS_INTERVAL
+    on_progress = on_progress or (lambda p: logger.info(
+        f"流式入库进度: {p['docs']} 文档, {p['chunks']} 块, {p['docs_per_sec']} docs/s"
+    ))
+
+    progress = IngestProgress()
+    chunk_queue = queue.Queue(maxsize=4)   # 解析批 -> 分块
+    embed_queue = queue.Queue(maxsize=4)   # chunk 分片 -> 向量化
+    write_queue = queue.Queue(maxsize=4)   # (分片, 向量) -> 写入
+
+    def drain(inbox: queue.Queue, handle, on_error):
+        """
+        逐项处理 inbox 直到结束标记
+
+        处理抛出异常后不再调用 handle，剩余各项（含出错的一项）交给 on_error 记为失败，
+        但仍读到结束标记为止，保证上游阶段与调用方不会阻塞在有界队列上。
+
+        Returns:
+            第一次异常的描述，没有异常时为 None
+        """
+        error = None
+        while True:
+            item = inbox.get()
+            if item is _STREAM_END:
+                return error
+            if error is None:
+                try:
+                    handle(item)
+                    continue
+                except Exception as e:
+                    logger.exception(f"流式入库阶段 {threading.current_thread().name} 异常: {e}")
+                    error = f"ingest stage failed: {e}"
+            on_error(item, error)
+
+    # 分块阶段：buffer 中每项为 (行号, chunk, 分块时已得到的向量或 None, chunk ID)
+    buffer = []
+    last_line = 0  # 已分块完成的最后一行
+
+    def chunk_batch(batch):
+        nonlocal buffer, last_line
+        split_results = get_split_pool().map(
+            _safe_split, [text for _, text, _ in batch], [meta for _, _, meta in batch]
+        )
+        for (line_no, _, _), (item, error) in zip(batch, split_results):
+            if error is not None:
+                progress.add_error(line_no, error)
+            else:
+                item_chunks, item_vectors = item
+                buffer.extend(
+                    (line_no, chunk, vector, str(uuid.uuid4()))
+                    for chunk, vector in zip(item_chunks, item_vectors)
+                )
+            last_line = line_no
+            while len(buffer) >= slice_size:
+                embed_queue.put((buffer[:slice_size], None))
+                buffer = buffer[slice_size:]
+
+    def chunk_failed(batch, error):
+        for line_no, _, _ in batch:
+            if line_no > last_line:
+                progress.add_error(line_no, error)
+
+    def chunk_stage():
+        error = None
+        try:
+            error = drain(chunk_queue, chunk_batch, chunk_failed)
+        finally:
+            # 出错时 buffer 中的文档可能已有块进入下游，交给写入阶段整体失败并回滚
+            if buffer:
+                embed_queue.put((buffer, error))
+            embed_queue.put(_STREAM_END)
+
+    # 向量化阶段：向量化失败的分片带着错误继续传给写入阶段，按序处理回滚
+    def embed_slice(item):
+        entries, error = item
+        if error is None:
+            try:
+                vectors = fill_vectors([entry[1] for entry in entries], [entry[2] for entry in entries])
+            except Exception as e:
+                logger.error(f"流式入库向量化失败: {e}")
+                error = str(e)
+        write_queue.put((entries, None if error else vectors, error))
+
+    def embed_stage():
+        try:
+            drain(embed_queue, embed_slice, lambda item, error: write_queue.put((item[0], None, error)))
+        finally:
+            write_queue.put(_STREAM_END)
+
+    # 写入阶段：一篇文档的块可能跨多个相邻分片，任一分片失败则整篇失败，
+    # 删除它已写入的块，并跳过它在后续分片中的块
+    open_lines: Dict[int, List[str]] = {}  # 可能延续到下一分片的文档已写入的块 ID
+    failed_lines = set()
+
+    def fail_lines(lines: set, error: str, attempted: Dict[int, List[str]] = None):
+        for line_no in sorted(lines - failed_lines):
+            written = open_lines.pop(line_no, [])
+            ids = written + (attempted or {}).get(line_no, [])
+            message = error
+            if ids:
+                try:
+                    delete_documents(ids)
+                    progress.add_chunks(written=-len(written), failed=len(written))
+                except Exception as e:
+                    logger.error(f"流式入库回滚失败，第 {line_no} 行: {e}")
+                    message += f" (rollback failed: {e})"
+            progress.add_error(line_no, message)
+        failed_lines.update(lines)
+
+    def write_slice(item):
+        entries, vectors, error = item
+        lines = {entry[0] for entry in entries}
+        # 块按行号顺序到达，不在本分片中的文档不会再出现
+        for line_no in [line_no for line_no in open_lines if line_no not in lines]:
+            del open_lines[line_no]
+        failed_lines.intersection_update(lines)
+        if error is not None:
+            fail_lines(lines, error)
+            progress.add_chunks(failed=len(entries))
+            return
+        keep = [i for i, entry in enumerate(entries) if entry[0] not in failed_lines]
+        progress.add_chunks(failed=len(entries) - len(keep))
+        if not keep:
+            return
+        ids = [entries[i][3] for i in keep]
+        try:
+            add_embedded_documents([entries[i][1] for i in keep], [vectors[i] for i in keep], ids=ids)
+        except Exception as e:
+            logger.error(f"流式入库写入失败: {e}")
+            attempted: Dict[int, List[str]] = {}
+            for i in keep:
+                attempted.setdefault(entries[i][0], []).append(entries[i][3])
+            fail_lines(set(attempted), str(e), attempted)
+            progress.add_chunks(failed=len(keep))
+            return
+        progress.add_chunks(written=len(keep))
+        for i in keep:
+            open_lines.setdefault(entries[i][0], []).append(entries[i][3])
+
+    def write_failed(item, error):
+        progress.add_chunks(failed=len(item[0]))
+        for line_no in sorted({entry[0] for entry in item[0]} - failed_lines):
+            progress.add_error(line_no, error)
+        failed_lines.update(entry[0] for entry in item[0])
+
+    def write_stage():
+        drain(write_queue, write_slice, write_failed)
+
+    stages = [
+        threading.Thread(target=chunk_stage, name="stream-chunk", daemon=True),
+        threading.Thread(target=embed_stage, name="stream-embed", daemon=True),
+        threading.Thread(target=write_stage, name="stream-write", daemon=True),
+    ]
+    for stage in stages:
+        stage.start()
+
+    # 解析阶段在调用线程中执行
+    batch = []
+    last_report = time.perf_counter()
+    try:
+        for line_no, line in enumerate(lines, start=1):
+            try:
+                # 非法 UTF-8 与 JSON 解析失败一样只记为该行失败
+                if isinstance(line, bytes):
+                    line = line.decode("utf-8")
+                line = line.strip()
+                if not line:
+                    continue
+                text, metadata = parse_record(json.loads(line), text_field, metadata_field)
+            except Exception as e:
+                progress.add_error(line_no, str(e))
+                continue
+            batch.append((line_no, text, metadata))
+            progress.docs += 1
+            if len(batch) >= batch_size:
+                chunk_queue.put(batch)
+                batch = []
+            now = time.perf_counter()
+            if now - last_report >= progress_interval:
+                on_progress(progress.to_dict())
+                last_report = now
+    finally:
+        if batch:
+            chunk_queue.put(batch)
+        chunk_queue.put(_STREAM_END)
+        for stage in stages:
+            stage.join()
+
+    result = progress.to_dict()
+    on_progress(result)
+    return result
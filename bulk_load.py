@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+离线批量导入脚本
+
+服务停止时把 NDJSON 文件直接写入 VectorStore 的 Chroma 目录，流程与 /add_stream 相同。
+嵌入式 Chroma 不支持多进程同时写入，运行前请先停止 easyRAG 服务。
+
+用法:
+    python bulk_load.py data.jsonl
+    python bulk_load.py requests.jsonl --text-field body
+    cat data.jsonl | python bulk_load.py -
+"""
+import argparse
+import logging
+import os
+import sys
+
+from config import Config
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('bulk_load')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="离线批量导入 NDJSON 到向量库")
+    parser.add_argument("path", help="NDJSON 文件路径，- 表示标准输入")
+    parser.add_argument("--text-field", default="text", help="正文字段名（默认 text）")
+    parser.add_argument("--metadata-field", default="metadata", help="元数据字段名（默认 metadata）")
+    parser.add_argument("--vector-dir", default=None, help="Chroma 目录（默认 Config.VECTOR_DIR）")
+    parser.add_argument("--batch-size", type=int, default=None, help="每批解析的文档数")
+    parser.add_argument("--slice-size", type=int, default=None, help="每次向量化/写入的块数")
+    args = parser.parse_args()
+
+    if args.vector_dir:
+        Config.VECTOR_DIR = args.vector_dir
+        if not os.getenv("LEXICAL_INDEX_DIR"):
+            Config.LEXICAL_INDEX_DIR = os.path.join(
+                os.path.dirname(os.path.normpath(args.vector_dir)) or ".", "lexical_index"
+            )
+
+    # 必须在修改 Config 之后导入，VectorStore 首次创建时读取 VECTOR_DIR
+    from bulk_ingest import ingest_stream
+    from lexical_index import get_lexical_index
+
+    # 加载关键词索引并注册变更监听，导入的数据同步写入 BM25 索引
+    get_lexical_index()
+
+    def report(progress):
+        logger.info(
+            f"已处理 {progress['docs']} 文档 / {progress['chunks']} 块，"
+            f"失败 {progress['failed_docs']} 文档，{progress['docs_per_sec']} docs/s"
+        )
+
+    logger.info(f"开始导入: {args.path} -> {Config.VECTOR_DIR}")
+    if args.path == "-":
+        result = ingest_stream(sys.stdin, args.text_field, args.metadata_field,
+                               batch_size=args.batch_size, slice_size=args.slice_size,
+                               on_progress=report)
+    else:
+        with open(args.path, "r", encoding="utf-8") as f:
+            result = ingest_stream(f, args.text_field, args.metadata_field,
+                                   batch_size=args.batch_size, slice_size=args.slice_size,
+                                   on_progress=report)
+
+    for error in result["errors"]:
+        logger.warning(f"第 {error['line']} 行导入失败: {error['error']}")
+    logger.info(f"导入完成，耗时 {result['elapsed_seconds']}s")
+    return 0 if result["failed_docs"] == 0 and result["failed_chunks"] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,284 @@
+"""
+缓存模块
+- LRUCache: 线程安全的内存 LRU 缓存，支持容量、TTL 和内存上限三种淘汰方式，并统计命中率
+- DiskEmbeddingCache: 基于内容哈希的持久化嵌入向量缓存
+"""
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+# 每个条目除键和值以外的内存开销（OrderedDict 节点 + (value, expires_at, size) 元组，CPython 64 位实测约 170 字节）
+_ENTRY_OVERHEAD = 170
+
+
+class LRUCache:
+    """
+    线程安全的 LRU 缓存
+
+    淘汰规则：
+    - 条目数超过 max_size 时淘汰最久未使用的条目
+    - 设置 max_bytes 时，按 sys.getsizeof(key) + sizeof(value) + 条目开销估算的总占用超过上限也会淘汰
+      （键按 sys.getsizeof 计，元组等容器键只计外层，长文本应先哈希成定长键）
+    - 设置 ttl 时，过期条目在读取时视为未命中并删除
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 0,
+                 max_bytes: int = 0, sizeof: Callable[[Any], int] = None):
+        """
+        初始化缓存
+
+        Args:
+            max_size: 最大条目数，<=0 表示不限条目数
+            ttl: 过期时间（秒），<=0 表示永不过期
+            max_bytes: 内存上限（字节），<=0 表示不限
+            sizeof: 估算单个值占用字节数的函数，max_bytes>0 时必须提供
+        """
+        if max_bytes > 0 and sizeof is None:
+            raise ValueError("设置 max_bytes 时必须提供 sizeof")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """读取缓存，命中时刷新 LRU 顺序"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._misses += 1
+                return default
+            value, expires_at, size = entry
+            if expires_at and expires_at < time.monotonic():
+                del self._data[key]
+                self._bytes -= size
+                self._misses += 1
+                return default
+            self._data.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        """写入缓存"""
+        size = sys.getsizeof(key) + self._sizeof(value) + _ENTRY_OVERHEAD if self._sizeof else 0
+        if self.max_bytes > 0 and size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else 0
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._data[key] = (value, expires_at, size)
+            self._bytes += size
+            self._evict()
+
+    def _evict(self):
+        """按容量和内存上限淘汰（调用方持有锁）"""
+        while self._data and (
+            (self.max_size > 0 and len(self._data) > self.max_size)
+            or (self.max_bytes > 0 and self._bytes > self.max_bytes)
+        ):
+            _, (_, _, size) = self._data.popitem(last=False)
+            self._bytes -= size
+            self._evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """删除并返回条目"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            self._bytes -= entry[2]
+            return entry[0]
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict:
+        """返回命中率等统计"""
+        with self._lock:
+            hits, misses = self._hits, self._misses
+            stats = {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+                "evictions": self._evictions,
+            }
+            if self.max_bytes > 0:
+                stats["bytes"] = self._bytes
+                stats["max_bytes"] = self.max_bytes
+        return stats
+
+
+class DiskEmbeddingCache:
+    """
+    持久化嵌入向量缓存
+
+    以 sha256(模型名 + 文本) 为键，把向量以 float32 二进制存入 SQLite，
+    服务重启后依然有效：重复入库的相同内容无需再经过模型。
+
+    每条记录带最近使用时间（命中时按天更新）：条目数超过 max_entries 时淘汰最久未使用的条目
+    （一次删到上限的 90%），超过 max_age 未使用的条目定期删除。条目数在内存中累计，
+    只在打开连接、每小时校正和淘汰时统计全表（多个进程共用同一文件时两次校正之间为近似值）。
+    """
+
+    _SQL_BATCH = 500        # 单条 SQL 的最大参数个数，避免超过 SQLite 限制
+    _TOUCH_INTERVAL = 86400  # 命中时最近使用时间的更新粒度（秒），避免每次读取都写库
+    _PRUNE_INTERVAL = 3600   # 校正条目数、清理过期条目的间隔（秒）
+
+    def __init__(self, directory: str, max_entries: int = 0, max_age: float = 0):
+        """
+        初始化缓存
+
+        Args:
+            directory: 缓存目录，不存在时自动创建
+            max_entries: 最大条目数，0 表示不限
+            max_age: 未使用超过该时间（秒）的条目被删除，0 表示不限
+        """
+        self.path = os.path.join(directory, "embeddings.sqlite3")
+        self.max_entries = max_entries
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+        self._local_pid = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._writes = 0
+        self._entries = 0
+        self._evictions = 0
+        self._pruned_at = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        """获取连接（进程 fork 后重新打开，连接不跨进程共享；调用方持有锁）"""
+        pid = os.getpid()
+        if self._conn is None or self._local_pid != pid:
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, used_at INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(embeddings)")}
+            if "used_at" not in columns:
+                # 旧版缓存文件：补充最近使用时间列，已有条目从现在开始计算
+                conn.execute("ALTER TABLE embeddings ADD COLUMN used_at INTEGER NOT NULL DEFAULT 0")
+                conn.execute("UPDATE embeddings SET used_at = ?", (int(time.time()),))
+            conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used_at ON embeddings (used_at)")
+            conn.commit()
+            self._conn = conn
+            self._local_pid = pid
+            self._pruned_at = 0.0
+            self._prune()
+        return self._conn
+
+    def _prune(self):
+        """删除过期条目，超过条目上限时淘汰最久未使用的条目（调用方持有锁）"""
+        now = time.time()
+        conn = self._conn
+        with conn:
+            if now - self._pruned_at >= self._PRUNE_INTERVAL:
+                # 定期按实际条目数校正（其他进程也会写入和淘汰）并清理过期条目
+                self._pruned_at = now
+                self._entries = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                if self.max_age > 0:
+                    removed = conn.execute(
+                        "DELETE FROM embeddings WHERE used_at < ?", (int(now - self.max_age),)
+                    ).rowcount
+                    self._entries -= removed
+                    self._evictions += removed
+            if self.max_entries > 0 and self._entries > self.max_entries:
+                self._entries = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                if self._entries > self.max_entries:
+                    removed = conn.execute(
+                        "DELETE FROM embeddings WHERE key IN "
+                        "(SELECT key FROM embeddings ORDER BY used_at LIMIT ?)",
+                        (self._entries - int(self.max_entries * 0.9),)
+                    ).rowcount
+                    self._entries -= removed
+                    self._evictions += removed
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        """生成缓存键：sha256(模型名 \\0 文本)"""
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """批量读取，返回命中的 key -> 向量（命中条目的最近使用时间超过一天时更新）"""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        now = int(time.time())
+        with self._lock:
+            conn = self._connection()
+            stale = []
+            for start in range(0, len(unique_keys), self._SQL_BATCH):
+                batch = unique_keys[start:start + self._SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT key, vector, used_at FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob, used_at in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+                    if now - used_at >= self._TOUCH_INTERVAL:
+                        stale.append((now, key))
+            if stale:
+                with conn:
+                    conn.executemany("UPDATE embeddings SET used_at = ? WHERE key = ?", stale)
+            self._hits += len(found)
+            self._misses += len(unique_keys) - len(found)
+        return found
+
+    def put_many(self, items: List[Tuple[str, List[float]]]):
+        """批量写入 (key, 向量)，写入后按需淘汰"""
+        if not items:
+            return
+        now = int(time.time())
+        # 相同 key 即相同模型与文本，向量相同，已存在的条目无需覆盖
+        rows = [(key, array("f", vector).tobytes(), now) for key, vector in items]
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                inserted = conn.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, vector, used_at) VALUES (?, ?, ?)", rows
+                ).rowcount
+            self._writes += len(rows)
+            self._entries += max(0, inserted)
+            self._prune()
+
+    def stats(self) -> Dict:
+        """返回命中统计（条目数为累计值，不扫描全表）"""
+        with self._lock:
+            self._connection()
+            hits, misses = self._hits, self._misses
+            return {
+                "path": self.path,
+                "entries": self._entries,
+                "max_entries": self.max_entries,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+                "writes": self._writes,
+                "evictions": self._evictions,
+            }
@@ -0,0 +1,180 @@
+"""
+Chroma 客户端
+CHROMA_MODE=local 时使用嵌入式 Chroma（VECTOR_DIR）；
+CHROMA_MODE=http 时连接独立部署的 Chroma 服务，多个无状态 easyRAG 实例共享同一个向量库。
+嵌入向量始终在客户端计算（嵌入服务微批），服务端只负责存储与检索。
+"""
+import base64
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import httpx
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# 可重试的服务端状态码（网关/服务暂时不可用）
+_RETRY_STATUS = {429, 502, 503, 504}
+
+# 写入类接口：请求可能已被服务端执行，只在连接阶段失败（请求未发出）时重试
+_WRITE_PATHS = ("/add", "/upsert", "/update", "/delete")
+
+
+class RetryTransport(httpx.HTTPTransport):
+    """
+    带退避重试的 HTTP 传输层
+
+    查询类请求在连接失败、读超时及 429/502/503/504 时按指数退避（带抖动）重试；
+    写入类请求（add/upsert/update/delete）可能已在服务端执行，只在连接失败时重试。
+    """
+
+    def __init__(self, retries: int = 3, backoff: float = 0.2, **kwargs):
+        """
+        Args:
+            retries: 最大重试次数
+            backoff: 首次重试等待（秒），之后每次翻倍
+            **kwargs: 透传给 httpx.HTTPTransport（连接池上限等）
+        """
+        super().__init__(**kwargs)
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.retried = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _is_write(request: httpx.Request) -> bool:
+        return request.method in ("PUT", "DELETE") or (
+            request.method == "POST" and request.url.path.rstrip("/").endswith(_WRITE_PATHS)
+        )
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        write = self._is_write(request)
+        retryable = (httpx.ConnectError,) if write else \
+            (httpx.ConnectError, httpx.ReadTimeout, httpx.RemoteProtocolError)
+        while True:
+            try:
+                response = super().handle_request(request)
+                if write or response.status_code not in _RETRY_STATUS or attempt >= self.retries:
+                    return response
+                response.close()
+                reason = f"HTTP {response.status_code}"
+            except retryable as e:
+                if attempt >= self.retries:
+                    with self._lock:
+                        self.failed += 1
+                    raise
+                reason = type(e).__name__
+
+            delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+            attempt += 1
+            with self._lock:
+                self.retried += 1
+            logger.warning(f"Chroma 请求 {request.method} {request.url.path} 失败（{reason}），"
+                           f"{delay:.2f}s 后第 {attempt} 次重试")
+            time.sleep(delay)
+
+
+def _auth_headers() -> Dict[str, str]:
+    """CHROMA_AUTH：user:password 使用 Basic 认证，否则作为 Bearer token"""
+    if not Config.CHROMA_AUTH:
+        return {}
+    if ":" in Config.CHROMA_AUTH:
+        token = base64.b64encode(Config.CHROMA_AUTH.encode("utf-8")).decode("ascii")
+        return {"Authorization": f"Basic {token}"}
+    return {"Authorization": f"Bearer {Config.CHROMA_AUTH}"}
+
+
+class ChromaHttpBackend:
+    """
+    Chroma 服务端连接
+
+    所有分片集合共用一个客户端，即共用一个 keep-alive 连接池；
+    连接池替换为带重试的传输层，进程 fork 后在子进程中重建连接池。
+    替换依赖 chromadb HTTP 客户端的内部属性（_server._session / http_limits），
+    当前版本没有这些属性时保留原生客户端（无重试），只记录警告。
+    """
+
+    def __init__(self):
+        import chromadb
+        from chromadb.config import Settings
+
+        self.host = Config.CHROMA_HOST
+        self.port = Config.CHROMA_PORT
+        self.client = chromadb.HttpClient(
+            host=self.host,
+            port=self.port,
+            ssl=Config.CHROMA_USE_HTTPS,
+            headers=_auth_headers(),
+            settings=Settings(
+                anonymized_telemetry=False,
+                chroma_http_keepalive_secs=Config.CHROMA_KEEPALIVE,
+                chroma_http_max_connections=Config.CHROMA_POOL_SIZE,
+                chroma_http_max_keepalive_connections=Config.CHROMA_POOL_SIZE,
+            )
+        )
+        self.transport: Optional[RetryTransport] = None
+        if self._supports_session():
+            self._install_session()
+            # fork 后的子进程不能复用父进程的连接：只丢弃引用（不关闭），重建连接池
+            os.register_at_fork(after_in_child=lambda: self._install_session(close_old=False))
+        else:
+            logger.warning(f"chromadb {chromadb.__version__} 的 HTTP 客户端结构不受支持，"
+                           f"使用原生连接（不重试、fork 后不重建连接池）")
+        logger.info(f"已连接 Chroma 服务: {self.host}:{self.port}，连接池 {Config.CHROMA_POOL_SIZE}")
+
+    def _supports_session(self) -> bool:
+        """chromadb HTTP 客户端是否有可替换的 httpx 连接池"""
+        server = getattr(self.client, "_server", None)
+        return isinstance(getattr(server, "_session", None), httpx.Client) \
+            and isinstance(getattr(server, "http_limits", None), httpx.Limits)
+
+    def _install_session(self, close_old: bool = True):
+        """为 chromadb 的 HTTP 客户端换上带重试的连接池（保留其请求头）"""
+        server = self.client._server
+        old_session = server._session
+        self.transport = RetryTransport(
+            retries=Config.CHROMA_RETRIES,
+            backoff=Config.CHROMA_RETRY_BACKOFF,
+            limits=server.http_limits,
+        )
+        server._session = httpx.Client(
+            transport=self.transport,
+            headers=old_session.headers,
+            timeout=httpx.Timeout(Config.CHROMA_TIMEOUT, connect=Config.CHROMA_CONNECT_TIMEOUT),
+        )
+        if close_old:
+            old_session.close()
+
+    def stats(self) -> Dict:
+        """连接与重试统计"""
+        return {
+            "mode": "http",
+            "server": f"{self.host}:{self.port}",
+            "pool_size": Config.CHROMA_POOL_SIZE,
+            "retried": self.transport.retried if self.transport else 0,
+            "failed": self.transport.failed if self.transport else 0,
+        }
+
+
+# 全局单例
+_backend: Optional[ChromaHttpBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_chroma_backend() -> Optional[ChromaHttpBackend]:
+    """获取 Chroma 服务端连接（CHROMA_MODE=local 时返回 None，使用嵌入式 Chroma）"""
+    global _backend
+    if Config.CHROMA_MODE != "http":
+        return None
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = ChromaHttpBackend()
+    return _backend
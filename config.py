@@ -11,25 +11,122 @@ class Config:
     SPARK_API_KEY = os.getenv("SPARK_API_KEY")
     SPARK_URL = "wss://spark-api.xf-yun.com/v4.0/chat"
     SPARK_DOMAIN = "4.0Ultra"
+    SPARK_CONNECT_TIMEOUT = float(os.getenv("SPARK_CONNECT_TIMEOUT", "10"))    # 建立连接超时（秒）
+    SPARK_RESPONSE_TIMEOUT = float(os.getenv("SPARK_RESPONSE_TIMEOUT", "60"))  # 两个响应块之间的最长等待（秒）
+    SPARK_CLIENT = os.getenv("SPARK_CLIENT", "async")                          # 客户端实现: async/thread
+    SPARK_MAX_CONCURRENCY = int(os.getenv("SPARK_MAX_CONCURRENCY", "32"))      # 同时进行的生成数上限
+    SPARK_PREWARM_CONNECTIONS = int(os.getenv("SPARK_PREWARM_CONNECTIONS", "2"))  # 预先建立的连接数，0 关闭
+    SPARK_IDLE_TTL = float(os.getenv("SPARK_IDLE_TTL", "30"))                  # 预热连接最长空闲时间（秒）
+    SPARK_URL_TTL = float(os.getenv("SPARK_URL_TTL", "240"))                   # 鉴权 URL 复用时间（秒，需小于 300）
+
+    # 语义答案缓存（/ask）
+    ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "True").lower() == "true"
+    ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.98"))  # 查询向量余弦相似度阈值
+    ANSWER_CACHE_MAX_EDITS = int(os.getenv("ANSWER_CACHE_MAX_EDITS", "1"))       # 规范化查询文本最大编辑距离
+    ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "600"))               # 过期时间（秒）
+    ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))              # 最大条目数
+    ANSWER_CACHE_SOURCE_KEY = os.getenv("ANSWER_CACHE_SOURCE_KEY", "filterKeyForDel")  # 来源标识字段
+
+    # 上下文组装（/ask、/ask-stream）
+    CONTEXT_PACKING_ENABLED = os.getenv("CONTEXT_PACKING_ENABLED", "True").lower() == "true"
+    CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))           # 上下文 token 预算（估算值）
+    CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.9"))    # 近似重复的字符二元组 Jaccard 阈值
+    CONTEXT_MIN_OVERLAP = int(os.getenv("CONTEXT_MIN_OVERLAP", "20"))               # 判定相邻块首尾重叠的最少字符数
+    CONTEXT_SOURCE_KEY = os.getenv("CONTEXT_SOURCE_KEY", "filterKeyForDel")         # 标识同一来源文档的 metadata 字段
 
     # 向量数据库配置
     EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "BAAI/bge-small-zh-v1.5")
     VECTOR_DIR = os.getenv("VECTOR_DIR", "./comment_vectors")
 
+    # 嵌入服务配置（进程内共享 + 动态微批）
+    EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))        # 单次前向最多合并的文本数
+    EMBEDDING_MAX_WAIT_MS = float(os.getenv("EMBEDDING_MAX_WAIT_MS", "5"))     # 合并并发请求的最长等待（毫秒）
+    QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))              # 查询向量缓存条数，0 关闭
+    QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "3600"))              # 查询向量缓存过期时间（秒），0 不过期
+    EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "True").lower() == "true"  # 入库向量持久化缓存
+    EMBEDDING_CACHE_DIR = os.getenv(
+        "EMBEDDING_CACHE_DIR",
+        os.path.join(os.path.dirname(os.path.normpath(VECTOR_DIR)) or ".", "embedding_cache")
+    )                                                                          # 默认与 VECTOR_DIR 同级
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "500000"))  # 向量缓存最大条目数，0 不限
+    EMBEDDING_CACHE_MAX_AGE_DAYS = float(os.getenv("EMBEDDING_CACHE_MAX_AGE_DAYS", "30"))  # 超过该天数未使用的条目删除，0 不限
+
+    # 精确暴力检索（强过滤/小库）
+    FLAT_SEARCH_ENABLED = os.getenv("FLAT_SEARCH_ENABLED", "True").lower() == "true"
+    FLAT_SEARCH_THRESHOLD = int(os.getenv("FLAT_SEARCH_THRESHOLD", "2000"))   # 候选数低于该值时使用暴力检索
+    FLAT_PARTITION_KEY = os.getenv("FLAT_PARTITION_KEY", "filterKey")        # 按该 metadata 字段分区
+    FLAT_MAX_PARTITIONS = int(os.getenv("FLAT_MAX_PARTITIONS", "256"))       # 最多缓存的分区数
+    FLAT_CACHE_TTL = float(os.getenv("FLAT_CACHE_TTL", "10"))                # 分区缓存向 Chroma 校验的间隔（秒），0 每次校验
+    FLAT_CACHE_MAX_AGE = float(os.getenv("FLAT_CACHE_MAX_AGE", "300"))       # 分区最长使用时间（秒），超过后重建，0 不限
+    FLAT_INDEX_DIR = os.getenv(
+        "FLAT_INDEX_DIR",
+        os.path.join(os.path.dirname(os.path.normpath(VECTOR_DIR)) or ".", "flat_index")
+    )                                                                          # 分区矩阵文件目录（缓存）
+
+    # 集合分片
+    SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))               # 分片数，1 表示单集合 "comment"
+    SHARD_STRATEGY = os.getenv("SHARD_STRATEGY", "key")            # 路由策略: key（按 metadata 字段）/hash（按文档 ID）
+    SHARD_KEY = os.getenv("SHARD_KEY", "filterKey")                # key 策略使用的 metadata 字段
+
+    UPSERT_LOCK_DIR = os.getenv(
+        "UPSERT_LOCK_DIR",
+        os.path.join(os.path.dirname(os.path.normpath(VECTOR_DIR)) or ".", "upsert_locks")
+    )                                                                          # upsert 跨进程文件锁目录（本机多 worker 共用）
+
+    DELETE_CHUNK_SIZE = int(os.getenv("DELETE_CHUNK_SIZE", "500"))            # 删除时每批的块数/键数
+
+    # 关键词索引（BM25，混合检索）
+    LEXICAL_INDEX_ENABLED = os.getenv("LEXICAL_INDEX_ENABLED", "True").lower() == "true"
+    LEXICAL_INDEX_DIR = os.getenv(
+        "LEXICAL_INDEX_DIR",
+        os.path.join(os.path.dirname(os.path.normpath(VECTOR_DIR)) or ".", "lexical_index")
+    )                                                                          # 默认与 VECTOR_DIR 同级
+    LEXICAL_MERGE_FACTOR = int(os.getenv("LEXICAL_MERGE_FACTOR", "8"))         # 同层段数达到该值时合并
+    HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))                        # RRF 融合常数 k
+
+    CHROMA_MODE = os.getenv("CHROMA_MODE", "local")            # local: 嵌入式（VECTOR_DIR）；http: 连接 Chroma 服务
     CHROMA_HOST = os.getenv("CHROMA_HOST", "localhost")
     CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
     CHROMA_USE_HTTPS = os.getenv("CHROMA_USE_HTTPS", "False").lower() == "true"
-    CHROMA_AUTH = os.getenv("CHROMA_AUTH", "")
+    CHROMA_AUTH = os.getenv("CHROMA_AUTH", "")                 # Bearer token，或 user:password（Basic）
+    CHROMA_POOL_SIZE = int(os.getenv("CHROMA_POOL_SIZE", "32"))             # HTTP 连接池大小
+    CHROMA_KEEPALIVE = float(os.getenv("CHROMA_KEEPALIVE", "40"))           # 空闲连接保活时间（秒）
+    CHROMA_TIMEOUT = float(os.getenv("CHROMA_TIMEOUT", "30"))               # 请求超时（秒）
+    CHROMA_CONNECT_TIMEOUT = float(os.getenv("CHROMA_CONNECT_TIMEOUT", "5"))  # 建立连接超时（秒）
+    CHROMA_RETRIES = int(os.getenv("CHROMA_RETRIES", "3"))                  # 连接失败/5xx 时的重试次数
+    CHROMA_RETRY_BACKOFF = float(os.getenv("CHROMA_RETRY_BACKOFF", "0.2"))  # 首次重试等待（秒），指数退避
 
     # 文本分块配置
     CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "500"))           # 每块最大字符数（约 250 汉字）
     CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "100"))     # 块之间的重叠字符数
     CHUNK_STRATEGY = os.getenv("CHUNK_STRATEGY", "char")       # 分块策略: char/semantic/hybrid
     MIN_CHUNK_LENGTH = int(os.getenv("MIN_CHUNK_LENGTH", "300"))  # 低于此长度不分块
+    SEMANTIC_POOL_VECTORS = os.getenv("SEMANTIC_POOL_VECTORS", "True").lower() == "true"  # 语义分块的多句块直接用句向量池化作为块向量（False 时入库重新向量化）
+
+    # 异步入库配置
+    INGEST_ASYNC = os.getenv("INGEST_ASYNC", "False").lower() == "true"   # /add 默认是否异步入库
+    INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))               # 后台入库线程数
+    INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "32"))        # 每批最多合并的任务数
+    INGEST_MAX_WAIT_MS = float(os.getenv("INGEST_MAX_WAIT_MS", "50"))    # 凑批最长等待（毫秒）
+    INGEST_JOB_HISTORY = int(os.getenv("INGEST_JOB_HISTORY", "10000"))   # 保留的任务记录条数
+
+    # 批量入库配置（/add_batch）
+    BULK_SPLIT_WORKERS = int(os.getenv("BULK_SPLIT_WORKERS", "0"))       # 分块线程数，0 表示 CPU 核数
+    BULK_SLICE_SIZE = int(os.getenv("BULK_SLICE_SIZE", "256"))           # 每次向量化/写入的 chunk 数
+    STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "64"))        # 流式入库每批解析的文档数
+    STREAM_PROGRESS_INTERVAL = float(os.getenv("STREAM_PROGRESS_INTERVAL", "5"))  # 进度输出间隔（秒）
     
     # Reranker 配置
     RERANKER_MODEL = os.getenv("RERANKER_MODEL", "BAAI/bge-reranker-v2-m3")
     RERANKER_USE_FP16 = os.getenv("RERANKER_USE_FP16", "True").lower() == "true"
+    RERANKER_MAX_BATCH = int(os.getenv("RERANKER_MAX_BATCH", "64"))          # 单次前向最多合并的 pair 数
+    RERANKER_MAX_WAIT_MS = float(os.getenv("RERANKER_MAX_WAIT_MS", "10"))    # 合并并发请求的最长等待（毫秒）
+    RERANKER_MAX_LENGTH = int(os.getenv("RERANKER_MAX_LENGTH", "512"))       # 单个 pair 最大 token 数（超出截断文档）
+    RERANKER_BUCKET_SIZE = int(os.getenv("RERANKER_BUCKET_SIZE", "16"))      # 按长度分桶后每桶的 pair 数
+    RERANKER_CACHE_MAX_MB = float(os.getenv("RERANKER_CACHE_MAX_MB", "64"))  # 分数缓存内存上限（MB），0 关闭
+    RERANKER_CASCADE_MODEL = os.getenv("RERANKER_CASCADE_MODEL", "")         # 级联初筛模型（如 BAAI/bge-reranker-base），空为关闭
+    RERANKER_CASCADE_DEPTH = int(os.getenv("RERANKER_CASCADE_DEPTH", "20"))  # 级联模式下交给主模型的候选数
+    RERANK_FETCH_FACTOR = int(os.getenv("RERANK_FETCH_FACTOR", "4"))         # 两阶段检索召回放大倍数
 
     # Nacos配置
     NACOS_SERVER_ADDR = os.getenv("NACOS_SERVER_ADDR", "127.0.0.1:8848")
@@ -44,4 +141,10 @@ class Config:
     SERVICE_WEIGHT = float(os.getenv("SERVICE_WEIGHT", "1.0"))
     SERVICE_CLUSTER = os.getenv("SERVICE_CLUSTER", "DEFAULT")
     SERVICE_GROUP = os.getenv("SERVICE_GROUP", "DEFAULT_GROUP")
-    SERVICE_EPHEMERAL = os.getenv("SERVICE_EPHEMERAL", "True").lower() == "true"
\ No newline at end of file
+    SERVICE_EPHEMERAL = os.getenv("SERVICE_EPHEMERAL", "True").lower() == "true"
+
+    # 多进程服务（serve.py）
+    SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", "0"))                      # worker 进程数，0 表示 CPU 核数
+    SERVE_THREADS_PER_WORKER = int(os.getenv("SERVE_THREADS_PER_WORKER", "0"))  # 每个 worker 的 torch 计算线程数，0 表示核数 / worker 数
+    SERVE_PIN_CPUS = os.getenv("SERVE_PIN_CPUS", "True").lower() == "true"    # 是否把每个 worker 绑定到固定的 CPU 核
+    SERVE_PRELOAD_RERANKER = os.getenv("SERVE_PRELOAD_RERANKER", "True").lower() == "true"  # fork 前是否预加载 Reranker
\ No newline at end of file
@@ -0,0 +1,284 @@
+"""
+上下文组装
+/ask、/ask-stream 拼接提示词前的处理：相邻块之间有 CHUNK_OVERLAP 的重叠，直接拼接会重复大量文本。
+
+1. 同一来源的块按重叠/相邻关系合并为连续片段（重叠部分只保留一份）
+2. 去掉被包含或近似重复（字符二元组 Jaccard 相似度达到阈值）的块
+3. 按相关性顺序装入 token 预算，返回上下文及节省的 token 数
+"""
+import logging
+import math
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# 检索阶段写入 metadata 的分数字段，不参与来源判断
+_SCORE_KEYS = ("score", "vector_score", "bm25_score")
+
+# token 估算：汉字（含日韩）每字 1 个，字母数字串每 4 个字符 1 个，其余非空白字符每个 1 个
+_TOKEN_RE = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]|[A-Za-z0-9]+|\S")
+
+
+def _cost(piece: str) -> int:
+    """单个匹配片段的 token 数"""
+    return math.ceil(len(piece) / 4) if piece[0].isascii() and piece[0].isalnum() else 1
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数（无需加载分词器）"""
+    return sum(_cost(match.group()) for match in _TOKEN_RE.finditer(text))
+
+
+def _bigrams(text: str) -> set:
+    """去掉空白后的字符二元组集合（近似重复判断用）"""
+    compact = "".join(text.split())
+    return {compact[i:i + 2] for i in range(len(compact) - 1)} or {compact}
+
+
+class _Block:
+    """合并后的连续片段"""
+
+    __slots__ = ("source", "text", "score", "rank", "chunk_index", "members")
+
+    def __init__(self, source, text: str, score: float, rank: int, chunk_index: Optional[int]):
+        self.source = source
+        self.text = text
+        self.score = score
+        self.rank = rank                # 最相关成员在检索结果中的名次
+        self.chunk_index = chunk_index  # 最后一个成员的块序号（upsert 写入的 chunk_index）
+        self.members = 1
+
+
+class ContextPacker:
+    """
+    上下文组装器
+
+    - 来源：metadata 中的 doc_key（/upsert 写入）或 CONTEXT_SOURCE_KEY 字段；都没有时
+      metadata 完全相同的块视为同一来源（同一次 /add 切出的块 metadata 相同）
+    - 合并：同一来源中，一块的结尾与另一块的开头重叠至少 min_overlap 个字符，
+      或 chunk_index 相邻，则拼接为一个片段；被另一块完整包含的块直接丢弃
+    - 去重：片段之间二元组 Jaccard 相似度 >= dedup_threshold 时只保留更相关的一个
+    - 装箱：片段按最相关成员的名次排序，依次装入 token 预算，装不下的跳过；
+      第一个片段就超出预算时截断
+    """
+
+    def __init__(self, token_budget: int = None, dedup_threshold: float = None,
+                 min_overlap: int = None, source_key: str = None):
+        """
+        初始化组装器
+
+        Args:
+            token_budget: 上下文 token 预算
+            dedup_threshold: 近似重复的 Jaccard 相似度阈值
+            min_overlap: 判定首尾重叠的最少字符数
+            source_key: 标识来源的 metadata 字段
+        """
+        self.token_budget = token_budget or Config.CONTEXT_TOKEN_BUDGET
+        self.dedup_threshold = dedup_threshold if dedup_threshold is not None else Config.CONTEXT_DEDUP_THRESHOLD
+        self.min_overlap = min_overlap or Config.CONTEXT_MIN_OVERLAP
+        self.source_key = source_key or Config.CONTEXT_SOURCE_KEY
+
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._tokens_before = 0
+        self._tokens_after = 0
+
+    def _source_of(self, doc: Document):
+        """块的来源标识"""
+        metadata = doc.metadata or {}
+        if metadata.get("doc_key") is not None:
+            return "doc_key", metadata["doc_key"]
+        if metadata.get(self.source_key) is not None:
+            return self.source_key, metadata[self.source_key]
+        return tuple(sorted(
+            (key, str(value)) for key, value in metadata.items()
+            if key not in _SCORE_KEYS and key not in ("chunk_index", "content_hash")
+        ))
+
+    def _overlap(self, head: str, tail: str) -> int:
+        """head 的结尾与 tail 的开头重叠的字符数（不足 min_overlap 时为 0）"""
+        if len(head) < self.min_overlap or len(tail) < self.min_overlap:
+            return 0
+        probe = tail[:self.min_overlap]
+        position = head.find(probe, max(0, len(head) - len(tail)))
+        while position >= 0:
+            if tail.startswith(head[position:]):
+                return len(head) - position
+            position = head.find(probe, position + 1)
+        return 0
+
+    def _join(self, block: _Block, other: _Block) -> bool:
+        """尝试把 other 并入 block（两者同源），成功返回 True"""
+        if other.text in block.text:
+            joined = block.text
+        elif block.text in other.text:
+            joined = other.text
+        else:
+            adjacent = block.chunk_index is not None and other.chunk_index is not None
+            overlap = self._overlap(block.text, other.text)
+            if overlap or (adjacent and other.chunk_index == block.chunk_index + 1):
+                joined = block.text + other.text[overlap:]
+                block.chunk_index = other.chunk_index
+            else:
+                overlap = self._overlap(other.text, block.text)
+                if not overlap and not (adjacent and block.chunk_index == other.chunk_index + 1):
+                    return False
+                joined = other.text + block.text[overlap:]
+        block.text = joined
+        block.score = max(block.score, other.score)
+        block.rank = min(block.rank, other.rank)
+        block.members += other.members
+        return True
+
+    def _merge(self, results: List[Tuple[Document, float]]) -> List[_Block]:
+        """同源块合并，直到没有可合并的块"""
+        groups: Dict[object, List[_Block]] = {}
+        for rank, (doc, score) in enumerate(results):
+            chunk_index = (doc.metadata or {}).get("chunk_index")
+            block = _Block(self._source_of(doc), doc.page_content.strip(), score, rank,
+                           chunk_index if isinstance(chunk_index, int) else None)
+            if block.text:
+                groups.setdefault(block.source, []).append(block)
+
+        blocks = []
+        for group in groups.values():
+            merged = True
+            while merged and len(group) > 1:
+                merged = False
+                for i in range(len(group)):
+                    for j in range(i + 1, len(group)):
+                        if self._join(group[i], group[j]):
+                            del group[j]
+                            merged = True
+                            break
+                    if merged:
+                        break
+            blocks.extend(group)
+        blocks.sort(key=lambda block: block.rank)
+        return blocks
+
+    def _dedup(self, blocks: List[_Block]) -> List[_Block]:
+        """跨来源去掉被包含或近似重复的片段（保留名次靠前的）"""
+        kept, signatures = [], []
+        for block in blocks:
+            bigrams = _bigrams(block.text)
+            duplicate = False
+            for other, other_bigrams in zip(kept, signatures):
+                if block.text in other.text:
+                    duplicate = True
+                elif len(bigrams & other_bigrams) / len(bigrams | other_bigrams) >= self.dedup_threshold:
+                    duplicate = True
+                if duplicate:
+                    other.members += block.members
+                    break
+            if not duplicate:
+                kept.append(block)
+                signatures.append(bigrams)
+        return kept
+
+    def _truncate(self, text: str, budget: int) -> str:
+        """截断到不超过 budget 个 token"""
+        tokens = 0
+        for match in _TOKEN_RE.finditer(text):
+            tokens += _cost(match.group())
+            if tokens > budget:
+                return text[:match.start()].rstrip()
+        return text
+
+    def pack(self, results: List[Tuple[Document, float]], token_budget: int = None) -> Tuple[str, Dict]:
+        """
+        组装上下文
+
+        Args:
+            results: 检索结果 [(文档, 分数)]，按相关性降序
+            token_budget: 本次的 token 预算，默认使用初始化时的预算
+
+        Returns:
+            (上下文文本, 统计)，统计包含 chunks / blocks / merged / duplicates / dropped /
+            tokens_before（原始逐块拼接）/ tokens_after / tokens_saved
+        """
+        budget = token_budget or self.token_budget
+        tokens_before = estimate_tokens("\n".join(doc.page_content for doc, _ in results))
+
+        merged = self._merge(results)
+        blocks = self._dedup(merged)
+
+        packed, used, dropped = [], 0, 0
+        for block in blocks:
+            tokens = estimate_tokens(block.text)
+            if used + tokens <= budget:
+                packed.append(block.text)
+                used += tokens
+            elif not packed:
+                packed.append(self._truncate(block.text, budget))
+                used = estimate_tokens(packed[0])
+            else:
+                dropped += 1
+
+        context = "\n".join(packed)
+        tokens_after = estimate_tokens(context)
+        stats = {
+            "chunks": len(results),
+            "blocks": len(packed),
+            "merged": len(results) - len(merged),
+            "duplicates": len(merged) - len(blocks),
+            "dropped": dropped,
+            "tokens_before": tokens_before,
+            "tokens_after": tokens_after,
+            "tokens_saved": tokens_before - tokens_after,
+        }
+        with self._lock:
+            self._requests += 1
+            self._tokens_before += tokens_before
+            self._tokens_after += tokens_after
+        logger.debug(f"上下文组装: {stats}")
+        return context, stats
+
+    def stats(self) -> Dict:
+        """返回累计统计"""
+        with self._lock:
+            before, after = self._tokens_before, self._tokens_after
+            return {
+                "token_budget": self.token_budget,
+                "requests": self._requests,
+                "tokens_before": before,
+                "tokens_after": after,
+                "tokens_saved": before - after,
+                "saved_ratio": round((before - after) / before, 4) if before else 0.0,
+            }
+
+
+# 全局单例
+_context_packer: Optional[ContextPacker] = None
+_context_packer_lock = threading.Lock()
+
+
+def get_context_packer() -> Optional[ContextPacker]:
+    """获取上下文组装器单例（CONTEXT_PACKING_ENABLED=False 时返回 None，按原方式逐块拼接）"""
+    global _context_packer
+    if not Config.CONTEXT_PACKING_ENABLED:
+        return None
+    if _context_packer is None:
+        with _context_packer_lock:
+            if _context_packer is None:
+                _context_packer = ContextPacker()
+    return _context_packer
+
+
+def pack_context(results: List[Tuple[Document, float]]) -> Tuple[str, Optional[Dict]]:
+    """
+    组装提示词上下文
+
+    Returns:
+        (上下文文本, 组装统计)；未启用上下文组装时逐块拼接，统计为 None
+    """
+    packer = get_context_packer()
+    if packer is None:
+        return "\n".join(doc.page_content for doc, _ in results), None
+    return packer.pack(results)
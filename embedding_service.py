@@ -0,0 +1,147 @@
+"""
+嵌入向量服务
+进程内共享的嵌入模型，VectorStore 与语义分块器共用同一份模型权重，
+并发的 /add、/search 与语义分块请求通过动态微批合并成一次前向计算
+"""
+import logging
+import re
+import threading
+import unicodedata
+from typing import List, Optional, Dict
+
+from langchain_core.embeddings import Embeddings
+
+from batching import MicroBatcher
+from cache import DiskEmbeddingCache, LRUCache
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingService(Embeddings):
+    """
+    共享嵌入服务
+
+    实现 langchain Embeddings 接口，可直接作为 Chroma 的 embedding_function。
+    所有调用都经过 MicroBatcher：后台线程把短时间内到达的文本合并成一批再送入模型。
+    查询向量额外经过 LRU 缓存（键为规范化查询文本 + 模型名），热门查询无需重复计算；
+    文档向量经过磁盘缓存（键为文本内容哈希 + 模型名），重复入库的相同内容直接复用。
+    """
+
+    def __init__(self, model_name: str = None, max_batch_size: int = None,
+                 max_wait_ms: float = None):
+        """
+        初始化嵌入服务
+
+        Args:
+            model_name: 嵌入模型名称，默认使用 Config.EMBEDDING_MODEL
+            max_batch_size: 单次前向最多合并的文本条数
+            max_wait_ms: 合并请求的最长等待时间（毫秒）
+        """
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        self.model_name = model_name or Config.EMBEDDING_MODEL
+        batch_size = max_batch_size or Config.EMBEDDING_BATCH_SIZE
+        wait_ms = max_wait_ms if max_wait_ms is not None else Config.EMBEDDING_MAX_WAIT_MS
+
+        logger.info(f"加载嵌入模型: {self.model_name}")
+        self._model = HuggingFaceEmbeddings(
+            model_name=self.model_name,
+            encode_kwargs={"batch_size": batch_size}
+        )
+        self._batcher = MicroBatcher(
+            handler=self._model.embed_documents,
+            max_batch_size=batch_size,
+            max_wait_ms=wait_ms,
+            name="embedding"
+        )
+        self._query_cache = LRUCache(
+            max_size=Config.QUERY_CACHE_SIZE,
+            ttl=Config.QUERY_CACHE_TTL
+        ) if Config.QUERY_CACHE_SIZE > 0 else None
+        self._doc_cache = DiskEmbeddingCache(
+            Config.EMBEDDING_CACHE_DIR,
+            max_entries=Config.EMBEDDING_CACHE_MAX_ENTRIES,
+            max_age=Config.EMBEDDING_CACHE_MAX_AGE_DAYS * 86400
+        ) if Config.EMBEDDING_CACHE_ENABLED else None
+        logger.info("嵌入模型加载完成")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """批量计算文档向量（已缓存的内容跳过模型计算）"""
+        texts = list(texts)
+        if self._doc_cache is None or not texts:
+            return self._batcher.submit(texts)
+
+        keys = [DiskEmbeddingCache.make_key(self.model_name, text) for text in texts]
+        try:
+            cached = self._doc_cache.get_many(keys)
+        except Exception as e:
+            logger.warning(f"读取向量缓存失败，直接计算: {e}")
+            return self._batcher.submit(texts)
+
+        # 只计算未命中的文本（同一批内的重复文本只算一次）
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self._batcher.submit(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            cached.update(computed)
+            try:
+                self._doc_cache.put_many(list(computed.items()))
+            except Exception as e:
+                logger.warning(f"写入向量缓存失败: {e}")
+
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        计算查询向量（优先读取查询缓存）
+
+        模型输入与缓存键都是规范化后的查询文本：只差大小写/空白的查询得到同一个向量，
+        与到达顺序、缓存是否开启无关
+        """
+        normalized = normalize_query(text)
+        if self._query_cache is None:
+            return self._batcher.submit([normalized])[0]
+
+        key = (self.model_name, normalized)
+        vector = self._query_cache.get(key)
+        if vector is None:
+            vector = self._batcher.submit([normalized])[0]
+            self._query_cache.put(key, vector)
+        return list(vector)
+
+    def stats(self) -> Dict:
+        """返回嵌入服务统计（批大小、延迟、缓存命中率）"""
+        return {
+            "model": self.model_name,
+            "batching": self._batcher.stats(),
+            "query_cache": self._query_cache.stats() if self._query_cache else None,
+            "document_cache": self._doc_cache.stats() if self._doc_cache else None,
+        }
+
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """规范化查询文本：全半角统一、去首尾空白、合并连续空白、转小写"""
+    text = unicodedata.normalize("NFKC", text)
+    return _WHITESPACE_RE.sub(" ", text).strip().lower()
+
+
+# 全局单例
+_embedding_service: Optional[EmbeddingService] = None
+_embedding_lock = threading.Lock()
+
+
+def get_embedding_service() -> EmbeddingService:
+    """获取嵌入服务单例"""
+    global _embedding_service
+    if _embedding_service is None:
+        with _embedding_lock:
+            if _embedding_service is None:
+                _embedding_service = EmbeddingService()
+    return _embedding_service
@@ -0,0 +1,413 @@
+"""
+精确暴力检索（Flat）
+单个 filterKey 之类的强过滤查询只涉及几百个向量，带 where 的 HNSW 检索既慢又可能漏召回；
+候选数低于阈值时改为对该分区的全部向量做一次矩阵-向量乘积，结果精确。
+
+每个 metadata 分区（FLAT_PARTITION_KEY 的一个取值；整个库很小时为全库）的向量
+连续存为 float32 矩阵文件并以 mmap 方式加载。分区按需从 Chroma 构建，
+本进程的数据变更由 vector_store 变更监听器使其失效；其他进程（多 worker / 多实例共用 Chroma 服务）
+的变更监听不到，分区缓存超过 FLAT_CACHE_TTL 后校验一次：先比较本机共享的变更版本号（任一进程写入时递增），
+再向 Chroma 只取该分区的 ID 比较，有变化则重建；超过 FLAT_CACHE_MAX_AGE 的分区无条件重建
+（兜底其他机器对同一 ID 的覆盖写入）。
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，只支持单进程，不需要跨进程版本号
+    fcntl = None
+
+from config import Config
+from embedding_service import get_embedding_service
+from vector_store import VectorStore, add_change_listener
+
+logger = logging.getLogger(__name__)
+
+# 全库分区的标识（无过滤且全库文档数低于阈值时使用）
+_ALL = ()
+
+# 本机共享的变更版本号文件（FLAT_INDEX_DIR 下，8 字节计数）
+_GENERATION_FILE = ".generation"
+
+
+def _pid_alive(pid: int) -> bool:
+    """进程是否存在"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _remove(path: str):
+    """删除文件或目录（不存在时忽略）"""
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_process_files(pid: int):
+    """删除已退出进程的分区矩阵文件（serve.py 在 worker 退出后调用）"""
+    shutil.rmtree(os.path.join(Config.FLAT_INDEX_DIR, str(pid)), ignore_errors=True)
+
+
+class _Partition:
+    """一个分区：mmap 的向量矩阵 + 文档内容"""
+
+    __slots__ = ("matrix", "norms", "ids", "documents", "metadatas", "nbytes", "checked_at", "built_at", "stamp")
+
+    def __init__(self, matrix: np.ndarray, ids: List[str], documents: List[str], metadatas: List[dict],
+                 stamp: int = 0):
+        self.matrix = matrix
+        self.norms = np.einsum("ij,ij->i", matrix, matrix) if len(ids) else np.zeros(0, dtype=np.float32)
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.nbytes = matrix.nbytes
+        self.checked_at = time.monotonic()  # 最近一次与 Chroma 确认一致的时间
+        self.built_at = self.checked_at
+        self.stamp = stamp  # 构建前读取的本机变更版本号
+
+    def search(self, query: np.ndarray, query_norm: float, k: int) -> List[Tuple[float, int]]:
+        """一次矩阵-向量乘积 + argpartition，返回 [(平方 L2 距离, 行号)]（与 Chroma l2 空间一致）"""
+        if not self.ids:
+            return []
+        distances = self.norms + query_norm - 2.0 * (self.matrix @ query)
+        if len(distances) > k:
+            rows = np.argpartition(distances, k)[:k]
+        else:
+            rows = np.arange(len(distances))
+        return [(max(0.0, float(distances[row])), int(row)) for row in rows]
+
+
+class FlatIndex:
+    """
+    分区暴力检索引擎
+
+    - 分区键 FLAT_PARTITION_KEY 的等值 / $in 过滤：命中的每个分区文档数都低于阈值时走暴力检索
+    - 无过滤：全库文档数低于阈值时走暴力检索
+    - 其他过滤条件（含其他字段）不适用，返回 None 由调用方走 HNSW
+    """
+
+    def __init__(self, directory: str = None, partition_key: str = None,
+                 threshold: int = None, max_partitions: int = None, ttl: float = None,
+                 max_age: float = None):
+        """
+        初始化引擎
+
+        Args:
+            directory: 分区矩阵文件目录（进程内缓存，每个进程一个子目录，启动时清理）
+            partition_key: 分区使用的 metadata 字段
+            threshold: 候选数上限，超过时不使用暴力检索
+            max_partitions: 最多保留的分区数，超出按 LRU 淘汰
+            ttl: 分区缓存向 Chroma 校验的间隔（秒），0 表示每次查询都校验
+            max_age: 分区最长使用时间（秒），超过后无条件重建，0 表示不限
+        """
+        self.directory = directory or Config.FLAT_INDEX_DIR
+        self.partition_key = partition_key or Config.FLAT_PARTITION_KEY
+        self.threshold = threshold or Config.FLAT_SEARCH_THRESHOLD
+        self.max_partitions = max_partitions or Config.FLAT_MAX_PARTITIONS
+        self.ttl = ttl if ttl is not None else Config.FLAT_CACHE_TTL
+        self.max_age = max_age if max_age is not None else Config.FLAT_CACHE_MAX_AGE
+
+        self._partitions: "OrderedDict[tuple, _Partition]" = OrderedDict()
+        self._oversized: Dict[tuple, Tuple[int, float]] = {}  # 已知超过阈值的分区 -> (文档数, 统计时间)
+        self._owners: Dict[str, tuple] = {}      # 文档 ID -> 所在分区（删除事件只带 ID）
+        self._generations: Dict[tuple, int] = {}  # 分区版本号，构建期间发生变更则放弃缓存
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._flat_queries = 0
+        self._fallbacks = 0
+        self._builds = 0
+        self._validations = 0
+        self._stale = 0
+
+        # 分区文件是可随时重建的缓存，启动时清理本进程与已退出进程的子目录，
+        # 不能清空整个目录：其他 worker 可能正在写入自己的子目录；版本号文件保留（重置会与旧版本号重复）
+        os.makedirs(self.directory, exist_ok=True)
+        self._generation_path = os.path.join(self.directory, _GENERATION_FILE)
+        for name in os.listdir(self.directory):
+            if name == _GENERATION_FILE:
+                continue
+            if not name.isdigit() or int(name) == os.getpid() or not _pid_alive(int(name)):
+                _remove(os.path.join(self.directory, name))
+
+    # ---------- 跨进程变更版本号 ----------
+
+    def _stamp(self) -> int:
+        """读取本机共享的变更版本号（不存在或不支持时为 0）"""
+        if fcntl is None:
+            return 0
+        try:
+            with open(self._generation_path, "rb") as f:
+                return int.from_bytes(f.read(8), "little")
+        except FileNotFoundError:
+            return 0
+
+    def _bump(self) -> Tuple[int, int]:
+        """版本号加 1（文件锁内读改写），返回 (旧值, 新值)"""
+        if fcntl is None:
+            return 0, 0
+        with open(self._generation_path, "a+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            old = int.from_bytes(f.read(8), "little")
+            f.truncate(0)
+            f.write((old + 1).to_bytes(8, "little"))
+            f.flush()
+        return old, old + 1
+
+    # ---------- 分区 ----------
+
+    def _partitions_for(self, filter: dict = None) -> Optional[List[tuple]]:
+        """解析过滤条件，返回涉及的分区；不适用暴力检索时返回 None"""
+        if not filter:
+            return [_ALL]
+        if len(filter) != 1 or self.partition_key not in filter:
+            return None
+        condition = filter[self.partition_key]
+        if not isinstance(condition, dict):
+            return [(condition,)]
+        if set(condition) == {"$eq"}:
+            return [(condition["$eq"],)]
+        if set(condition) == {"$in"} and isinstance(condition["$in"], list):
+            return [(value,) for value in dict.fromkeys(condition["$in"])]
+        return None
+
+    def _where(self, partition: tuple) -> Optional[dict]:
+        return None if partition == _ALL else {self.partition_key: partition[0]}
+
+    def _path(self, partition: tuple) -> str:
+        """分区矩阵文件路径（按进程分目录，多 worker 各自构建，互不覆盖）"""
+        digest = hashlib.sha1(json.dumps(partition, ensure_ascii=False).encode("utf-8")).hexdigest()
+        directory = os.path.join(self.directory, str(os.getpid()))
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, digest)
+
+    def _estimate(self, partition: tuple) -> int:
+        """
+        分区文档数（已加载的分区直接返回，否则只查询 ID）
+
+        只需判断是否超过阈值：过滤分区最多取 threshold + 1 个 ID，大分区不会整体扫描
+        """
+        with self._lock:
+            if partition in self._partitions:
+                return len(self._partitions[partition].ids)
+            if partition in self._oversized:
+                count, counted_at = self._oversized[partition]
+                if time.monotonic() - counted_at < self.ttl:
+                    return count
+                del self._oversized[partition]
+        store = VectorStore()
+        if partition == _ALL:
+            count = store.count()
+        else:
+            count = len(store.get(where=self._where(partition), limit=self.threshold + 1)["ids"])
+        if count > self.threshold:
+            with self._lock:
+                self._oversized[partition] = (count, time.monotonic())
+        return count
+
+    def _unchanged(self, partition: tuple, cached: _Partition) -> bool:
+        """
+        分区缓存是否仍然有效
+
+        本机其他进程写入过（版本号变化）时直接重建；否则只向 Chroma 取 ID 比较，
+        发现其他机器的新增与删除
+        """
+        if self._stamp() != cached.stamp:
+            return False
+        if self.max_age and time.monotonic() - cached.built_at >= self.max_age:
+            return False
+        return VectorStore().get(where=self._where(partition), include=[])["ids"] == cached.ids
+
+    def _load(self, partition: tuple) -> _Partition:
+        """
+        获取分区（未加载时从 Chroma 拉取向量，写成矩阵文件后 mmap 加载）
+
+        缓存超过 ttl 时由一个查询向 Chroma 校验，校验期间其他查询继续使用缓存；不一致则重建
+        """
+        with self._lock:
+            cached = self._partitions.get(partition)
+            if cached is not None:
+                self._partitions.move_to_end(partition)
+                now = time.monotonic()
+                if now - cached.checked_at < self.ttl:
+                    return cached
+                cached.checked_at = now
+            generation = self._generations.get(partition, 0)
+
+        if cached is not None:
+            unchanged = self._unchanged(partition, cached)
+            with self._lock:
+                self._validations += 1
+                if unchanged:
+                    return cached
+                self._stale += 1
+                if self._partitions.get(partition) is cached:
+                    self._drop(partition)
+                generation = self._generations.get(partition, 0)
+            logger.debug(f"暴力检索分区 {partition} 已被其他进程修改，重建")
+
+        with self._build_lock:
+            stamp = self._stamp()
+            page = VectorStore().get(where=self._where(partition),
+                                     include=["embeddings", "documents", "metadatas"])
+            ids = page["ids"]
+            if ids:
+                path = self._path(partition)
+                np.save(f"{path}.tmp.npy", np.ascontiguousarray(page["embeddings"], dtype=np.float32))
+                os.replace(f"{path}.tmp.npy", f"{path}.npy")
+                matrix = np.load(f"{path}.npy", mmap_mode="r")
+            else:
+                matrix = np.zeros((0, 0), dtype=np.float32)
+            loaded = _Partition(matrix, ids, page["documents"], page["metadatas"], stamp)
+
+        with self._lock:
+            self._builds += 1
+            if self._generations.get(partition, 0) != generation:
+                # 构建期间分区有变更，本次结果只用于当前查询，不缓存
+                return loaded
+            self._partitions[partition] = loaded
+            if partition != _ALL:  # 全库分区在任何变更时都会失效，无需记录
+                for doc_id in ids:
+                    self._owners[doc_id] = partition
+            while len(self._partitions) > self.max_partitions:
+                self._drop(next(iter(self._partitions)))
+        return loaded
+
+    def _drop(self, partition: tuple):
+        """移除分区（调用方持有锁）"""
+        self._generations[partition] = self._generations.get(partition, 0) + 1
+        self._oversized.pop(partition, None)
+        removed = self._partitions.pop(partition, None)
+        if removed is None:
+            return
+        for doc_id in removed.ids:
+            if self._owners.get(doc_id) == partition:
+                del self._owners[doc_id]
+        try:
+            # 已 mmap 的进行中查询不受影响，文件删除后映射依然有效
+            os.remove(f"{self._path(partition)}.npy")
+        except FileNotFoundError:
+            pass
+
+    def on_store_change(self, event: str, ids: list, documents: list = None):
+        """
+        向量库变更监听器：使受影响的分区和全库分区失效，并递增本机共享的变更版本号
+
+        本进程未受影响的分区在版本号递增前已是最新（旧值相同），跟进到新值，不必重建；
+        其他进程的分区版本号落后，下次校验时重建
+        """
+        old, new = self._bump()
+        with self._lock:
+            for cached in self._partitions.values():
+                if cached.stamp == old:
+                    cached.stamp = new
+            affected = {_ALL}
+            for doc_id in ids:
+                if doc_id in self._owners:
+                    affected.add(self._owners[doc_id])
+            for doc in documents or []:
+                value = (doc.metadata or {}).get(self.partition_key)
+                if value is not None:
+                    affected.add((value,))
+            for partition in affected:
+                self._drop(partition)
+            if event == "delete":
+                # 删除事件不带 metadata，无法定位未加载的分区，已知超限的分区重新估算
+                self._oversized.clear()
+
+    # ---------- 查询 ----------
+
+    def search(self, query: str, k: int, filter: dict = None,
+               query_vector: list = None) -> Optional[List[Tuple[Document, float]]]:
+        """
+        暴力检索
+
+        Args:
+            query: 查询文本
+            k: 返回条数
+            filter: metadata 过滤条件
+            query_vector: 可选，调用方已计算的查询向量
+
+        Returns:
+            [(文档, 平方 L2 距离)]，按距离升序；不适用（过滤条件不支持或候选数超过阈值）时返回 None
+        """
+        partitions = self._partitions_for(filter)
+        if partitions is None:
+            return None
+        total = 0
+        for partition in partitions:
+            total += self._estimate(partition)
+            if total > self.threshold:
+                with self._lock:
+                    self._fallbacks += 1
+                return None
+
+        if query_vector is None:
+            query_vector = get_embedding_service().embed_query(query)
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        query_norm = float(query_vector @ query_vector)
+        hits = []
+        for partition in partitions:
+            loaded = self._load(partition)
+            for distance, row in loaded.search(query_vector, query_norm, k):
+                doc = Document(id=loaded.ids[row], page_content=loaded.documents[row] or "",
+                               metadata=loaded.metadatas[row] or {})
+                hits.append((doc, distance))
+        with self._lock:
+            self._flat_queries += 1
+        hits.sort(key=lambda x: x[1])
+        return hits[:k]
+
+    def stats(self) -> Dict:
+        """返回引擎统计"""
+        with self._lock:
+            return {
+                "threshold": self.threshold,
+                "partition_key": self.partition_key,
+                "partitions": len(self._partitions),
+                "vectors": sum(len(p.ids) for p in self._partitions.values()),
+                "mapped_bytes": sum(p.nbytes for p in self._partitions.values()),
+                "flat_queries": self._flat_queries,
+                "fallbacks": self._fallbacks,
+                "builds": self._builds,
+                "validations": self._validations,
+                "stale": self._stale,
+            }
+
+
+# 全局单例
+_flat_index: Optional[FlatIndex] = None
+_flat_lock = threading.Lock()
+
+
+def get_flat_index() -> Optional[FlatIndex]:
+    """获取暴力检索引擎单例（FLAT_SEARCH_ENABLED=False 时返回 None）"""
+    global _flat_index
+    if not Config.FLAT_SEARCH_ENABLED:
+        return None
+    if _flat_index is None:
+        with _flat_lock:
+            if _flat_index is None:
+                _flat_index = FlatIndex()
+                add_change_listener(_flat_index.on_store_change)
+    return _flat_index
@@ -0,0 +1,174 @@
+"""
+异步入库队列
+/add 在异步模式下只负责入队并返回 job_id，后台线程批量完成 分块 -> 向量化 -> 写入 Chroma
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from batching import MicroBatcher
+from config import Config
+from vector_store import split_text_with_vectors, store_documents
+
+logger = logging.getLogger(__name__)
+
+
+class IngestJob:
+    """入库任务"""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCESS = "success"
+    FAILED = "failed"
+
+    def __init__(self, text: str, metadata: dict = None):
+        self.id = uuid.uuid4().hex
+        self.text = text
+        self.metadata = metadata or {}
+        self.status = self.QUEUED
+        self.chunks = 0
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "chunks": self.chunks,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestQueue:
+    """
+    异步入库队列
+
+    多个后台线程从队列中成批取出任务：逐条分块后，整批 chunk 一次向量化、
+    一次 add_documents 写入，降低请求线程的阻塞时间和写入次数。
+    """
+
+    def __init__(self, workers: int = None, batch_size: int = None,
+                 max_wait_ms: float = None, history: int = None):
+        """
+        初始化入库队列
+
+        Args:
+            workers: 后台线程数
+            batch_size: 每批最多合并的任务数
+            max_wait_ms: 凑批最长等待时间（毫秒）
+            history: 保留的任务记录条数（超出后淘汰最早的已完成任务）
+        """
+        self.history = history or Config.INGEST_JOB_HISTORY
+        self._jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._batcher = MicroBatcher(
+            handler=self._process_batch,
+            max_batch_size=batch_size or Config.INGEST_BATCH_SIZE,
+            max_wait_ms=max_wait_ms if max_wait_ms is not None else Config.INGEST_MAX_WAIT_MS,
+            name="ingest",
+            workers=workers or Config.INGEST_WORKERS
+        )
+
+    def submit(self, text: str, metadata: dict = None) -> str:
+        """提交入库任务，立即返回 job_id"""
+        job = IngestJob(text, metadata)
+        with self._jobs_lock:
+            self._jobs[job.id] = job
+            self._trim_history()
+        self._batcher.submit_async([job])
+        return job.id
+
+    def _trim_history(self):
+        """淘汰最早的已完成任务记录（调用方持有锁）"""
+        if len(self._jobs) <= self.history:
+            return
+        for job_id in list(self._jobs.keys()):
+            if len(self._jobs) <= self.history:
+                break
+            if self._jobs[job_id].status in (IngestJob.SUCCESS, IngestJob.FAILED):
+                del self._jobs[job_id]
+
+    def get_job(self, job_id: str) -> Optional[Dict]:
+        """查询任务状态"""
+        with self._jobs_lock:
+            job = self._jobs.get(job_id)
+            return job.to_dict() if job else None
+
+    def _process_batch(self, jobs: List[IngestJob]) -> List[IngestJob]:
+        """批处理：逐条分块，整批一次写入"""
+        started = time.time()
+        chunks, vectors = [], []
+        ready = []
+        for job in jobs:
+            job.status = IngestJob.RUNNING
+            job.started_at = started
+            try:
+                job_chunks, job_vectors = split_text_with_vectors(job.text, job.metadata)
+            except Exception as e:
+                logger.error(f"异步入库分块失败 job={job.id}: {e}")
+                self._finish(job, IngestJob.FAILED, str(e))
+                continue
+            job.chunks = len(job_chunks)
+            chunks.extend(job_chunks)
+            vectors.extend(job_vectors)
+            ready.append(job)
+
+        try:
+            if chunks:
+                store_documents(chunks, vectors)
+            for job in ready:
+                self._finish(job, IngestJob.SUCCESS)
+        except Exception as e:
+            logger.error(f"异步入库写入失败，批大小 {len(ready)}: {e}")
+            for job in ready:
+                self._finish(job, IngestJob.FAILED, str(e))
+
+        logger.debug(f"异步入库批次完成: 任务 {len(jobs)}，块数 {len(chunks)}")
+        return jobs
+
+    @staticmethod
+    def _finish(job: IngestJob, status: str, error: str = None):
+        """标记任务结束"""
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        job.text = None  # 释放原文
+
+    def queue_depth(self) -> int:
+        """排队中的任务数"""
+        return self._batcher.queue_depth()
+
+    def stats(self) -> Dict:
+        """返回队列统计"""
+        with self._jobs_lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            "queue_depth": self.queue_depth(),
+            "jobs": counts,
+            "batching": self._batcher.stats(),
+        }
+
+
+# 全局单例
+_ingest_queue: Optional[IngestQueue] = None
+_ingest_lock = threading.Lock()
+
+
+def get_ingest_queue() -> IngestQueue:
+    """获取异步入库队列单例"""
+    global _ingest_queue
+    if _ingest_queue is None:
+        with _ingest_lock:
+            if _ingest_queue is None:
+                _ingest_queue = IngestQueue()
+    return _ingest_queue
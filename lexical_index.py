@@ -0,0 +1,561 @@
+"""
+BM25 关键词索引
+弥补向量检索对型号、产品名等精确词的召回不足（如 "xiaomi 17 pro max"），
+与 Chroma 结果做 RRF 融合实现混合检索。
+
+索引按段（segment）持久化：每次写入生成一个不可变段文件，删除只改写对应段的存活位图，
+段数过多时按大小分层合并。启动时直接加载段文件，无需重新分词。
+
+多个 worker 进程（serve.py）共用同一个索引目录：写入在文件排他锁内先同步其他进程的变更再改写清单，
+清单带版本号，检索前发现清单被其他进程改写时增量同步，各进程看到的是同一份索引。
+"""
+import json
+import logging
+import math
+import os
+import pickle
+import re
+import threading
+import time
+import unicodedata
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，只支持单进程
+    fcntl = None
+
+from config import Config
+from vector_store import VectorStore, add_change_listener
+
+logger = logging.getLogger(__name__)
+
+# 分词器版本，变更分词规则后旧索引自动重建
+TOKENIZER_VERSION = "cjk-bigram-v1"
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[._\-][a-z0-9]+)*|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    中文友好分词（无需额外依赖）
+
+    - 英文/数字按词切分，保留型号中的 . _ -（如 "v4.0"、"rtx-4090"）
+    - 连续汉字切成二元组（"小米手机" -> 小米/米手/手机），单个汉字保留为一元
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for match in _TOKEN_RE.finditer(text):
+        word = match.group()
+        if word.isascii() or len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+class _Segment:
+    """
+    不可变索引段
+
+    倒排表压平存储：terms[i] 的 posting 为 ords[offsets[i]:offsets[i+1]]（段内文档序号）
+    与对应的词频 tfs；live 为存活位图，删除只修改位图。
+    """
+
+    def __init__(self, name: str, ids: List[str], lengths: np.ndarray, terms: List[str],
+                 offsets: np.ndarray, ords: np.ndarray, tfs: np.ndarray, live: np.ndarray = None):
+        self.name = name
+        self.ids = ids
+        self.lengths = lengths
+        self.terms = terms
+        self.offsets = offsets
+        self.ords = ords
+        self.tfs = tfs
+        self.live = live if live is not None else np.ones(len(ids), dtype=bool)
+        self.term_index = {term: i for i, term in enumerate(terms)}
+
+    @classmethod
+    def build(cls, name: str, docs: List[Tuple[str, List[str]]]) -> "_Segment":
+        """由 (文档ID, 分词结果) 列表构建段"""
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        lengths = np.zeros(len(docs), dtype=np.int32)
+        for ord_, (_, tokens) in enumerate(docs):
+            lengths[ord_] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((ord_, tf))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        for i, term in enumerate(terms):
+            offsets[i + 1] = offsets[i] + len(postings[term])
+        ords = np.empty(offsets[-1], dtype=np.int32)
+        tfs = np.empty(offsets[-1], dtype=np.int32)
+        for i, term in enumerate(terms):
+            entries = postings[term]
+            ords[offsets[i]:offsets[i + 1]] = [o for o, _ in entries]
+            tfs[offsets[i]:offsets[i + 1]] = [tf for _, tf in entries]
+        return cls(name, [doc_id for doc_id, _ in docs], lengths, terms, offsets, ords, tfs)
+
+    def posting(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """返回 (文档序号, 词频)，词不存在时返回 None"""
+        i = self.term_index.get(term)
+        if i is None:
+            return None
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.ords[start:end], self.tfs[start:end]
+
+    def live_docs(self):
+        """遍历存活文档 (序号, 文档ID)"""
+        for ord_ in np.flatnonzero(self.live):
+            yield int(ord_), self.ids[ord_]
+
+    def terms_of(self) -> Dict[int, Counter]:
+        """还原存活文档的词频（合并段时使用）"""
+        docs: Dict[int, Counter] = {}
+        for i, term in enumerate(self.terms):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            for ord_, tf in zip(self.ords[start:end], self.tfs[start:end]):
+                if self.live[ord_]:
+                    docs.setdefault(int(ord_), Counter())[term] = int(tf)
+        return docs
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class LexicalIndex:
+    """
+    BM25 倒排索引
+
+    通过 vector_store.add_change_listener 增量维护：
+    写入时分词生成新段，删除时翻转所在段的存活位，覆盖写入（相同 ID）先删除旧版本。
+    每次变更都会改写清单并递增版本号，其他进程据此同步。
+    """
+
+    def __init__(self, directory: str = None, merge_factor: int = None,
+                 k1: float = 1.5, b: float = 0.75):
+        """
+        初始化索引（加载已有段文件）
+
+        Args:
+            directory: 段文件目录，默认 Config.LEXICAL_INDEX_DIR
+            merge_factor: 同一大小层级的段数达到该值时合并
+            k1: BM25 词频饱和参数
+            b: BM25 文档长度归一化参数
+        """
+        self.directory = directory or Config.LEXICAL_INDEX_DIR
+        self.merge_factor = max(2, merge_factor or Config.LEXICAL_MERGE_FACTOR)
+        self.k1 = k1
+        self.b = b
+
+        self._segments: List[_Segment] = []
+        self._locations: Dict[str, Tuple[_Segment, int]] = {}
+        self._total_length = 0
+        self._generation = 0  # 已同步的清单版本号
+        self._stamp = None    # 已同步的清单文件状态（inode, mtime, size）
+        self._lock = threading.RLock()
+        self._searches = 0
+        self._merges = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, self._file_lock(exclusive=True):
+            self._load()
+
+    # ---------- 持久化 ----------
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        """跨进程文件锁：改写索引持排他锁，读取其他进程的变更持共享锁"""
+        if fcntl is None:
+            yield
+            return
+        with open(self._path(".lock"), "a+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def _write_atomic(self, name: str, data: bytes):
+        """先写临时文件再替换，避免崩溃留下半个文件（临时文件名带进程号，多 worker 写入互不干扰）"""
+        tmp = self._path(f"{name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(name))
+
+    def _write_segment(self, segment: _Segment):
+        """写入段文件和存活位图"""
+        payload = {
+            "ids": segment.ids,
+            "lengths": segment.lengths,
+            "terms": segment.terms,
+            "offsets": segment.offsets,
+            "ords": segment.ords,
+            "tfs": segment.tfs,
+        }
+        self._write_atomic(f"{segment.name}.seg", pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+        self._write_live(segment)
+
+    def _write_live(self, segment: _Segment):
+        """写入存活位图（删除时只改写这个小文件）"""
+        self._write_atomic(f"{segment.name}.live", np.packbits(segment.live).tobytes())
+
+    def _write_manifest(self):
+        """清单文件决定哪些段有效，段的新增/合并/删除以清单替换为准（版本号递增，调用方持有排他锁）"""
+        self._generation += 1
+        manifest = {
+            "tokenizer": TOKENIZER_VERSION,
+            "generation": self._generation,
+            "segments": [segment.name for segment in self._segments],
+        }
+        self._write_atomic("manifest.json", json.dumps(manifest).encode("utf-8"))
+        self._stamp = self._manifest_stamp()
+
+    def _manifest_stamp(self) -> Optional[tuple]:
+        """清单文件状态，清单每次改写都是替换文件，状态变化即有其他进程写入"""
+        try:
+            stat = os.stat(self._path("manifest.json"))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _read_manifest(self) -> Tuple[int, List[str]]:
+        """读取清单，返回 (版本号, 段名列表)；分词规则变更时视为空索引"""
+        manifest_path = self._path("manifest.json")
+        if not os.path.exists(manifest_path):
+            return 0, []
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("tokenizer") != TOKENIZER_VERSION:
+            logger.info("关键词索引分词规则已变更，重建索引")
+            return manifest.get("generation", 0), []
+        return manifest.get("generation", 0), manifest.get("segments", [])
+
+    def _read_live(self, name: str, size: int) -> Optional[np.ndarray]:
+        """读取段的存活位图，文件不存在时返回 None（全部存活）"""
+        live_path = self._path(f"{name}.live")
+        if not os.path.exists(live_path):
+            return None
+        with open(live_path, "rb") as f:
+            bits = np.frombuffer(f.read(), dtype=np.uint8)
+        return np.unpackbits(bits)[:size].astype(bool)
+
+    def _read_segment(self, name: str) -> _Segment:
+        """读取段文件和存活位图"""
+        with open(self._path(f"{name}.seg"), "rb") as f:
+            payload = pickle.load(f)
+        return _Segment(name, live=self._read_live(name, len(payload["ids"])), **payload)
+
+    def _load(self):
+        """加载清单中的段，清理未登记的残留文件（调用方持有排他锁）"""
+        started = time.perf_counter()
+        self._stamp = self._manifest_stamp()
+        self._generation, names = self._read_manifest()
+        for name in names:
+            self._attach(self._read_segment(name))
+
+        valid = set(names)
+        for filename in os.listdir(self.directory):
+            stem, ext = os.path.splitext(filename)
+            if ext in (".seg", ".live", ".tmp") and stem not in valid:
+                os.remove(self._path(filename))
+
+        logger.info(
+            f"关键词索引加载完成: {len(self._segments)} 段, {len(self._locations)} 文档, "
+            f"耗时 {(time.perf_counter() - started) * 1000:.1f}ms"
+        )
+
+    def _attach(self, segment: _Segment):
+        """把段挂入内存索引"""
+        self._segments.append(segment)
+        for ord_, doc_id in segment.live_docs():
+            self._locations[doc_id] = (segment, ord_)
+            self._total_length += int(segment.lengths[ord_])
+
+    def _forget(self, segment: _Segment, ords):
+        """从内存索引中移除段内指定序号的文档（文档已被更新的段接管时跳过）"""
+        for ord_ in ords:
+            doc_id = segment.ids[ord_]
+            location = self._locations.get(doc_id)
+            if location is not None and location[0] is segment and location[1] == ord_:
+                del self._locations[doc_id]
+                self._total_length -= int(segment.lengths[ord_])
+
+    def _refresh(self):
+        """
+        同步其他进程的变更（调用方持有锁）：卸下已被合并掉的段，
+        重读其余段的存活位图，挂入新段
+        """
+        stamp = self._manifest_stamp()
+        if stamp == self._stamp:
+            return
+        generation, names = self._read_manifest()
+        if generation != self._generation:
+            wanted = set(names)
+            for segment in [s for s in self._segments if s.name not in wanted]:
+                self._forget(segment, np.flatnonzero(segment.live))
+            self._segments = [s for s in self._segments if s.name in wanted]
+
+            known = set()
+            for segment in self._segments:
+                known.add(segment.name)
+                live = self._read_live(segment.name, len(segment))
+                if live is not None:
+                    self._forget(segment, np.flatnonzero(segment.live & ~live))
+                    segment.live = live
+            for name in names:
+                if name not in known:
+                    self._attach(self._read_segment(name))
+            self._generation = generation
+            logger.debug(f"关键词索引已同步到版本 {generation}: {len(self._locations)} 文档")
+        self._stamp = stamp
+
+    def _sync(self):
+        """检索前检查清单，其他进程写入过时同步（调用方持有 self._lock）"""
+        if self._manifest_stamp() != self._stamp:
+            with self._file_lock(exclusive=False):
+                self._refresh()
+
+    # ---------- 维护 ----------
+
+    def add(self, ids: List[str], texts: List[str]):
+        """写入文档（已存在的 ID 视为覆盖）"""
+        if not ids:
+            return
+        # 同一批内重复的 ID 以最后一次为准
+        latest = dict(zip(ids, texts))
+        docs = [(doc_id, tokenize(text or "")) for doc_id, text in latest.items()]
+        segment = _Segment.build(uuid.uuid4().hex, docs)
+        with self._lock, self._file_lock(exclusive=True):
+            self._refresh()
+            self._delete_locked(list(latest))
+            self._write_segment(segment)
+            self._attach(segment)
+            self._maybe_merge()
+            self._write_manifest()
+
+    def delete(self, ids: List[str]):
+        """删除文档"""
+        with self._lock, self._file_lock(exclusive=True):
+            self._refresh()
+            if self._delete_locked(ids):
+                self._write_manifest()
+
+    def _delete_locked(self, ids: List[str]) -> int:
+        """翻转存活位并持久化受影响段的位图（调用方持有锁），返回删除的文档数"""
+        touched = {}
+        removed = 0
+        for doc_id in ids:
+            location = self._locations.pop(doc_id, None)
+            if location is None:
+                continue
+            segment, ord_ = location
+            segment.live[ord_] = False
+            self._total_length -= int(segment.lengths[ord_])
+            touched[segment.name] = segment
+            removed += 1
+        for segment in touched.values():
+            self._write_live(segment)
+        return removed
+
+    def _maybe_merge(self):
+        """
+        分层合并：按存活文档数的数量级分层，某层段数达到 merge_factor 时合并为一个段，
+        每篇文档只会被重写 O(log N) 次（调用方持有锁）
+        """
+        while True:
+            tiers: Dict[int, List[_Segment]] = {}
+            for segment in self._segments:
+                size = int(segment.live.sum())
+                tier = int(math.log(size, self.merge_factor)) if size else -1
+                tiers.setdefault(tier, []).append(segment)
+            group = next((g for g in tiers.values() if len(g) >= self.merge_factor), None)
+            if group is None:
+                return
+            self._merge(group)
+
+    def _merge(self, group: List[_Segment]):
+        """合并一组段：只保留存活文档，旧段文件在新清单生效后删除"""
+        docs = []
+        for segment in group:
+            counts = segment.terms_of()
+            for ord_, doc_id in segment.live_docs():
+                tokens = list(counts.get(ord_, Counter()).elements())
+                docs.append((doc_id, tokens))
+        merged = _Segment.build(uuid.uuid4().hex, docs)
+        self._write_segment(merged)
+
+        removed = {segment.name for segment in group}
+        self._segments = [segment for segment in self._segments if segment.name not in removed]
+        for segment in group:
+            for ord_, doc_id in segment.live_docs():
+                self._total_length -= int(segment.lengths[ord_])
+                del self._locations[doc_id]
+        self._attach(merged)
+        self._write_manifest()
+        for name in removed:
+            for ext in (".seg", ".live"):
+                try:
+                    os.remove(self._path(f"{name}{ext}"))
+                except FileNotFoundError:
+                    pass
+        self._merges += 1
+        logger.debug(f"关键词索引合并 {len(group)} 段 -> {len(merged)} 文档")
+
+    def rebuild(self, batch_size: int = 1000):
+        """从 Chroma 全量重建索引（首次启用或索引与向量库不一致时）"""
+        started = time.perf_counter()
+        with self._lock, self._file_lock(exclusive=True):
+            self._refresh()
+            for segment in self._segments:
+                for ext in (".seg", ".live"):
+                    try:
+                        os.remove(self._path(f"{segment.name}{ext}"))
+                    except FileNotFoundError:
+                        pass
+            self._segments = []
+            self._locations = {}
+            self._total_length = 0
+
+            for shard in VectorStore().shards:
+                offset = 0
+                while True:
+                    page = shard._collection.get(include=["documents"], limit=batch_size, offset=offset)
+                    if not page["ids"]:
+                        break
+                    docs = [(doc_id, tokenize(text or "")) for doc_id, text in zip(page["ids"], page["documents"])]
+                    segment = _Segment.build(uuid.uuid4().hex, docs)
+                    self._write_segment(segment)
+                    self._attach(segment)
+                    self._maybe_merge()
+                    offset += len(page["ids"])
+            self._write_manifest()
+        logger.info(
+            f"关键词索引重建完成: {len(self._locations)} 文档, 耗时 {time.perf_counter() - started:.1f}s"
+        )
+
+    def on_store_change(self, event: str, ids: list, documents: list = None):
+        """向量库变更监听器（见 vector_store.add_change_listener）"""
+        if event == "add":
+            self.add(ids, [doc.page_content for doc in documents])
+        elif event == "delete":
+            self.delete(ids)
+
+    # ---------- 查询 ----------
+
+    def search(self, query: str, k: int = 10, ids: set = None) -> List[Tuple[str, float]]:
+        """
+        BM25 检索
+
+        Args:
+            query: 查询文本
+            k: 返回条数
+            ids: 可选，只在这些文档中取 top k（metadata 过滤后的候选；IDF 等统计仍按全库计算）
+
+        Returns:
+            [(文档ID, BM25 分数)]，按分数降序
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or k <= 0:
+            return []
+
+        with self._lock:
+            self._sync()
+            self._searches += 1
+            n_docs = len(self._locations)
+            if n_docs == 0:
+                return []
+            avgdl = self._total_length / n_docs
+
+            # 第一遍：统计全局文档频率
+            postings = []
+            df = Counter()
+            for segment in self._segments:
+                entries = []
+                for term in terms:
+                    posting = segment.posting(term)
+                    if posting is not None:
+                        entries.append((term, posting))
+                        df[term] += int(segment.live[posting[0]].sum())
+                if entries:
+                    postings.append((segment, entries))
+
+            idf = {term: math.log(1 + (n_docs - df[term] + 0.5) / (df[term] + 0.5)) for term in df}
+
+            allowed = None
+            if ids is not None:
+                allowed = {}
+                for doc_id in ids:
+                    location = self._locations.get(doc_id)
+                    if location is not None:
+                        allowed.setdefault(location[0].name, []).append(location[1])
+
+            # 第二遍：逐段向量化计算分数，各段取 top k 再汇总
+            candidates = []
+            for segment, entries in postings:
+                if allowed is not None and segment.name not in allowed:
+                    continue
+                scores = np.zeros(len(segment), dtype=np.float32)
+                norm = self.k1 * (1 - self.b + self.b * segment.lengths / avgdl)
+                for term, (ords, tfs) in entries:
+                    scores[ords] += idf[term] * tfs * (self.k1 + 1) / (tfs + norm[ords])
+                scores[~segment.live] = 0
+                if allowed is not None:
+                    mask = np.zeros(len(segment), dtype=bool)
+                    mask[allowed[segment.name]] = True
+                    scores[~mask] = 0
+                hits = np.flatnonzero(scores)
+                if len(hits) > k:
+                    hits = hits[np.argpartition(-scores[hits], k)[:k]]
+                candidates.extend((segment.ids[i], float(scores[i])) for i in hits)
+
+        candidates.sort(key=lambda x: x[1], reverse=True)
+        return candidates[:k]
+
+    def __len__(self):
+        return len(self._locations)
+
+    def stats(self) -> Dict:
+        """返回索引统计"""
+        with self._lock:
+            self._sync()
+            return {
+                "documents": len(self._locations),
+                "segments": len(self._segments),
+                "avg_doc_tokens": round(self._total_length / len(self._locations), 2) if self._locations else 0.0,
+                "searches": self._searches,
+                "merges": self._merges,
+                "generation": self._generation,
+            }
+
+
+# 全局单例
+_lexical_index: Optional[LexicalIndex] = None
+_lexical_lock = threading.Lock()
+
+
+def get_lexical_index() -> Optional[LexicalIndex]:
+    """
+    获取关键词索引单例（LEXICAL_INDEX_ENABLED=False 时返回 None）
+
+    需在服务启动时调用一次以注册变更监听器；索引文档数与向量库不一致时自动重建
+    """
+    global _lexical_index
+    if not Config.LEXICAL_INDEX_ENABLED:
+        return None
+    if _lexical_index is None:
+        with _lexical_lock:
+            if _lexical_index is None:
+                index = LexicalIndex()
+                add_change_listener(index.on_store_change)
+                count = VectorStore().count()
+                if len(index) != count:
+                    logger.info(f"关键词索引 ({len(index)}) 与向量库 ({count}) 不一致，开始重建")
+                    index.rebuild()
+                _lexical_index = index
+    return _lexical_index
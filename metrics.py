@@ -0,0 +1,52 @@
+"""
+运行指标模块
+提供线程安全的延迟/数值统计，用于各服务的 stats 输出
+"""
+import threading
+from collections import deque
+from typing import Dict
+
+
+class LatencyRecorder:
+    """
+    滑动窗口统计器
+
+    记录最近 window 个样本，输出次数、均值、P50/P95/P99、最大值。
+    所有方法线程安全。
+    """
+
+    def __init__(self, window: int = 1024):
+        self._samples = deque(maxlen=window)
+        self._count = 0
+        self._total = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, value: float):
+        """记录一个样本（延迟单位由调用方决定，通常为毫秒）"""
+        with self._lock:
+            self._samples.append(value)
+            self._count += 1
+            self._total += value
+
+    def snapshot(self) -> Dict:
+        """返回当前统计快照"""
+        with self._lock:
+            samples = sorted(self._samples)
+            count = self._count
+            total = self._total
+
+        if not samples:
+            return {"count": count, "avg": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+
+        def percentile(p: float) -> float:
+            index = min(len(samples) - 1, int(round(p * (len(samples) - 1))))
+            return round(samples[index], 3)
+
+        return {
+            "count": count,
+            "avg": round(total / count, 3),
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+            "max": round(samples[-1], 3),
+        }
@@ -2,10 +2,15 @@
 Reranker 重排序服务
 使用 bge-reranker 模型对检索结果进行精排
 """
+import hashlib
 import logging
-from typing import List, Dict, Optional
+import sys
+from typing import List, Dict, Optional, Tuple
 
+from batching import MicroBatcher
+from cache import LRUCache
 from config import Config
+from metrics import LatencyRecorder
 
 logger = logging.getLogger(__name__)
 
@@ -14,9 +19,17 @@ class RerankerService:
     """
     基于 BGE-Reranker 的重排序服务
     支持 bge-reranker-v2-m3（多语言）和 bge-reranker-large（中文）
+    
+    并发请求的 query-document 对经 MicroBatcher 短暂收集后合并为一次 compute_score，
+    再按顺序把分数分发回各请求；
+    已算过的 (query, document) 分数缓存在内存 LRU 中（按内存上限淘汰），只有未命中的 pair 送入模型；
+    每批 pair 按 token 长度分桶计算，减少 padding 浪费。
+    
+    级联模式（配置 cascade_model）：轻量模型先给全部候选打分，
+    只有前 M 个候选交给主模型精排，最终分数校准到统一的 0-1 区间。
     """
     
-    def __init__(self, model_name: str = None, use_fp16: bool = None):
+    def __init__(self, model_name: str = None, use_fp16: bool = None, cascade_model: str = None):
         """
         初始化 Reranker 服务
         
@@ -26,12 +39,31 @@ class RerankerService:
                 - BAAI/bge-reranker-large (中文)
                 - BAAI/bge-reranker-base (轻量)
             use_fp16: 是否使用 FP16 加速
+            cascade_model: 级联初筛用的轻量模型（如 BAAI/bge-reranker-base），
+                默认 Config.RERANKER_CASCADE_MODEL，空字符串表示不启用级联
         """
         # 使用配置文件中的默认值
         self.model_name = model_name or getattr(Config, 'RERANKER_MODEL', 'BAAI/bge-reranker-v2-m3')
         self.use_fp16 = use_fp16 if use_fp16 is not None else getattr(Config, 'RERANKER_USE_FP16', True)
+        self.cascade_model = cascade_model if cascade_model is not None else Config.RERANKER_CASCADE_MODEL
+        self._light: Optional["RerankerService"] = None
         self.reranker = None
         self._initialized = False
+        self._batcher = MicroBatcher(
+            handler=self._score_pairs,
+            max_batch_size=Config.RERANKER_MAX_BATCH,
+            max_wait_ms=Config.RERANKER_MAX_WAIT_MS,
+            name="reranker"
+        )
+        self.max_length = Config.RERANKER_MAX_LENGTH
+        self.bucket_size = max(1, Config.RERANKER_BUCKET_SIZE)
+        self._padding_waste = LatencyRecorder()
+        cache_bytes = int(Config.RERANKER_CACHE_MAX_MB * 1024 * 1024)
+        self._score_cache = LRUCache(
+            max_size=0,
+            max_bytes=cache_bytes,
+            sizeof=sys.getsizeof
+        ) if cache_bytes > 0 else None
         
     def _lazy_init(self):
         """延迟初始化，首次调用时加载模型"""
@@ -60,7 +92,100 @@ class RerankerService:
             logger.error(f"Reranker 模型加载失败: {e}")
             raise
     
-    def rerank(self, query: str, documents: List[str], top_k: int = 5) -> List[Dict]:
+    def _token_lengths(self, pairs: List[List[str]]) -> List[int]:
+        """计算每个 pair 截断后的 token 数（无 tokenizer 时按字符数估算）"""
+        tokenizer = getattr(self.reranker, "tokenizer", None)
+        if tokenizer is not None:
+            encoded = tokenizer(
+                [query for query, _ in pairs],
+                [doc for _, doc in pairs],
+                truncation="only_second",
+                max_length=self.max_length
+            )
+            return [len(ids) for ids in encoded["input_ids"]]
+        return [min(len(query) + len(doc) + 3, self.max_length) for query, doc in pairs]
+    
+    def _score_pairs(self, pairs: List[List[str]]) -> List[Tuple[float, int, int]]:
+        """
+        批量计算 query-document 对的相关性分数（MicroBatcher 的批处理函数）
+        
+        按 token 长度排序后切成若干桶，每桶单独 compute_score，
+        避免一条长文档把整批都 padding 到最大长度；最后恢复原顺序。
+        
+        Returns:
+            与 pairs 等长的 (分数, 实际 token 数, padding 后 token 数)
+        """
+        lengths = self._token_lengths(pairs)
+        order = sorted(range(len(pairs)), key=lambda i: lengths[i])
+        results: List[Optional[Tuple[float, int, int]]] = [None] * len(pairs)
+        
+        for start in range(0, len(order), self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            padded = max(lengths[i] for i in bucket)
+            scores = self.reranker.compute_score(
+                [pairs[i] for i in bucket],
+                normalize=True,
+                max_length=self.max_length,
+                batch_size=len(bucket)
+            )
+            
+            # 如果只有一个文档，scores 是标量
+            if isinstance(scores, (int, float)):
+                scores = [scores]
+            for i, score in zip(bucket, scores):
+                results[i] = (float(score), lengths[i], padded)
+        return results
+    
+    def _cache_key(self, query: str, document: str) -> bytes:
+        """分数缓存键：hash(模型名, query, document)，定长 16 字节，缓存占用与文本长度无关"""
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (self.model_name, query, document):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.digest()
+    
+    def _scores(self, query: str, documents: List[str]) -> Tuple[List[float], Dict]:
+        """
+        计算分数：先查缓存，只把未命中的 pair 送入批处理，再按原顺序合并
+        
+        Returns:
+            (分数列表, 本次请求的统计：缓存命中数、token 数、padding 浪费比例)
+        """
+        scores: List[Optional[float]] = [None] * len(documents)
+        keys = None
+        if self._score_cache is not None:
+            keys = [self._cache_key(query, doc) for doc in documents]
+            scores = [self._score_cache.get(key) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        
+        tokens = padded_tokens = 0
+        if missing:
+            computed = self._batcher.submit([[query, documents[i]] for i in missing])
+            for i, (score, length, padded) in zip(missing, computed):
+                scores[i] = score
+                tokens += length
+                padded_tokens += padded
+                if keys is not None:
+                    self._score_cache.put(keys[i], score)
+        
+        stats = {
+            "pairs": len(documents),
+            "cache_hits": len(documents) - len(missing),
+            "tokens": tokens,
+            "padded_tokens": padded_tokens,
+            "padding_waste": round(1 - tokens / padded_tokens, 4) if padded_tokens else 0.0,
+        }
+        if padded_tokens:
+            self._padding_waste.record(stats["padding_waste"])
+        return scores, stats
+    
+    def rerank(self, query: str, documents: List[str], top_k: int = 5,
+               cascade_depth: int = None) -> List[Dict]:
+        """对文档进行重排序，返回值见 rerank_with_stats"""
+        return self.rerank_with_stats(query, documents, top_k, cascade_depth)[0]
+    
+    def rerank_with_stats(self, query: str, documents: List[str], top_k: int = 5,
+                          cascade_depth: int = None) -> Tuple[List[Dict], Dict]:
         """
         对文档进行重排序
         
@@ -68,29 +193,30 @@ class RerankerService:
             query: 查询文本
             documents: 待排序的文档列表
             top_k: 返回前 K 个结果
+            cascade_depth: 级联模式下交给主模型的候选数 M，
+                默认 Config.RERANKER_CASCADE_DEPTH，0 表示本次不使用级联
             
         Returns:
-            按相关性排序的结果列表，每个元素包含:
+            (结果列表, 本次请求统计)
+            结果按相关性排序，每个元素包含:
             - index: 原始索引
             - score: 重排序分数 (0-1)
             - text: 文档文本
+            统计包含缓存命中数、token 数、padding 浪费比例（级联时另含各阶段统计）
         """
         if not documents:
-            return []
+            return [], {}
         
-        # 延迟初始化
-        self._lazy_init()
+        depth = cascade_depth if cascade_depth is not None else Config.RERANKER_CASCADE_DEPTH
         
         try:
-            # 构建 query-document 对
-            pairs = [[query, doc] for doc in documents]
-            
-            # 计算相关性分数
-            scores = self.reranker.compute_score(pairs, normalize=True)
-            
-            # 如果只有一个文档，scores 是标量
-            if isinstance(scores, (int, float)):
-                scores = [scores]
+            if self.cascade_model and 0 < depth < len(documents):
+                scores, stats = self._cascade_scores(query, documents, depth)
+            else:
+                # 延迟初始化
+                self._lazy_init()
+                # 计算相关性分数（命中缓存的直接复用，其余与并发请求合并成一批）
+                scores, stats = self._scores(query, documents)
             
             # 构建结果
             results = [
@@ -107,7 +233,7 @@ class RerankerService:
             
             logger.debug(f"Rerank 完成: query='{query[:50]}...', docs={len(documents)}, top_k={top_k}")
             
-            return results[:top_k]
+            return results[:top_k], stats
             
         except Exception as e:
             logger.error(f"Rerank 失败: {e}")
@@ -115,7 +241,57 @@ class RerankerService:
             return [
                 {"index": i, "score": 0.5, "text": doc}
                 for i, doc in enumerate(documents[:top_k])
-            ]
+            ], {"degraded": True}
+    
+    def _light_service(self) -> "RerankerService":
+        """获取级联初筛用的轻量 Reranker（延迟创建）"""
+        if self._light is None:
+            self._light = RerankerService(model_name=self.cascade_model, cascade_model="")
+        return self._light
+    
+    def _cascade_scores(self, query: str, documents: List[str], depth: int) -> Tuple[List[float], Dict]:
+        """
+        级联打分
+        
+        1. 轻量模型给全部候选打分
+        2. 前 depth 个候选用主模型重新打分
+        3. 校准：入选候选使用主模型分数；落选候选按轻量分数缩放到
+           [0, 入选候选最低分]，保证落选者不会排在入选者之前，整体仍为 0-1
+        """
+        light = self._light_service()
+        light._lazy_init()
+        light_scores, light_stats = light._scores(query, documents)
+        
+        survivors = sorted(range(len(documents)), key=lambda i: light_scores[i], reverse=True)[:depth]
+        self._lazy_init()
+        heavy_scores, heavy_stats = self._scores(query, [documents[i] for i in survivors])
+        
+        floor = min(heavy_scores)
+        scores = [light_score * floor for light_score in light_scores]
+        for i, score in zip(survivors, heavy_scores):
+            scores[i] = score
+        
+        stats = {
+            "cascade": {
+                "light_model": self.cascade_model,
+                "candidates": len(documents),
+                "survivors": len(survivors),
+            },
+            "light": light_stats,
+            **heavy_stats,
+        }
+        return scores, stats
+    
+    def stats(self) -> Dict:
+        """返回重排序统计（批大小、延迟、缓存命中率等）"""
+        return {
+            "model": self.model_name,
+            "initialized": self._initialized,
+            "batching": self._batcher.stats(),
+            "score_cache": self._score_cache.stats() if self._score_cache else None,
+            "padding_waste": self._padding_waste.snapshot(),
+            "cascade": self._light.stats() if self._light else None,
+        }
     
     def is_available(self) -> bool:
         """检查 Reranker 是否可用"""
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+分片迁移脚本
+
+修改 SHARD_COUNT / SHARD_STRATEGY / SHARD_KEY 后，已有数据仍在旧布局的集合中，
+VectorStore 启动时会拒绝启动（ShardLayoutError）。本脚本把所有分片集合（"comment" 与 comment_i）
+中的数据按新布局重新路由：
+
+1. 逐页读取旧集合（ID、向量、内容、metadata，不重新向量化），写入临时集合 comment_reshard_i
+2. 核对条数一致后删除旧集合，把临时集合改名为 comment / comment_i，并记录新布局
+
+文档 ID 不变，关键词索引无需重建。运行前请停止所有 easyRAG 实例（嵌入式 Chroma 不支持多进程访问，
+HTTP 模式下迁移期间的写入会丢失；迁移未完成时 VectorStore 拒绝启动）。
+
+迁移进度记录在状态集合 reshard_state 的 metadata 中（phase=copying / copied），中途中断时重新运行即可：
+- copying：旧集合未被改动，且条数与开始时一致时丢弃临时集合重新复制；条数变化时报错退出，不删除任何集合
+- copied：复制已核对完成，临时集合是唯一完整副本，不再删除，只继续删除旧集合与改名
+
+用法:
+    SHARD_COUNT=4 python reshard.py          # 按当前 SHARD_* 配置迁移
+    python reshard.py --shards 8 --strategy hash
+    python reshard.py --shards 1             # 合并回单集合 "comment"
+"""
+import argparse
+import logging
+import sys
+import time
+from typing import Dict, List
+
+from config import Config
+from vector_store import RESHARD_STATE, is_shard_collection, shard_for, shard_layout, shard_names
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('reshard')
+
+STAGING_PREFIX = "comment_reshard_"
+
+
+def open_client():
+    """Chroma 客户端（CHROMA_MODE=http 时连接服务，否则打开 VECTOR_DIR）"""
+    from chroma_client import get_chroma_backend
+
+    backend = get_chroma_backend()
+    if backend is not None:
+        return backend.client
+    import chromadb
+    from chromadb.config import Settings
+    return chromadb.PersistentClient(path=Config.VECTOR_DIR, settings=Settings(anonymized_telemetry=False))
+
+
+def collection_names(client) -> List[str]:
+    """全部集合名（兼容 list_collections 返回集合对象或名称的版本）"""
+    return [getattr(collection, "name", collection) for collection in client.list_collections()]
+
+
+def upsert(collection, ids: list, embeddings: list, documents: list, metadatas: list):
+    """写入一批（与 vector_store._upsert 一致：有/无 metadata 分两次写入）"""
+    with_meta = [i for i, metadata in enumerate(metadatas) if metadata]
+    without_meta = [i for i, metadata in enumerate(metadatas) if not metadata]
+    if with_meta:
+        collection.upsert(ids=[ids[i] for i in with_meta], embeddings=[embeddings[i] for i in with_meta],
+                          documents=[documents[i] for i in with_meta], metadatas=[metadatas[i] for i in with_meta])
+    if without_meta:
+        collection.upsert(ids=[ids[i] for i in without_meta], embeddings=[embeddings[i] for i in without_meta],
+                          documents=[documents[i] for i in without_meta])
+
+
+def source_sizes(client) -> Dict[str, int]:
+    """当前全部分片集合（任意分片数）及条数"""
+    return {name: client.get_collection(name).count()
+            for name in collection_names(client) if is_shard_collection(name)}
+
+
+def set_state(client, layout: dict, phase: str, total: int):
+    """写入迁移进度（metadata 整体替换）"""
+    state = client.get_or_create_collection(RESHARD_STATE, metadata={**layout, "phase": phase, "total": total})
+    state.modify(metadata={**layout, "phase": phase, "total": total})
+
+
+def finish(client, layout: dict, total: int) -> int:
+    """
+    复制已核对（phase=copied）后完成切换：删除旧集合，临时集合改名为正式分片名
+
+    先删除全部旧集合再改名，因此临时集合全部存在时说明尚未开始改名，现有分片集合都是旧集合；
+    缺少部分临时集合时说明改名已开始，旧集合已全部删除，现有分片集合都是迁移后的数据。
+
+    Returns:
+        0 成功，1 迁移后条数不一致
+    """
+    count = layout["shard_count"]
+    staging = [f"{STAGING_PREFIX}{i}" for i in range(count)]
+    targets = shard_names(count)
+    names = set(collection_names(client))
+    remaining = [i for i, name in enumerate(staging) if name in names]
+    if len(remaining) == count:
+        for name in source_sizes(client):
+            client.delete_collection(name)
+            logger.info(f"已删除旧集合 {name}")
+    for i in remaining:
+        client.get_collection(staging[i]).modify(name=targets[i])
+
+    sizes = [client.get_collection(name).count() for name in targets]
+    if sum(sizes) != total:
+        logger.error(f"切换后条数不一致（{sum(sizes)} != {total}），保留迁移状态 {RESHARD_STATE}，请人工检查")
+        return 1
+    client.delete_collection(RESHARD_STATE)
+    logger.info(f"迁移完成: {total} 条 -> {targets}，各分片 {sizes}")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="按新的分片配置迁移向量库")
+    parser.add_argument("--shards", type=int, default=Config.SHARD_COUNT, help="目标分片数（默认 SHARD_COUNT）")
+    parser.add_argument("--strategy", default=Config.SHARD_STRATEGY, choices=["key", "hash"],
+                        help="目标路由策略（默认 SHARD_STRATEGY）")
+    parser.add_argument("--key", default=Config.SHARD_KEY, help="key 策略的分片键（默认 SHARD_KEY）")
+    parser.add_argument("--batch-size", type=int, default=1000, help="每页读取的条数")
+    args = parser.parse_args()
+
+    count = max(1, args.shards)
+    layout = shard_layout(count, args.strategy, args.key)
+    client = open_client()
+    names = collection_names(client)
+    leftovers = [name for name in names if name.startswith(STAGING_PREFIX)]
+    sizes = source_sizes(client)
+    total = sum(sizes.values())
+
+    if RESHARD_STATE in names:
+        state = dict(client.get_collection(RESHARD_STATE).metadata or {})
+        phase, previous = state.pop("phase", None), state.pop("total", None)
+        if phase == "copied":
+            if state != layout:
+                logger.warning(f"上次迁移（{state}）已复制完成，先按该布局完成切换，忽略本次参数 {layout}")
+            logger.info("上次迁移已复制并核对完成，继续删除旧集合与改名")
+            return finish(client, state, previous)
+        if total != previous:
+            logger.error(
+                f"上次迁移中断于复制阶段，但旧集合条数已变化（{previous} -> {total}），"
+                f"可能有实例仍在写入；请停止所有实例后人工检查，本次不删除任何集合"
+            )
+            return 1
+        logger.info(f"上次迁移中断于复制阶段，旧集合完整（{total} 条），丢弃临时集合重新复制: {leftovers}")
+        for name in leftovers:
+            client.delete_collection(name)
+    elif leftovers:
+        logger.error(f"存在临时集合 {leftovers} 但没有迁移状态 {RESHARD_STATE}，无法判断其中数据是否可丢弃，请人工检查")
+        return 1
+
+    targets = shard_names(count)
+    current = all(name in targets for name, size in sizes.items() if size)
+    # 单集合时路由与策略无关，只比较分片数
+    keys = list(layout) if count > 1 else ["shard_count"]
+    current = current and all(
+        (client.get_collection(name).metadata or {}).get(key) == layout[key]
+        for name in targets if sizes.get(name) for key in keys
+    )
+    if current:
+        logger.info(f"数据已是目标布局 {layout}，无需迁移")
+        return 0
+
+    logger.info(f"当前分片集合: {sizes}，共 {total} 条；目标布局: {layout}")
+    started = time.perf_counter()
+    set_state(client, layout, "copying", total)
+    staging = [f"{STAGING_PREFIX}{i}" for i in range(count)]
+    collections = [client.create_collection(name, metadata=layout) for name in staging]
+    copied = 0
+    for name in sizes:
+        source = client.get_collection(name)
+        offset = 0
+        while True:
+            page = source.get(include=["embeddings", "documents", "metadatas"],
+                              limit=args.batch_size, offset=offset)
+            if not len(page["ids"]):
+                break
+            groups: Dict[int, List[int]] = {}
+            for i, (doc_id, metadata) in enumerate(zip(page["ids"], page["metadatas"])):
+                groups.setdefault(shard_for(doc_id, metadata, count, args.strategy, args.key), []).append(i)
+            for shard, rows in groups.items():
+                upsert(collections[shard],
+                       [page["ids"][i] for i in rows],
+                       [page["embeddings"][i] for i in rows],
+                       [page["documents"][i] for i in rows],
+                       [page["metadatas"][i] for i in rows])
+            offset += len(page["ids"])
+            copied += len(page["ids"])
+            logger.info(f"已复制 {copied}/{total} 条")
+
+    written = sum(collection.count() for collection in collections)
+    after = sum(source_sizes(client).values())
+    if written != total or after != total:
+        logger.error(f"复制后条数不一致（旧集合 {total} -> {after}，新集合 {written}），保留旧集合，"
+                     f"重新运行将丢弃临时集合重试")
+        return 1
+
+    # 核对完成后先落盘进度，此后临时集合不再被丢弃
+    set_state(client, layout, "copied", total)
+    logger.info(f"复制完成，耗时 {time.perf_counter() - started:.1f}s")
+    return finish(client, layout, total)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+检索模块
+/search、/ask、/ask-stream 共用的检索流程：向量召回（可选 BM25 混合召回）->（可选）进程内重排序 -> 分数截断
+"""
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from config import Config
+from flat_search import get_flat_index
+from lexical_index import get_lexical_index
+from reranker_service import get_reranker_service
+from vector_store import VectorStore
+
+logger = logging.getLogger(__name__)
+
+
+def distance_to_score(distance: float) -> float:
+    """
+    将 Chroma 的 L2 距离转换为相关性分数 (0-1，越大越相关)
+
+    L2 距离通常在 0-2 之间（归一化向量的情况下），
+    distance=0 -> score=1, distance=2 -> score=0，超出范围截断
+    """
+    return max(0.0, min(1.0, 1.0 - distance / 2.0))
+
+
+def _lexical_documents(query: str, k: int, filter: dict = None) -> List[Tuple[Document, float]]:
+    """
+    BM25 召回并从 Chroma 取回文档内容
+
+    有 metadata 过滤时先从 Chroma 取出满足条件的文档 ID（只取 ID），BM25 只在这些文档中取 top k；
+    先取全库 top k 再过滤，强过滤（如单个 filterKeyForDel）下几乎全部被滤掉
+    """
+    index = get_lexical_index()
+    if index is None:
+        logger.warning("关键词索引未启用，混合检索退化为向量检索")
+        return []
+    candidates = None
+    if filter:
+        candidates = set(VectorStore().get(where=filter)["ids"])
+        if not candidates:
+            return []
+    hits = index.search(query, k, ids=candidates)
+    if not hits:
+        return []
+    bm25_scores = dict(hits)
+    page = VectorStore().get(ids=list(bm25_scores), where=filter or None,
+                             include=["documents", "metadatas"])
+    documents = {
+        doc_id: Document(id=doc_id, page_content=text, metadata=metadata or {})
+        for doc_id, text, metadata in zip(page["ids"], page["documents"], page["metadatas"])
+    }
+    return [(documents[doc_id], score) for doc_id, score in hits if doc_id in documents]
+
+
+def _fuse(vector_hits: List[Tuple[Document, float]], lexical_hits: List[Tuple[Document, float]],
+          k: int) -> List[Tuple[Document, float]]:
+    """
+    倒数排名融合 (RRF)：score = Σ 1 / (k + rank)
+
+    融合分数除以两路都排第一时的最大值，换算到 0-1；
+    文档 metadata 中附带 vector_score / bm25_score 便于排查
+    """
+    fused: Dict[str, list] = {}
+    for source, hits in (("vector_score", vector_hits), ("bm25_score", lexical_hits)):
+        for rank, (doc, score) in enumerate(hits, start=1):
+            key = doc.id or doc.page_content
+            entry = fused.setdefault(key, [doc, 0.0, {}])
+            entry[1] += 1.0 / (k + rank)
+            entry[2][source] = round(score, 4)
+
+    best = 2.0 / (k + 1)
+    results = []
+    for doc, score, sources in fused.values():
+        doc.metadata = {**doc.metadata, **sources}
+        results.append((doc, score / best))
+    results.sort(key=lambda x: x[1], reverse=True)
+    return results
+
+
+def retrieve(query: str, top_k: int, filter: dict = None, rerank: bool = False,
+             rerank_factor: int = None, min_score: Optional[float] = None,
+             hybrid: bool = False, query_vector: list = None) -> Tuple[List[Tuple[Document, float]], Dict]:
+    """
+    检索相关文档
+
+    Args:
+        query: 查询文本
+        top_k: 返回条数
+        filter: metadata 过滤条件
+        rerank: 是否启用两阶段检索（先从 Chroma 多取 rerank_factor*top_k 条，再用 Reranker 精排）
+        rerank_factor: 召回放大倍数，默认 Config.RERANK_FETCH_FACTOR
+        min_score: 分数下限，低于该分数的结果被丢弃（启用重排时作用于重排分数）
+        hybrid: 是否混合检索（向量与 BM25 各召回同样条数，按 RRF 融合）
+        query_vector: 可选，调用方已计算的查询向量（不再重复向量化 query）
+
+    Returns:
+        ([(文档, 分数)], 各阶段耗时)，分数为 0-1；
+        启用重排或混合检索时文档 metadata 中附带 vector_score（混合检索另有 bm25_score）
+    """
+    timings = {}
+    started = time.perf_counter()
+
+    fetch_k = top_k
+    if rerank:
+        fetch_k = top_k * max(1, rerank_factor or Config.RERANK_FETCH_FACTOR)
+
+    # 候选数低于阈值（强过滤 / 小库）时走精确暴力检索，否则走 HNSW
+    flat_index = get_flat_index()
+    hits = flat_index.search(query, fetch_k, filter, query_vector=query_vector) if flat_index else None
+    timings["engine"] = "hnsw" if hits is None else "flat"
+    if hits is None:
+        hits = VectorStore().similarity_search_with_score(query=query, k=fetch_k, filter=filter,
+                                                          embedding=query_vector)
+    results = [(doc, distance_to_score(distance)) for doc, distance in hits]
+    timings["retrieve_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    if hybrid:
+        lexical_started = time.perf_counter()
+        lexical_hits = _lexical_documents(query, fetch_k, filter)
+        timings["lexical_ms"] = round((time.perf_counter() - lexical_started) * 1000, 2)
+        results = _fuse(results, lexical_hits, Config.HYBRID_RRF_K)[:fetch_k]
+
+    if rerank and results:
+        rerank_started = time.perf_counter()
+        reranked = get_reranker_service().rerank(
+            query=query,
+            documents=[doc.page_content for doc, _ in results],
+            top_k=top_k
+        )
+        merged = []
+        for item in reranked:
+            doc, vector_score = results[item["index"]]
+            if not hybrid:
+                doc.metadata = {**doc.metadata, "vector_score": round(vector_score, 4)}
+            merged.append((doc, item["score"]))
+        results = merged
+        timings["rerank_ms"] = round((time.perf_counter() - rerank_started) * 1000, 2)
+    else:
+        results = results[:top_k]
+
+    if min_score is not None:
+        results = [(doc, score) for doc, score in results if score >= min_score]
+
+    timings["total_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    logger.debug(f"检索完成: query='{query[:50]}', fetch_k={fetch_k}, hybrid={hybrid}, 返回 {len(results)} 条, {timings}")
+    return results, timings
+
+
+def retrieval_options(data: dict) -> Dict:
+    """
+    从请求体解析检索选项（rerank / rerank_factor / min_score / hybrid）
+
+    Raises:
+        ValueError: rerank_factor 不是整数或 min_score 不是数字（消息指明字段，接口返回 400）
+    """
+    options = {
+        "rerank": bool(data.get("rerank", False)),
+        "hybrid": bool(data.get("hybrid", False)),
+    }
+    for field, parse, expected in (("rerank_factor", int, "an integer"), ("min_score", float, "a number")):
+        if data.get(field) is None:
+            continue
+        try:
+            options[field] = parse(data[field])
+        except (TypeError, ValueError):
+            raise ValueError(f"'{field}' must be {expected}, got {data[field]!r}") from None
+    return options
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+多进程生产服务（pre-fork）
+
+主进程加载嵌入模型与 Reranker 并各做一次预热推理，冻结 GC 后创建监听 socket，再 fork 出 N 个 worker：
+- 模型权重在 fork 前加载，worker 以写时复制方式共享同一份物理内存，不会各自加载一份
+- 每个 worker 绑定到固定的 CPU 核，torch 计算线程数等于分到的核数，避免 N 个进程的线程互相抢核
+- 所有 worker 在同一个 socket 上 accept，由内核分发连接；worker 异常退出时主进程重新拉起
+- Nacos 只由主进程注册一次
+- 关键词索引各 worker 共用同一目录，写入在文件锁内合并清单，其他 worker 检索前按清单版本同步
+
+嵌入式 Chroma（CHROMA_MODE=local）不支持多进程访问，此时只启动 1 个 worker；
+多 worker 请使用 CHROMA_MODE=http 连接独立的 Chroma 服务。
+
+用法:
+    python serve.py                       # worker 数默认等于 CPU 核数
+    python serve.py --workers 4 --port 5000
+"""
+import argparse
+import atexit
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Dict, List
+
+# tokenizers 的 Rust 线程池在 fork 后不可用，必须在加载模型前关闭
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+from config import Config
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(process)d - %(levelname)s - %(message)s')
+logger = logging.getLogger('serve')
+
+
+def _set_torch_threads(threads: int):
+    """设置 torch 计算线程数（未安装 torch 时忽略）"""
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(max(1, threads))
+
+
+def preload():
+    """
+    在主进程中加载全部模型并预热
+
+    预热时 torch 只用 1 个线程：主进程不创建 OpenMP 线程池，fork 后的 worker 可以安全地重新设置线程数
+    """
+    _set_torch_threads(1)
+    started = time.perf_counter()
+
+    import app as application
+    from embedding_service import get_embedding_service
+    from flat_search import get_flat_index
+    from reranker_service import get_reranker_service
+
+    get_embedding_service().embed_query("预热")
+    # 暴力检索引擎在主进程创建（启动时清理一次分区目录），worker 继承后各自使用 <pid> 子目录
+    get_flat_index()
+    if Config.SERVE_PRELOAD_RERANKER:
+        # rerank() 在模型出错时降级为固定分数而不抛异常，先直接加载模型，失败时主进程启动失败，
+        # 而不是让每个 worker 各自在首次请求时报错（不需要 Reranker 时设置 SERVE_PRELOAD_RERANKER=False）
+        reranker = get_reranker_service()
+        services = [reranker] + ([reranker._light_service()] if reranker.cascade_model else [])
+        for service in services:
+            try:
+                service._lazy_init()
+            except Exception as e:
+                raise RuntimeError(f"Reranker 模型 {service.model_name} 预加载失败: {e}") from e
+            service.rerank("预热", ["预热"], top_k=1)
+
+    # 启动阶段创建的对象移入永久代，worker 中的 GC 不再遍历它们，避免触碰共享页触发复制
+    gc.collect()
+    gc.freeze()
+    logger.info(f"模型预加载完成，耗时 {time.perf_counter() - started:.1f}s")
+    return application
+
+
+def cpu_slices(workers: int) -> List[List[int]]:
+    """把当前进程可用的 CPU 核均分给各 worker（worker 多于核数时轮流复用）"""
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else \
+        list(range(os.cpu_count() or 1))
+    if workers >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(workers)]
+    size, extra = divmod(len(cpus), workers)
+    slices, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        slices.append(cpus[start:end])
+        start = end
+    return slices
+
+
+def run_worker(index: int, sock: socket.socket, application, cpus: List[int], threads: int):
+    """worker 进程：绑核、设置线程数后在共享 socket 上提供服务，不返回"""
+    from werkzeug.serving import make_server
+
+    code = 0
+    try:
+        # 默认的 SIGINT 处理会抛 KeyboardInterrupt，交给主进程统一处理
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        if Config.SERVE_PIN_CPUS and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        _set_torch_threads(threads)
+        host, port = sock.getsockname()[:2]
+        server = make_server(host, port, application.app, threaded=True, fd=sock.fileno())
+        logger.info(f"worker {index} 已启动: pid={os.getpid()}, cpus={cpus}, torch 线程 {threads}")
+        server.serve_forever()
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 0
+    except Exception as e:
+        logger.error(f"worker {index} 异常退出: {e}")
+        code = 1
+    finally:
+        # 不执行主进程注册的 atexit（如 Nacos 注销）
+        os._exit(code)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="easyRAG 多进程服务")
+    parser.add_argument("--host", default="0.0.0.0", help="监听地址（默认 0.0.0.0）")
+    parser.add_argument("--port", type=int, default=Config.SERVICE_PORT, help="监听端口（默认 SERVICE_PORT）")
+    parser.add_argument("--workers", type=int, default=Config.SERVE_WORKERS,
+                        help="worker 进程数（默认 SERVE_WORKERS，0 表示 CPU 核数）")
+    parser.add_argument("--threads", type=int, default=Config.SERVE_THREADS_PER_WORKER,
+                        help="每个 worker 的 torch 计算线程数（0 表示分到的核数）")
+    parser.add_argument("--backlog", type=int, default=1024, help="监听队列长度")
+    args = parser.parse_args()
+
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1 and Config.CHROMA_MODE != "http":
+        logger.warning("嵌入式 Chroma（CHROMA_MODE=local）不支持多进程访问，只启动 1 个 worker；"
+                       "多 worker 请设置 CHROMA_MODE=http 连接独立的 Chroma 服务")
+        workers = 1
+
+    application = preload()
+    from flat_search import remove_process_files
+
+    sock = socket.socket(socket.AF_INET6 if ":" in args.host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(args.backlog)
+
+    slices = cpu_slices(workers)
+    children: Dict[int, int] = {}  # pid -> worker 序号
+
+    def spawn(index: int):
+        threads = args.threads or len(slices[index])
+        pid = os.fork()
+        if pid == 0:
+            run_worker(index, sock, application, slices[index], threads)
+        children[pid] = index
+
+    for index in range(workers):
+        spawn(index)
+    logger.info(f"已启动 {workers} 个 worker，监听 {args.host}:{args.port}")
+
+    # Nacos 注册与心跳使用实际监听端口
+    Config.SERVICE_PORT = args.port
+    nacos_service = application.nacos_service
+    if nacos_service.register():
+        atexit.register(nacos_service.deregister)
+    else:
+        logger.warning("Nacos 注册失败，继续提供服务")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # 监督 worker：异常退出时重新拉起，收到停止信号后等待全部退出
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        remove_process_files(pid)
+        if not stopping:
+            logger.warning(f"worker {index} (pid={pid}) 退出，状态 {status}，重新启动")
+            time.sleep(1)
+            spawn(index)
+
+    sock.close()
+    logger.info("全部 worker 已退出")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,15 @@
+import asyncio
+import concurrent.futures
 import json
+import logging
+import os
+import queue
 import ssl
+import threading
+import time
 import websocket
 from threading import Thread
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 from time import mktime
 from urllib.parse import urlparse, urlencode
@@ -10,14 +18,156 @@ import hashlib
 import hmac
 import base64
 from config import Config
+from metrics import LatencyRecorder
+
+logger = logging.getLogger(__name__)
+
+
+class SparkError(Exception):
+    """星火接口调用失败（连接失败、超时或服务端返回错误码）"""
+
+
+# 会话结束标记
+_END = object()
+
+
+class SparkSession:
+    """
+    单次对话会话
+
+    每个请求独立持有自己的 WebSocket、响应队列和连接事件，互不共享状态；
+    等待连接、等待响应块都使用阻塞的 Event / Queue 加超时，不做忙等。
+    """
+
+    def __init__(self, url: str, connect_timeout: float = None, response_timeout: float = None):
+        """
+        初始化会话
+
+        Args:
+            url: 鉴权后的 WebSocket 地址
+            connect_timeout: 建立连接超时（秒）
+            response_timeout: 两个响应块之间的最长等待（秒）
+        """
+        self.connect_timeout = connect_timeout or Config.SPARK_CONNECT_TIMEOUT
+        self.response_timeout = response_timeout or Config.SPARK_RESPONSE_TIMEOUT
+        self._chunks: "queue.Queue" = queue.Queue()
+        self._opened = threading.Event()
+        self._closed = threading.Event()
+        self._ready = threading.Event()  # 连接成功或失败时置位
+        self._abandoned = threading.Event()  # 连接建立前被放弃，建立后立即关闭
+        self._ws = websocket.WebSocketApp(
+            url,
+            on_message=self._on_message,
+            on_error=self._on_error,
+            on_close=self._on_close,
+            on_open=self._on_open
+        )
+        self._thread = Thread(
+            target=self._ws.run_forever,
+            kwargs={"sslopt": {"cert_reqs": ssl.CERT_NONE}},
+            daemon=True
+        )
+
+    def _on_message(self, ws, message):
+        """处理返回消息"""
+        data = json.loads(message)
+        if data['header']['code'] != 0:
+            logger.error(f"星火接口返回错误: {data['header']['message']}")
+            self._chunks.put(SparkError(data['header']['message']))
+            ws.close()
+            return
+
+        for text in data["payload"]["choices"]["text"]:
+            self._chunks.put(text['content'])
+
+        if data['payload']['choices']['status'] == 2:
+            self._chunks.put(_END)
+            ws.close()
+
+    def _on_error(self, ws, error):
+        """处理WebSocket错误"""
+        logger.error(f"WebSocket error: {error}")
+        self._chunks.put(SparkError(str(error)))
+
+    def _on_close(self, ws, *args):
+        """处理WebSocket关闭（websocket-client 1.x 会额外传入状态码和原因）"""
+        logger.debug("WebSocket connection closed")
+        self._closed.set()
+        self._ready.set()
+        # 未正常结束就关闭时，唤醒等待方
+        self._chunks.put(SparkError("WebSocket connection closed"))
+
+    def _on_open(self, ws):
+        """处理WebSocket连接建立"""
+        logger.debug("WebSocket connection opened")
+        self._opened.set()
+        self._ready.set()
+        if self._abandoned.is_set():
+            ws.close()
+
+    def start(self):
+        """在后台线程开始建立连接（不等待，可重复调用）"""
+        if self._thread.ident is None:
+            self._thread.start()
+
+    def connect(self):
+        """建立连接（已在后台建立时只等待结果），超时或连接失败时抛出 SparkError"""
+        self.start()
+        if not self._ready.wait(self.connect_timeout):
+            self.close()
+            raise SparkError(f"连接星火接口超时（{self.connect_timeout}s）")
+        if not self._opened.is_set() or self._closed.is_set():
+            raise SparkError("连接星火接口失败")
+
+    def send(self, query: str):
+        """发送请求数据"""
+        self._ws.send(_build_payload(query))
+
+    def stream(self, query: str):
+        """等待连接就绪后发送请求，逐块返回响应"""
+        try:
+            self.connect()
+        except SparkError:
+            self.close()
+            raise
+        self.send(query)
+        yield from self.iter_chunks()
+
+    def iter_chunks(self):
+        """逐块返回响应，直到结束；出错或超时抛出 SparkError"""
+        try:
+            while True:
+                try:
+                    chunk = self._chunks.get(timeout=self.response_timeout)
+                except queue.Empty:
+                    raise SparkError(f"等待星火响应超时（{self.response_timeout}s）")
+                if chunk is _END:
+                    return
+                if isinstance(chunk, SparkError):
+                    raise chunk
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        """关闭连接（可重复调用）；连接仍在建立中时不阻塞，建立后由 _on_open 关闭"""
+        self._abandoned.set()
+        if self._thread.ident is not None and not self._ready.is_set():
+            return
+        if not self._closed.is_set():
+            try:
+                self._ws.close()
+            except Exception:
+                pass
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1)
 
 
 class SparkAPI:
     def __init__(self):
-        self.ws = None
-        self.response = ""
-        self.connected = False
-        self.chunks = []  # 用于存储流式响应的块
+        # 流式响应指标（毫秒）：首个响应块延迟（从 prepare_stream 算起）、相邻响应块间隔
+        self._ttft = LatencyRecorder()
+        self._inter_token = LatencyRecorder()
 
     def _create_url(self):
         """生成鉴权URL"""
@@ -39,105 +189,379 @@ class SparkAPI:
 
         return f"{Config.SPARK_URL}?{urlencode({'authorization': authorization, 'date': date, 'host': urlparse(Config.SPARK_URL).netloc})}"
 
-    def _on_message(self, ws, message):
-        """处理返回消息"""
-        data = json.loads(message)
-        if data['header']['code'] != 0:
-            print(f"Error: {data['header']['message']}")
-            return
+    def open_session(self) -> SparkSession:
+        """创建并连接一个新会话（每个请求独立）"""
+        session = SparkSession(self._create_url())
+        session.connect()
+        return session
 
-        for text in data["payload"]["choices"]["text"]:
-            chunk = text['content']
-            self.response += chunk
-            self.chunks.append(chunk)  # 存储每个响应块
+    def get_response(self, query: str) -> str:
+        """获取大模型回复"""
+        session = self.open_session()
+        session.send(query)
+        return "".join(session.iter_chunks())
 
-        if data['payload']['choices']['status'] == 2:
-            self.connected = False
-            ws.close()
+    def stream_response(self, query: str):
+        """流式获取大模型回复"""
+        yield from self.prepare_stream().stream(query)
 
-    def _on_error(self, ws, error):
-        """处理WebSocket错误"""
-        print("WebSocket error:", error)
-        self.connected = False
+    def prepare_stream(self, started: float = None) -> "PreparedStream":
+        """
+        提前建立流式会话：连接与鉴权在后台进行，调用方可同时做检索等准备工作，
+        拿到提示词后再调用 stream(prompt)
 
-    def _on_close(self, ws):
-        """处理WebSocket关闭"""
-        print("WebSocket connection closed")
-        self.connected = False
+        Args:
+            started: 请求开始时间（time.perf_counter()），用于统计首包延迟，默认为当前时间
+        """
+        session = SparkSession(self._create_url())
+        session.start()
+        return PreparedStream(self, session.stream, session.close, started)
 
-    def _on_open(self, ws):
-        """处理WebSocket连接建立"""
-        self.connected = True
-        print("WebSocket connection opened")
+    def _record_stream(self, chunks, started: float):
+        """透传响应块并记录首包延迟和块间隔"""
+        last = None
+        for chunk in chunks:
+            now = time.perf_counter()
+            if last is None:
+                self._ttft.record((now - started) * 1000)
+            else:
+                self._inter_token.record((now - last) * 1000)
+            last = now
+            yield chunk
 
-    def get_response(self, query: str) -> str:
-        """获取大模型回复"""
-        self.response = ""
-        self.chunks = []  # 清空块列表
+    def stream_stats(self) -> Dict:
+        """流式响应指标"""
+        return {"ttft_ms": self._ttft.snapshot(), "inter_token_ms": self._inter_token.snapshot()}
 
-        # 创建WebSocket连接
-        ws = websocket.WebSocketApp(
-            self._create_url(),
-            on_message=self._on_message,
-            on_error=self._on_error,
-            on_close=self._on_close,
-            on_open=self._on_open
+    def stats(self) -> Dict:
+        """返回客户端统计"""
+        return {"client": "thread", **self.stream_stats()}
+
+
+class PreparedStream:
+    """
+    已提前建立连接的流式会话（见 SparkAPI.prepare_stream）
+
+    stream(prompt) 只能调用一次；不再需要时（如检索无结果）调用 close() 释放连接。
+    """
+
+    def __init__(self, client: SparkAPI, stream, close, started: float = None):
+        self._client = client
+        self._stream = stream
+        self._close = close
+        self.started = started if started is not None else time.perf_counter()
+
+    def stream(self, query: str):
+        """发送请求并逐块返回响应，同时记录首包延迟和块间隔"""
+        yield from self._client._record_stream(self._stream(query), self.started)
+
+    def close(self):
+        """放弃会话，关闭已建立的连接"""
+        self._close()
+
+
+class _Reservation:
+    """prepare_stream 提前占用的并发名额与连接（只在事件循环线程上读写）"""
+
+    __slots__ = ("future", "held", "ws")
+
+    def __init__(self):
+        self.future: Optional[concurrent.futures.Future] = None  # 占用过程（_reserve）
+        self.held = False  # 是否占用了一个并发名额
+        self.ws = None     # 提前建立的连接
+
+
+def _build_payload(query: str) -> str:
+    """构造请求数据"""
+    return json.dumps({
+        "header": {"app_id": Config.SPARK_APPID, "uid": "1234"},
+        "parameter": {"chat": {"domain": Config.SPARK_DOMAIN, "temperature": 0.5}},
+        "payload": {"message": {"text": [{"role": "user", "content": query}]}}
+    })
+
+
+class AsyncSparkClient(SparkAPI):
+    """
+    基于 asyncio 的星火客户端
+
+    - 所有请求运行在同一个后台事件循环上，不再为每次调用创建线程
+    - 信号量限制同时进行的生成数（SPARK_MAX_CONCURRENCY），超出的请求排队等待；
+      prepare_stream 提前建立的连接同样占用名额，没有空闲名额时不提前建连
+    - 鉴权 URL 在有效期内缓存复用（SPARK_URL_TTL），避免每次重新计算 HMAC
+    - 后台预先建立若干连接（SPARK_PREWARM_CONNECTIONS），请求到来时直接取用；
+      星火服务端在一次回答结束后关闭连接，因此“复用”体现为预热连接池
+
+    对外保持与 SparkAPI 相同的同步接口：get_response / stream_response。
+    """
+
+    def __init__(self, max_concurrency: int = None, prewarm: int = None):
+        import websockets  # noqa: F401  未安装时由 get_spark_client 降级
+
+        super().__init__()
+        self.max_concurrency = max_concurrency or Config.SPARK_MAX_CONCURRENCY
+        self.prewarm = prewarm if prewarm is not None else Config.SPARK_PREWARM_CONNECTIONS
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_pid: Optional[int] = None
+        self._loop_lock = threading.Lock()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._idle: List[Tuple[object, float]] = []  # 预热连接 (ws, 建立时间)
+        self._refilling = False
+        self._url: Optional[str] = None
+        self._url_expires = 0.0
+        self._url_lock = threading.Lock()
+        self._in_flight = 0
+        self._stats = {"requests": 0, "errors": 0, "prewarmed_used": 0, "connections_opened": 0,
+                       "url_signed": 0, "prepare_skipped": 0}
+
+    # ---------- 事件循环 ----------
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """延迟启动后台事件循环（进程 fork 后重建）"""
+        pid = os.getpid()
+        if self._loop is not None and self._loop_pid == pid:
+            return self._loop
+        with self._loop_lock:
+            if self._loop is None or self._loop_pid != pid:
+                loop = asyncio.new_event_loop()
+                Thread(target=loop.run_forever, name="spark-async-loop", daemon=True).start()
+                self._loop = loop
+                self._loop_pid = pid
+                self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._idle = []
+                self._refilling = False
+                if self.prewarm > 0:
+                    asyncio.run_coroutine_threadsafe(self._refill(), loop)
+        return self._loop
+
+    def _run(self, coro) -> concurrent.futures.Future:
+        """把协程提交到后台事件循环"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    # ---------- 连接管理 ----------
+
+    def _signed_url(self) -> str:
+        """获取鉴权 URL（有效期内复用）"""
+        now = time.monotonic()
+        with self._url_lock:
+            if self._url is None or now >= self._url_expires:
+                self._url = self._create_url()
+                self._url_expires = now + Config.SPARK_URL_TTL
+                self._stats["url_signed"] += 1
+            return self._url
+
+    async def _open(self):
+        """建立新连接"""
+        import websockets
+
+        url = self._signed_url()
+        ssl_context = None
+        if url.startswith("wss://"):
+            ssl_context = ssl.create_default_context()
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        ws = await websockets.connect(
+            url, ssl=ssl_context, open_timeout=Config.SPARK_CONNECT_TIMEOUT, max_size=None
         )
+        self._stats["connections_opened"] += 1
+        return ws
 
-        # 启动WebSocket线程
-        ws_thread = Thread(target=ws.run_forever, kwargs={"sslopt": {"cert_reqs": ssl.CERT_NONE}})
-        ws_thread.start()
+    async def _refill(self):
+        """补齐预热连接"""
+        if self._refilling:
+            return
+        self._refilling = True
+        try:
+            while len(self._idle) < self.prewarm:
+                try:
+                    ws = await self._open()
+                except Exception as e:
+                    logger.warning(f"预热星火连接失败: {e}")
+                    return
+                self._idle.append((ws, time.monotonic()))
+        finally:
+            self._refilling = False
+
+    async def _acquire(self):
+        """取一个可用连接：优先使用未过期的预热连接，否则新建"""
+        now = time.monotonic()
+        while self._idle:
+            ws, opened_at = self._idle.pop(0)
+            if now - opened_at < Config.SPARK_IDLE_TTL and ws.close_code is None:
+                self._stats["prewarmed_used"] += 1
+                self._schedule_refill()
+                return ws, True
+            asyncio.ensure_future(ws.close())
+        self._schedule_refill()
+        return await self._open(), False
+
+    def _schedule_refill(self):
+        """后台补齐预热连接"""
+        if self.prewarm > 0:
+            asyncio.ensure_future(self._refill())
+
+    # ---------- 生成 ----------
+
+    async def _reserve(self, reservation: _Reservation):
+        """
+        提前占用一个并发名额并取连接（prepare_stream）
+
+        没有空闲名额时不占用也不建连，生成时再按常规排队，提前建立的连接数因此不超过 SPARK_MAX_CONCURRENCY；
+        建连失败时保留名额，生成时改为常规取连接
+        """
+        if self._semaphore.locked():
+            self._stats["prepare_skipped"] += 1
+            return
+        await self._semaphore.acquire()
+        reservation.held = True
+        try:
+            reservation.ws, _ = await self._acquire()
+        except Exception as e:
+            logger.warning(f"提前建立星火连接失败: {e}")
 
-        # 等待连接建立
-        while not self.connected:
+    async def _claim(self, reservation: Optional[_Reservation]) -> Tuple[bool, object]:
+        """认领提前占用的名额与连接，返回 (是否持有名额, 连接)；已被认领时返回 (False, None)"""
+        if reservation is None:
+            return False, None
+        try:
+            await asyncio.wrap_future(reservation.future)
+        except Exception:
             pass
+        held, ws = reservation.held, reservation.ws
+        reservation.held, reservation.ws = False, None
+        return held, ws
 
-        # 发送请求数据
-        data = json.dumps({
-            "header": {"app_id": Config.SPARK_APPID, "uid": "1234"},
-            "parameter": {"chat": {"domain": Config.SPARK_DOMAIN, "temperature": 0.5}},
-            "payload": {"message": {"text": [{"role": "user", "content": query}]}}
-        })
-        ws.send(data)
+    async def _release(self, reservation: _Reservation):
+        """放弃提前占用的名额与连接（已被生成认领时无操作）"""
+        held, ws = await self._claim(reservation)
+        if held:
+            self._semaphore.release()
+        if ws is not None:
+            await ws.close()
 
-        # 等待响应完成
-        ws_thread.join()
-        return self.response
+    async def _generate(self, query: str, on_chunk, reservation: _Reservation = None):
+        """
+        完成一次生成，每收到一个响应块调用 on_chunk(chunk)
+
+        预热连接（含 prepare_stream 提前建立的连接）可能已被服务端关闭，首包前失败时换新连接重试一次。
+        """
+        import websockets
+
+        held, reserved_ws = await self._claim(reservation)
+        if not held:
+            await self._semaphore.acquire()
+        try:
+            self._in_flight += 1
+            self._stats["requests"] += 1
+            try:
+                for attempt in range(2):
+                    if attempt == 0 and reserved_ws is not None and reserved_ws.close_code is None:
+                        ws, prewarmed = reserved_ws, True
+                    else:
+                        ws, prewarmed = await self._acquire()
+                    received = False
+                    try:
+                        await ws.send(_build_payload(query))
+                        while True:
+                            message = await asyncio.wait_for(ws.recv(), Config.SPARK_RESPONSE_TIMEOUT)
+                            data = json.loads(message)
+                            if data['header']['code'] != 0:
+                                raise SparkError(data['header']['message'])
+                            for text in data["payload"]["choices"]["text"]:
+                                received = True
+                                on_chunk(text['content'])
+                            if data['payload']['choices']['status'] == 2:
+                                return
+                    except websockets.ConnectionClosed as e:
+                        if prewarmed and not received and attempt == 0:
+                            continue
+                        raise SparkError(f"星火连接已关闭: {e}") from e
+                    except asyncio.TimeoutError as e:
+                        raise SparkError(f"等待星火响应超时（{Config.SPARK_RESPONSE_TIMEOUT}s）") from e
+                    finally:
+                        await ws.close()
+            except Exception:
+                self._stats["errors"] += 1
+                raise
+            finally:
+                self._in_flight -= 1
+        finally:
+            self._semaphore.release()
+
+    def get_response(self, query: str) -> str:
+        """获取大模型回复"""
+        chunks = []
+        future = self._run(self._generate(query, chunks.append))
+        try:
+            future.result()
+        except SparkError:
+            raise
+        except Exception as e:
+            raise SparkError(str(e)) from e
+        return "".join(chunks)
 
     def stream_response(self, query: str):
         """流式获取大模型回复"""
-        self.response = ""
-        self.chunks = []  # 清空块列表
+        yield from self._record_stream(self._stream(query), time.perf_counter())
 
-        # 创建WebSocket连接
-        ws = websocket.WebSocketApp(
-            self._create_url(),
-            on_message=self._on_message,
-            on_error=self._on_error,
-            on_close=self._on_close,
-            on_open=self._on_open
-        )
+    def prepare_stream(self, started: float = None) -> PreparedStream:
+        """
+        提前建立流式会话：在后台事件循环上占用一个并发名额并取预热连接或新建连接（含 TLS 握手与鉴权），
+        与调用方的检索并行；stream(prompt) 时直接使用该连接和名额
+        """
+        reservation = _Reservation()
+        reservation.future = self._run(self._reserve(reservation))
+        return PreparedStream(self, lambda query: self._stream(query, reservation),
+                              lambda: self._discard(reservation), started)
 
-        # 启动WebSocket线程
-        ws_thread = Thread(target=ws.run_forever, kwargs={"sslopt": {"cert_reqs": ssl.CERT_NONE}})
-        ws_thread.start()
+    def _discard(self, reservation: _Reservation):
+        """放弃提前占用的名额与连接（占用完成后释放；已被生成认领时无操作）"""
+        self._run(self._release(reservation))
 
-        # 等待连接建立
-        while not self.connected:
-            pass
+    def _stream(self, query: str, reservation: _Reservation = None):
+        """在后台事件循环上生成，逐块返回"""
+        chunks: "queue.Queue" = queue.Queue()
+        future = self._run(self._generate(query, chunks.put, reservation))
+        future.add_done_callback(lambda _: chunks.put(_END))
+        try:
+            while True:
+                try:
+                    chunk = chunks.get(timeout=Config.SPARK_RESPONSE_TIMEOUT)
+                except queue.Empty:
+                    raise SparkError(f"等待星火响应超时（{Config.SPARK_RESPONSE_TIMEOUT}s）")
+                if chunk is _END:
+                    break
+                yield chunk
+            error = future.exception()
+            if error is not None:
+                raise error if isinstance(error, SparkError) else SparkError(str(error))
+        finally:
+            if not future.done():
+                future.cancel()
+            if reservation is not None:
+                # 生成被取消时提前占用的名额与连接可能尚未被认领，确保释放
+                self._discard(reservation)
+
+    def stats(self) -> Dict:
+        """返回客户端统计"""
+        return {
+            "client": "async",
+            "in_flight": self._in_flight,
+            "max_concurrency": self.max_concurrency,
+            "idle_connections": len(self._idle),
+            **self._stats,
+            **self.stream_stats(),
+        }
+
+
+def get_spark_client() -> SparkAPI:
+    """
+    按配置创建星火客户端
 
-        # 发送请求数据
-        data = json.dumps({
-            "header": {"app_id": Config.SPARK_APPID, "uid": "1234"},
-            "parameter": {"chat": {"domain": Config.SPARK_DOMAIN, "temperature": 0.5}},
-            "payload": {"message": {"text": [{"role": "user", "content": query}]}}
-        })
-        ws.send(data)
-
-        # 流式返回响应块
-        while self.connected or self.chunks:
-            if self.chunks:
-                yield self.chunks.pop(0)
-
-        # 等待响应完成
-        ws_thread.join()
\ No newline at end of file
+    SPARK_CLIENT=async（默认）使用 AsyncSparkClient，未安装 websockets 时降级为线程版 SparkAPI
+    """
+    if Config.SPARK_CLIENT == "async":
+        try:
+            return AsyncSparkClient()
+        except ImportError:
+            logger.warning("websockets 未安装，星火客户端降级为线程模式: pip install websockets")
+    return SparkAPI()
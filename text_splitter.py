@@ -3,45 +3,161 @@
 提供多种分块策略：字符分块、语义分块、混合分块
 """
 import logging
-from typing import List, Optional
+import re
+from typing import List, Optional, Tuple
+
+import numpy as np
 
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
-from langchain_huggingface import HuggingFaceEmbeddings
 
 from config import Config
+from embedding_service import get_embedding_service
 
 logger = logging.getLogger(__name__)
 
 # 全局单例
+_char_splitter = None
 _semantic_splitter = None
 _hybrid_splitter = None
 
 
-def get_char_splitter() -> RecursiveCharacterTextSplitter:
+# 字符分块的分隔符，按优先级排列（"" 表示最后按字符切）
+CHUNK_SEPARATORS = [
+    "\n\n",              # 1. 段落分隔
+    "\n",                # 2. 换行
+    "。",                # 3. 句号
+    "！",                # 4. 感叹号
+    "？",                # 5. 问号
+    "；",                # 6. 分号
+    "……",               # 7. 省略号
+    "...",               # 8. 英文省略号
+    "，",                # 9. 逗号
+    " ",                 # 10. 空格
+    ""                   # 11. 字符
+]
+
+
+class CharTextSplitter:
     """
-    获取字符分块器
+    线性时间的中文字符分块器
+    
+    与 RecursiveCharacterTextSplitter 使用相同的分隔符优先级和 chunk_size / chunk_overlap 语义，
+    但不逐级递归切分整篇文本、也不生成中间片段，而是从头到尾逐窗口推进：
+    - 每个块在 (起点, 起点 + chunk_size] 内选优先级最高的分隔符中最靠后的一个作为终点
+      （str.rfind 只扫描当前窗口），没有任何分隔符时按字符切
+    - 下一块从 [终点 - chunk_overlap, 终点) 内不低于该优先级的最靠前的分隔符处开始，
+      即重叠部分尽量是完整的句子/段落，且不超过 chunk_overlap
+    - 分隔符（标点）保留在前一块的末尾，而不是下一块的开头
+    """
+    
+    def __init__(self, chunk_size: int = None, chunk_overlap: int = None,
+                 separators: List[str] = None):
+        """
+        Args:
+            chunk_size: 每块最大字符数，默认 Config.CHUNK_SIZE
+            chunk_overlap: 块之间最大重叠字符数，默认 Config.CHUNK_OVERLAP
+            separators: 分隔符优先级列表，默认 CHUNK_SEPARATORS
+        """
+        self.chunk_size = chunk_size or Config.CHUNK_SIZE
+        self.chunk_overlap = chunk_overlap if chunk_overlap is not None else Config.CHUNK_OVERLAP
+        if self.chunk_overlap >= self.chunk_size:
+            raise ValueError(f"chunk_overlap ({self.chunk_overlap}) 必须小于 chunk_size ({self.chunk_size})")
+        self.separators = [sep for sep in (separators or CHUNK_SEPARATORS) if sep]
+    
+    def _spans(self, text: str) -> List[Tuple[int, int]]:
+        """计算各块在原文中的 (起, 止) 位置"""
+        separators = self.separators
+        length = len(text)
+        spans = []
+        start = end = 0
+        while start < length:
+            limit = start + self.chunk_size
+            if limit >= length:
+                spans.append((start, length))
+                break
+            
+            # 终点：窗口内（且在上一块终点之后）优先级最高的分隔符中最靠后的一个
+            previous_end = end
+            end, level = limit, len(separators)
+            for lv, sep in enumerate(separators):
+                i = text.rfind(sep, max(start, previous_end - len(sep) + 1), limit)
+                if i >= 0:
+                    end, level = i + len(sep), lv
+                    break
+            spans.append((start, end))
+            
+            # 下一块起点：重叠区间 [floor, end) 内不低于该优先级的分隔符中最靠前的边界（与分隔符顺序无关）
+            floor = max(start + 1, end - self.chunk_overlap)
+            boundaries = []
+            for sep in separators[:level + 1]:
+                i = text.find(sep, max(0, floor - len(sep)), end - 1)
+                if i >= 0:
+                    boundaries.append(i + len(sep))
+            if boundaries:
+                start = min(boundaries)
+            else:
+                start = end if level < len(separators) else floor
+        return spans
+    
+    def split_text(self, text: str) -> List[str]:
+        """切分文本，返回去掉首尾空白的非空块"""
+        chunks = []
+        for start, end in self._spans(text):
+            chunk = text[start:end].strip()
+            if chunk:
+                chunks.append(chunk)
+        return chunks
+    
+    def split_documents(self, documents: List[Document]) -> List[Document]:
+        """切分文档列表，每个块复制原文档的 metadata"""
+        chunks = []
+        for doc in documents:
+            for chunk in self.split_text(doc.page_content):
+                chunks.append(Document(page_content=chunk, metadata=dict(doc.metadata or {})))
+        return chunks
+
+
+def get_char_splitter() -> CharTextSplitter:
+    """
+    获取字符分块器单例
     
     特点：快速、无额外依赖
     """
-    return RecursiveCharacterTextSplitter(
-        chunk_size=Config.CHUNK_SIZE,
-        chunk_overlap=Config.CHUNK_OVERLAP,
-        length_function=len,
-        separators=[
-            "\n\n",              # 1. 段落分隔
-            "\n",                # 2. 换行
-            "。",                # 3. 句号
-            "！",                # 4. 感叹号
-            "？",                # 5. 问号
-            "；",                # 6. 分号
-            "……",               # 7. 省略号
-            "...",               # 8. 英文省略号
-            "，",                # 9. 逗号
-            " ",                 # 10. 空格
-            ""                   # 11. 字符
-        ]
-    )
+    global _char_splitter
+    if _char_splitter is None:
+        _char_splitter = CharTextSplitter()
+    return _char_splitter
+
+
+# 句末：中文句末标点（连续的算一个，如 "？！"、"……"）或后接空白的英文句号，
+# 连同其后的右引号/右括号；换行也视为句子边界
+_SENTENCE_END_RE = re.compile(r'(?:[。！？!?；;…]+|\.(?=\s|$))[”’」』）)】》"\']*|\n+')
+
+
+def split_sentences(text: str) -> List[Tuple[int, int]]:
+    """
+    中文句子切分
+
+    Returns:
+        各句在原文中的 (起, 止) 位置（已去掉首尾空白），按原文顺序
+    """
+    spans = []
+    start = 0
+    for match in _SENTENCE_END_RE.finditer(text):
+        _append_span(spans, text, start, match.end())
+        start = match.end()
+    _append_span(spans, text, start, len(text))
+    return spans
+
+
+def _append_span(spans: list, text: str, start: int, end: int):
+    """去掉首尾空白后记录非空句子"""
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    if start < end:
+        spans.append((start, end))
 
 
 class SemanticTextSplitter:
@@ -50,11 +166,17 @@ class SemanticTextSplitter:
     
     原理：计算相邻句子的嵌入相似度，在相似度低的地方切分
     优点：保持语义完整性
-    缺点：需要额外计算嵌入向量，速度较慢
+    
+    实现要点：
+    - 全部句子一次批量向量化（经共享嵌入服务）
+    - 相邻句窗口（前后各一句）的向量直接由句向量相加得到，不再额外调用模型
+    - 断点阈值用 NumPy 向量化计算
+    - 块向量由句向量按长度加权平均得到（单句块直接复用句向量），
+      入库时无需再次调用模型
     """
     
     def __init__(self, breakpoint_threshold_type: str = "percentile",
-                 breakpoint_threshold_amount: float = 0.5):
+                 breakpoint_threshold_amount: float = 0.5, pool_vectors: bool = None):
         """
         初始化语义分块器
         
@@ -64,44 +186,81 @@ class SemanticTextSplitter:
                 - "standard_deviation": 标准差
                 - "interquartile": 四分位距
             breakpoint_threshold_amount: 阈值大小，越小切分越细
+            pool_vectors: 多句块是否使用句向量池化结果作为块向量，
+                默认 Config.SEMANTIC_POOL_VECTORS；False 时多句块入库时重新向量化
         """
+        if breakpoint_threshold_type not in ("percentile", "standard_deviation", "interquartile"):
+            raise ValueError(f"不支持的断点阈值类型: {breakpoint_threshold_type}")
         self.breakpoint_threshold_type = breakpoint_threshold_type
         self.breakpoint_threshold_amount = breakpoint_threshold_amount
-        self._splitter = None
-        self._initialized = False
+        self.pool_vectors = pool_vectors if pool_vectors is not None else Config.SEMANTIC_POOL_VECTORS
     
-    def _lazy_init(self):
-        """延迟初始化"""
-        if self._initialized:
-            return
+    def _threshold(self, distances: np.ndarray) -> float:
+        """断点阈值（语义距离超过该值处切分）"""
+        amount = self.breakpoint_threshold_amount
+        if self.breakpoint_threshold_type == "percentile":
+            return float(np.percentile(distances, amount))
+        if self.breakpoint_threshold_type == "standard_deviation":
+            return float(distances.mean() + amount * distances.std())
+        q1, q3 = np.percentile(distances, [25, 75])
+        return float(distances.mean() + amount * (q3 - q1))
+    
+    def split_with_vectors(self, text: str, metadata: dict = None
+                           ) -> Tuple[List[Document], List[Optional[List[float]]]]:
+        """
+        切分文本并给出块向量
         
-        try:
-            from langchain_experimental.text_splitter import SemanticChunker
-            
-            embeddings = HuggingFaceEmbeddings(model_name=Config.EMBEDDING_MODEL)
-            self._splitter = SemanticChunker(
-                embeddings=embeddings,
-                breakpoint_threshold_type=self.breakpoint_threshold_type,
-                breakpoint_threshold_amount=self.breakpoint_threshold_amount
-            )
-            self._initialized = True
-            logger.info("语义分块器初始化完成")
-            
-        except ImportError as e:
-            raise ImportError(
-                "语义分块需要安装 langchain-experimental: "
-                "pip install langchain-experimental>=0.0.47"
-            ) from e
+        Returns:
+            (文档列表, 等长的块向量列表)；pool_vectors=False 时多句块的向量为 None
+        """
+        spans = split_sentences(text)
+        if not spans:
+            return [], []
+        
+        sentences = [text[start:end] for start, end in spans]
+        vectors = np.asarray(get_embedding_service().embed_documents(sentences), dtype=np.float32)
+        
+        # 相邻句距离：每句与前后各一句的向量之和作为窗口向量，比较相邻窗口的余弦距离
+        breakpoints = []
+        if len(sentences) > 1:
+            padded = np.pad(vectors, ((1, 1), (0, 0)))
+            windows = padded[:-2] + padded[1:-1] + padded[2:]
+            windows /= np.maximum(np.linalg.norm(windows, axis=1, keepdims=True), 1e-12)
+            distances = 1.0 - np.einsum("ij,ij->i", windows[:-1], windows[1:])
+            breakpoints = np.flatnonzero(distances > self._threshold(distances)).tolist()
+        
+        bounds = [0] + [i + 1 for i in breakpoints] + [len(sentences)]
+        lengths = np.array([end - start for start, end in spans], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1)
+        documents, chunk_vectors = [], []
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            # 块文本取原文片段，保留句间的标点与换行
+            content = text[spans[first][0]:spans[last - 1][1]]
+            documents.append(Document(page_content=content, metadata=dict(metadata or {})))
+            if last - first == 1:
+                chunk_vectors.append(vectors[first].tolist())
+            elif self.pool_vectors:
+                weights = lengths[first:last] / lengths[first:last].sum()
+                pooled = weights @ vectors[first:last]
+                # 保持与句向量相同的模长（归一化模型即单位向量）
+                pooled *= (weights @ norms[first:last]) / max(float(np.linalg.norm(pooled)), 1e-12)
+                chunk_vectors.append(pooled.tolist())
+            else:
+                chunk_vectors.append(None)
+        
+        logger.debug(f"语义分块: {len(sentences)} 句 -> {len(documents)} 块")
+        return documents, chunk_vectors
     
     def split_text(self, text: str) -> List[str]:
         """切分文本，返回字符串列表"""
-        self._lazy_init()
-        return self._splitter.split_text(text)
+        return [doc.page_content for doc in self.split_with_vectors(text)[0]]
     
     def split_documents(self, documents: List[Document]) -> List[Document]:
         """切分文档列表"""
-        self._lazy_init()
-        return self._splitter.split_documents(documents)
+        chunks = []
+        for doc in documents:
+            chunks.extend(self.split_with_vectors(doc.page_content, doc.metadata)[0])
+        return chunks
 
 
 class HybridTextSplitter:
@@ -117,23 +276,11 @@ class HybridTextSplitter:
     def __init__(self):
         self._char_splitter = get_char_splitter()
         self._semantic_splitter = None
-        self._semantic_available = None
     
-    def _get_semantic_splitter(self) -> Optional[SemanticTextSplitter]:
-        """获取语义分块器（带缓存和可用性检查）"""
-        if self._semantic_available is False:
-            return None
-        
+    def _get_semantic_splitter(self) -> SemanticTextSplitter:
+        """获取语义分块器（与 get_semantic_splitter 共用单例）"""
         if self._semantic_splitter is None:
-            try:
-                self._semantic_splitter = SemanticTextSplitter()
-                self._semantic_splitter._lazy_init()  # 触发初始化检查
-                self._semantic_available = True
-            except ImportError:
-                logger.warning("语义分块依赖未安装，混合模式将仅使用字符分块")
-                self._semantic_available = False
-                return None
-        
+            self._semantic_splitter = get_semantic_splitter()
         return self._semantic_splitter
     
     def split_text(self, text: str, metadata: dict = None) -> List[Document]:
@@ -147,34 +294,38 @@ class HybridTextSplitter:
         Returns:
             分块后的文档列表
         """
+        return self.split_with_vectors(text, metadata)[0]
+    
+    def split_with_vectors(self, text: str, metadata: dict = None
+                           ) -> Tuple[List[Document], List[Optional[List[float]]]]:
+        """
+        根据文本特征选择分块策略，并给出已知的块向量
+        
+        Returns:
+            (文档列表, 等长的块向量列表)；只有语义分块的块带向量，其余为 None
+        """
         text_len = len(text)
         min_chunk_length = getattr(Config, 'MIN_CHUNK_LENGTH', 300)
         
         # 短文本：不分块
         if text_len < min_chunk_length:
             logger.debug(f"短文本不分块: {text_len} < {min_chunk_length}")
-            return [Document(page_content=text, metadata=metadata or {})]
-        
-        # 中等文本（<1000字）：字符分块（速度优先）
-        if text_len < 1000:
-            logger.debug(f"中等文本使用字符分块: {text_len}")
-            doc = Document(page_content=text, metadata=metadata or {})
-            return self._char_splitter.split_documents([doc])
+            return [Document(page_content=text, metadata=metadata or {})], [None]
         
         # 长文本（>=1000字）：尝试语义分块（质量优先）
-        semantic_splitter = self._get_semantic_splitter()
-        if semantic_splitter:
+        if text_len >= 1000:
             try:
                 logger.debug(f"长文本使用语义分块: {text_len}")
-                doc = Document(page_content=text, metadata=metadata or {})
-                return semantic_splitter.split_documents([doc])
+                return self._get_semantic_splitter().split_with_vectors(text, metadata)
             except Exception as e:
                 logger.warning(f"语义分块失败，降级到字符分块: {e}")
+        else:
+            # 中等文本（<1000字）：字符分块（速度优先）
+            logger.debug(f"中等文本使用字符分块: {text_len}")
         
-        # 降级：字符分块
-        logger.debug(f"降级到字符分块: {text_len}")
         doc = Document(page_content=text, metadata=metadata or {})
-        return self._char_splitter.split_documents([doc])
+        chunks = self._char_splitter.split_documents([doc])
+        return chunks, [None] * len(chunks)
 
 
 def get_semantic_splitter() -> SemanticTextSplitter:
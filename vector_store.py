@@ -1,65 +1,602 @@
+import hashlib
+import heapq
 import os
+import re
+import threading
+import time
+import uuid
+import zlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，upsert 只在进程内串行
+    fcntl = None
 
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
 from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
 
+from chroma_client import get_chroma_backend
 from config import Config
+from embedding_service import get_embedding_service
+from metrics import LatencyRecorder
+from text_splitter import get_char_splitter
 
 logger = logging.getLogger(__name__)
 
+# 数据变更监听器：listener(event, ids, documents)，event 为 "add" 或 "delete"
+_change_listeners = []
+
+# upsert 按 key 分段加锁，同一 key 的并发更新串行执行（进程内线程锁 + 本机跨进程文件锁）
+_upsert_locks = [threading.Lock() for _ in range(64)]
+
+# 分片集合名（单集合 "comment" 或 comment_0 ... comment_{N-1}）
+_SHARD_NAME_RE = re.compile(r"^comment(_\d+)?$")
+
+# reshard.py 的迁移进度集合，存在时说明迁移未完成
+RESHARD_STATE = "reshard_state"
+
+
+class ShardLayoutError(RuntimeError):
+    """已有数据的分片布局与当前 SHARD_* 配置不一致（需先运行 reshard.py 迁移）"""
+
+
+def shard_layout(count: int, strategy: str, key: str) -> Dict:
+    """分片布局，写入各分片集合的 metadata，启动时据此校验配置"""
+    return {"shard_count": count, "shard_strategy": strategy, "shard_key": key}
+
+
+def shard_names(count: int) -> List[str]:
+    """分片集合名：1 个分片时为 "comment"（兼容已有数据），否则为 comment_0 ... comment_{N-1}"""
+    return ["comment"] if count == 1 else [f"comment_{i}" for i in range(count)]
+
+
+def is_shard_collection(name: str) -> bool:
+    """是否为分片集合名（任意分片数）"""
+    return bool(_SHARD_NAME_RE.match(name))
+
+
+def shard_for(doc_id: str, metadata: dict, count: int, strategy: str, key: str) -> int:
+    """文档所在分片（VectorStore 与 reshard.py 共用的路由规则）"""
+    if count == 1:
+        return 0
+    value = metadata[key] if strategy == "key" and metadata and key in metadata else doc_id
+    return zlib.crc32(str(value).encode("utf-8")) % count
+
+
+def _same_layout(stored: dict, layout: dict) -> bool:
+    """布局是否一致（单集合时路由与策略无关，只比较分片数）"""
+    if stored.get("shard_count") != layout["shard_count"]:
+        return False
+    return layout["shard_count"] == 1 or all(stored.get(key) == value for key, value in layout.items())
+
 
 class VectorStore:
+    """
+    向量库（Chroma 集合分片）
+
+    SHARD_COUNT=1 时只有一个集合 "comment"，与已有数据兼容；
+    SHARD_COUNT>1 时数据分布到 comment_0 ... comment_{N-1}：
+    - key 策略：按 metadata[SHARD_KEY] 的哈希路由，同一内容的所有块落在同一分片，
+      带该字段等值/$in 过滤的查询只访问相关分片
+    - hash 策略：按文档 ID 哈希均匀分布，查询访问全部分片
+
+    检索时向相关分片并发查询，再按距离合并 top-k。
+    对外保留 similarity_search_with_score / get 等 Chroma 同名方法。
+
+    分片布局（分片数、策略、分片键）记录在各分片集合的 metadata 中。启动时若其他布局的集合里还有数据，
+    或记录的布局与配置不同，抛出 ShardLayoutError 拒绝启动：修改 SHARD_* 后需先用 reshard.py 迁移。
+    """
     _instance = None
 
     def __new__(cls):
         if not cls._instance:
-            embeddings = HuggingFaceEmbeddings(model_name=Config.EMBEDDING_MODEL)
-            cls._instance = Chroma(
-                collection_name="comment",
-                embedding_function=embeddings,
-                persist_directory=Config.VECTOR_DIR
-            )
+            instance = super().__new__(cls)
+            instance._setup()
+            cls._instance = instance
         return cls._instance
 
+    def _setup(self):
+        """创建各分片集合"""
+        self.shard_count = max(1, Config.SHARD_COUNT)
+        self.strategy = Config.SHARD_STRATEGY
+        self.shard_key = Config.SHARD_KEY
+        self.names = shard_names(self.shard_count)
+        # http 模式下所有分片共用一个客户端（一个连接池）；向量始终在本地计算后传给 Chroma
+        self.backend = get_chroma_backend()
+        if self.backend is not None:
+            location = {"client": self.backend.client}
+        else:
+            location = {"persist_directory": Config.VECTOR_DIR}
+        self.shards = [
+            Chroma(
+                collection_name=name,
+                embedding_function=get_embedding_service(),
+                **location
+            )
+            for name in self.names
+        ]
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pool_pid: Optional[int] = None
+        self._stats_lock = threading.Lock()
+        self._searches = [0] * self.shard_count
+        self._latency = [LatencyRecorder() for _ in self.shards]
+        self._fanout_latency = LatencyRecorder()
+        self._check_layout()
+        logger.info(f"向量库分片: {self.names}，策略 {self.strategy}，分片键 {self.shard_key}")
+
+    def _check_layout(self):
+        """校验已有数据的分片布局，未记录布局的分片集合补写当前布局"""
+        layout = shard_layout(self.shard_count, self.strategy, self.shard_key)
+        client = self.shards[0]._client
+        for collection in client.list_collections():
+            name = getattr(collection, "name", collection)
+            if name == RESHARD_STATE:
+                raise ShardLayoutError("分片迁移尚未完成，请先重新运行 python reshard.py 完成迁移")
+            if name in self.names or not is_shard_collection(name):
+                continue
+            count = client.get_collection(name).count()
+            if count:
+                raise ShardLayoutError(
+                    f"集合 {name} 中还有 {count} 条数据，不属于当前分片布局 {self.names}；"
+                    f"请先运行 python reshard.py 迁移，或恢复原来的 SHARD_COUNT"
+                )
+        for name, shard in zip(self.names, self.shards):
+            collection = shard._collection
+            metadata = collection.metadata or {}
+            stored = {key: metadata[key] for key in layout if key in metadata}
+            if not stored:
+                # 修改距离函数等 hnsw 参数不被允许，只补写布局字段
+                kept = {key: value for key, value in metadata.items() if not key.startswith("hnsw:")}
+                collection.modify(metadata={**kept, **layout})
+            elif not _same_layout(stored, layout):
+                raise ShardLayoutError(
+                    f"集合 {name} 按 {stored} 写入，与当前配置 {layout} 不一致，"
+                    f"请先运行 python reshard.py 迁移，或恢复原来的 SHARD_* 配置"
+                )
+
+    # ---------- 路由 ----------
+
+    def _hash(self, value) -> int:
+        return zlib.crc32(str(value).encode("utf-8")) % self.shard_count
+
+    def shard_of(self, doc_id: str, metadata: dict = None) -> int:
+        """文档所在分片"""
+        return shard_for(doc_id, metadata, self.shard_count, self.strategy, self.shard_key)
+
+    def shards_for(self, filter: dict = None) -> List[int]:
+        """查询需要访问的分片（key 策略下根据过滤条件中的分片键裁剪）"""
+        if self.shard_count == 1 or self.strategy != "key":
+            return list(range(self.shard_count))
+        values = _routing_values(filter, self.shard_key)
+        if values is None:
+            return list(range(self.shard_count))
+        return sorted({self._hash(value) for value in values})
+
+    # ---------- 查询 ----------
+
+    def _executor(self) -> ThreadPoolExecutor:
+        """分片检索线程池（延迟创建，进程 fork 后重建：子进程继承不到父进程的线程）"""
+        pid = os.getpid()
+        if self._pool is None or self._pool_pid != pid:
+            with self._stats_lock:
+                if self._pool is None or self._pool_pid != pid:
+                    self._pool = ThreadPoolExecutor(max_workers=self.shard_count,
+                                                    thread_name_prefix="shard-search")
+                    self._pool_pid = pid
+        return self._pool
+
+    def _search_shard(self, shard: int, embedding: list, k: int, filter: dict = None):
+        started = time.perf_counter()
+        hits = self.shards[shard].similarity_search_by_vector_with_relevance_scores(
+            embedding, k=k, filter=filter
+        )
+        self._latency[shard].record((time.perf_counter() - started) * 1000)
+        with self._stats_lock:
+            self._searches[shard] += 1
+        return hits
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: dict = None,
+                                     embedding: list = None) -> List[Tuple[Document, float]]:
+        """
+        向相关分片并发检索并合并 top-k
+
+        Args:
+            embedding: 可选，调用方已计算的查询向量（不再重复向量化 query）
+
+        Returns:
+            [(文档, L2 距离)]，按距离升序
+        """
+        targets = self.shards_for(filter)
+        if not targets:
+            return []
+        if embedding is None:
+            embedding = get_embedding_service().embed_query(query)
+        if len(targets) == 1:
+            return self._search_shard(targets[0], embedding, k, filter)
+
+        started = time.perf_counter()
+        futures = [self._executor().submit(self._search_shard, shard, embedding, k, filter) for shard in targets]
+        hits = [hit for future in futures for hit in future.result()]
+        self._fanout_latency.record((time.perf_counter() - started) * 1000)
+        return heapq.nsmallest(k, hits, key=lambda x: x[1])
+
+    def locate(self, where: dict = None, ids: list = None, include: list = None,
+               limit: int = None) -> List[Tuple[int, dict]]:
+        """
+        在相关分片中查询，按分片返回 [(分片序号, 查询结果)]
+
+        include 默认为空（只取 ID）；limit 为全部分片合计的最多条数，取够后不再查询后续分片
+        """
+        results = []
+        for shard in self.shards_for(where):
+            page = self.shards[shard]._collection.get(
+                ids=ids, where=where, include=include if include is not None else [], limit=limit
+            )
+            if page["ids"]:
+                results.append((shard, page))
+                if limit is not None:
+                    limit -= len(page["ids"])
+                    if limit <= 0:
+                        break
+        return results
+
+    def get(self, ids: list = None, where: dict = None, include: list = None, limit: int = None) -> Dict:
+        """跨分片 get，合并为 {"ids", "documents", "metadatas", "embeddings"}"""
+        merged = {"ids": [], "documents": [], "metadatas": [], "embeddings": []}
+        for _, page in self.locate(where=where, ids=ids, include=include, limit=limit):
+            for field in merged:
+                if page.get(field) is not None:
+                    merged[field].extend(page[field])
+        return merged
+
+    def count(self) -> int:
+        """全部分片的文档数"""
+        return sum(shard._collection.count() for shard in self.shards)
+
+    def stats(self) -> Dict:
+        """分片统计（文档数、检索次数、延迟）"""
+        with self._stats_lock:
+            searches = list(self._searches)
+        return {
+            "backend": self.backend.stats() if self.backend else {"mode": "local", "path": Config.VECTOR_DIR},
+            "strategy": self.strategy,
+            "shard_key": self.shard_key,
+            "shard_count": self.shard_count,
+            "fanout_ms": self._fanout_latency.snapshot(),
+            "shards": [
+                {
+                    "name": name,
+                    "documents": shard._collection.count(),
+                    "searches": searches[i],
+                    "latency_ms": self._latency[i].snapshot(),
+                }
+                for i, (name, shard) in enumerate(zip(self.names, self.shards))
+            ],
+        }
+
+
+def _routing_values(filter: dict, key: str) -> Optional[set]:
+    """从 where 条件中提取分片键的取值集合，无法确定时返回 None（访问全部分片）"""
+    if not isinstance(filter, dict):
+        return None
+    if key in filter:
+        condition = filter[key]
+        if not isinstance(condition, dict):
+            return {condition}
+        if "$eq" in condition:
+            return {condition["$eq"]}
+        if "$in" in condition:
+            return set(condition["$in"])
+        return None
+    if "$and" in filter:
+        result = None
+        for clause in filter["$and"]:
+            values = _routing_values(clause, key)
+            if values is not None:
+                result = values if result is None else result & values
+        return result
+    if "$or" in filter:
+        result = set()
+        for clause in filter["$or"]:
+            values = _routing_values(clause, key)
+            if values is None:
+                return None
+            result |= values
+        return result
+    return None
+
 
 def get_text_splitter():
     """
-    获取优化后的文本分割器
-    
-    优化点：
-    1. chunk_size 从 200 增大到 500（约 250 汉字），保持语义完整性
-    2. chunk_overlap 从 50 增大到 100，更好的上下文连贯
-    3. 修复分隔符，添加完整的中文标点支持
-    """
-    return RecursiveCharacterTextSplitter(
-        chunk_size=Config.CHUNK_SIZE,
-        chunk_overlap=Config.CHUNK_OVERLAP,
-        length_function=len,
-        separators=[
-            "\n\n",              # 1. 段落分隔（最高优先级）
-            "\n",                # 2. 换行
-            "。",                # 3. 句号
-            "！",                # 4. 感叹号
-            "？",                # 5. 问号
-            "；",                # 6. 分号
-            "……",               # 7. 省略号
-            "...",               # 8. 英文省略号
-            "，",                # 9. 逗号（尽量不在此处切）
-            " ",                 # 10. 空格
-            ""                   # 11. 最后按字符切
-        ]
-    )
+    获取字符分块器（CHUNK_SIZE / CHUNK_OVERLAP，中文标点优先级见 text_splitter.CHUNK_SEPARATORS）
 
+    单例，线性时间切分，见 text_splitter.CharTextSplitter
+    """
+    return get_char_splitter()
 
-def delete_text_by_metadata(filter: dict):
-    """根据元数据删除文本"""
-    vector_store = VectorStore()
-    results = vector_store.get(where=filter)
-    if results and "ids" in results:
-        vector_store.delete(ids=results["ids"])
+
+def add_change_listener(listener):
+    """
+    注册数据变更监听器（缓存失效、索引维护等）
+
+    写入后回调 listener("add", ids, documents)，删除后回调 listener("delete", ids, None)
+    """
+    _change_listeners.append(listener)
+
+
+def _notify_change(event: str, ids: list, documents: list = None):
+    """通知监听器，监听器异常不影响主流程"""
+    for listener in _change_listeners:
+        try:
+            listener(event, ids, documents)
+        except Exception as e:
+            logger.warning(f"数据变更监听器执行失败: {e}")
+
+
+def fill_vectors(documents: list, vectors: list = None) -> list:
+    """
+    补全文档向量：vectors 中为 None 的（或未提供 vectors 时全部）一次批量经嵌入服务计算
+
+    Returns:
+        与 documents 等长的向量列表
+    """
+    vectors = list(vectors) if vectors is not None else [None] * len(documents)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        embedded = get_embedding_service().embed_documents([documents[i].page_content for i in missing])
+        for i, vector in zip(missing, embedded):
+            vectors[i] = vector
+    return vectors
+
+
+def store_documents(documents: list, vectors: list = None) -> list:
+    """
+    写入文档并通知监听器，返回文档 ID 列表
+
+    Args:
+        documents: 文档列表
+        vectors: 可选，分块时已得到的块向量（None 项经嵌入服务计算）
+    """
+    if not documents:
+        return []
+    return add_embedded_documents(documents, fill_vectors(documents, vectors))
+
+
+def add_embedded_documents(documents: list, embeddings: list, ids: list = None) -> list:
+    """
+    写入已计算好向量的文档（跳过 Chroma 内部的向量化），按分片分组写入
+
+    Returns:
+        写入的文档 ID 列表
+    """
+    if not documents:
+        return []
+    ids = ids or [str(uuid.uuid4()) for _ in documents]
+    store = VectorStore()
+
+    groups: Dict[int, List[int]] = {}
+    for i, doc in enumerate(documents):
+        groups.setdefault(store.shard_of(ids[i], doc.metadata), []).append(i)
+    for shard, indexes in groups.items():
+        _upsert(
+            store.shards[shard]._collection,
+            [documents[i] for i in indexes],
+            [embeddings[i] for i in indexes],
+            [ids[i] for i in indexes]
+        )
+    _notify_change("add", ids, documents)
+    return ids
+
+
+def _upsert(collection, documents: list, embeddings: list, ids: list):
+    """
+    写入单个集合
+
+    与 Chroma.add_texts 的写入方式一致：有元数据和无元数据的文档分两次 upsert，
+    避免空 metadata 被 Chroma 拒绝。
+    """
+    with_meta = [i for i, doc in enumerate(documents) if doc.metadata]
+    without_meta = [i for i, doc in enumerate(documents) if not doc.metadata]
+    if with_meta:
+        collection.upsert(
+            ids=[ids[i] for i in with_meta],
+            embeddings=[embeddings[i] for i in with_meta],
+            documents=[documents[i].page_content for i in with_meta],
+            metadatas=[documents[i].metadata for i in with_meta]
+        )
+    if without_meta:
+        collection.upsert(
+            ids=[ids[i] for i in without_meta],
+            embeddings=[embeddings[i] for i in without_meta],
+            documents=[documents[i].page_content for i in without_meta]
+        )
+
+
+def delete_text_by_metadata(filter: dict, chunk_size: int = None) -> int:
+    """
+    根据元数据删除文本
+
+    只按 where 条件查询 ID（不读取文档内容和元数据），再分批删除
+
+    Returns:
+        删除的块数
+    """
+    store = VectorStore()
+    deleted = 0
+    for shard, page in store.locate(where=filter):
+        _delete_ids(store.shards[shard]._collection, page["ids"], chunk_size)
+        deleted += len(page["ids"])
+    return deleted
+
+
+def delete_documents(ids: list, chunk_size: int = None) -> int:
+    """
+    按文档 ID 删除（在各分片中查找后分批删除）
+
+    Returns:
+        删除的块数
+    """
+    store = VectorStore()
+    deleted = 0
+    for shard, page in store.locate(ids=list(ids)):
+        _delete_ids(store.shards[shard]._collection, page["ids"], chunk_size)
+        deleted += len(page["ids"])
+    return deleted
+
+
+def delete_by_keys(field: str, values: list, chunk_size: int = None) -> int:
+    """
+    按某个 metadata 字段的多个取值批量删除（如多个 filterKeyForDel）
+
+    取值按 chunk_size 分组用 $in 查询 ID，每组查完即删
+
+    Returns:
+        删除的块数
+    """
+    chunk_size = chunk_size or Config.DELETE_CHUNK_SIZE
+    deleted = 0
+    values = list(dict.fromkeys(values))
+    for start in range(0, len(values), chunk_size):
+        group = values[start:start + chunk_size]
+        where = {field: group[0]} if len(group) == 1 else {field: {"$in": group}}
+        deleted += delete_text_by_metadata(where, chunk_size)
+    return deleted
+
+
+def _delete_ids(collection, ids: list, chunk_size: int = None):
+    """
+    分批删除，每批单独提交并通知监听器
+
+    大批量下架时避免一次长事务长时间占用 Chroma 的写锁，批次之间让出 GIL，检索请求可以穿插执行
+    """
+    chunk_size = chunk_size or Config.DELETE_CHUNK_SIZE
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        collection.delete(ids=chunk)
+        _notify_change("delete", chunk)
+        time.sleep(0)
+
+
+@contextmanager
+def _upsert_lock(key: str):
+    """
+    同一 key 的 upsert 串行执行
+
+    先取进程内线程锁，再取 UPSERT_LOCK_DIR 下对应分段的 fcntl 文件锁，serve.py 预 fork 的多个 worker
+    之间同样串行。分段按 crc32 计算（hash() 每个进程的随机种子不同）。
+    文件锁只在同一台机器上生效：多台机器通过 CHROMA_MODE=http 写同一个 Chroma 服务时，
+    需由调用方保证同一 key 不并发 upsert。
+    """
+    stripe = zlib.crc32(key.encode("utf-8")) % len(_upsert_locks)
+    with _upsert_locks[stripe]:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(Config.UPSERT_LOCK_DIR, exist_ok=True)
+        with open(os.path.join(Config.UPSERT_LOCK_DIR, f"{stripe}.lock"), "a+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+
+def upsert_text(key: str, text: str, metadata: dict = None) -> dict:
+    """
+    幂等写入：按调用方提供的 key 覆盖该 key 下的全部块
+
+    块 ID 为 "{key}:{块序号}"，metadata 中记录 doc_key / chunk_index / content_hash：
+    - 内容哈希未变的块不重新向量化（metadata 有变化时只更新 metadata）
+    - 内容变化或新增的块重新向量化后覆盖写入
+    - 文本变短后多出来的旧块（孤儿块）一并删除
+
+    先写入新块，成功后再删除孤儿块和迁移分片后留在旧分片的块：向量化或写入失败时旧内容仍完整，
+    可原样重试。同一 key 的并发 upsert 经 _upsert_lock 串行（本机多进程同样生效）。
+
+    Args:
+        key: 文档唯一标识（如 filterKey）
+        text: 文本内容
+        metadata: 元数据
+
+    Returns:
+        {"chunks": 当前块数, "embedded": 重新向量化的块数, "updated": 仅更新 metadata 的块数,
+         "unchanged": 未变化的块数, "removed": 删除的孤儿块数}
+    """
+    chunks, chunk_vectors = split_text_with_vectors(text, metadata)
+    ids = [f"{key}:{i}" for i in range(len(chunks))]
+    for i, chunk in enumerate(chunks):
+        chunk.metadata = {
+            **chunk.metadata,
+            "doc_key": key,
+            "chunk_index": i,
+            "content_hash": hashlib.sha256(chunk.page_content.encode("utf-8")).hexdigest(),
+        }
+
+    store = VectorStore()
+    with _upsert_lock(key):
+        targets = {doc_id: store.shard_of(doc_id, chunk.metadata) for doc_id, chunk in zip(ids, chunks)}
+        current = {}  # ID -> 目标分片中的旧 metadata
+        stale: Dict[int, List[str]] = {}  # 分片 -> 需删除的旧块（孤儿块、分片变化后留在旧分片的块）
+        for shard, page in store.locate(where={"doc_key": key}, include=["metadatas"]):
+            for doc_id, old in zip(page["ids"], page["metadatas"]):
+                if targets.get(doc_id) == shard:
+                    current[doc_id] = old
+                else:
+                    stale.setdefault(shard, []).append(doc_id)
+
+        changed, meta_only, unchanged = [], [], 0
+        for doc_id, chunk, vector in zip(ids, chunks, chunk_vectors):
+            old = current.get(doc_id)
+            if old is None or old.get("content_hash") != chunk.metadata["content_hash"]:
+                changed.append((doc_id, chunk, vector))
+            elif old != chunk.metadata:
+                meta_only.append((doc_id, chunk))
+            else:
+                unchanged += 1
+
+        # 先写入新内容，失败时不删除任何旧块
+        if changed:
+            docs = [chunk for _, chunk, _ in changed]
+            vectors = fill_vectors(docs, [vector for _, _, vector in changed])
+            add_embedded_documents(docs, vectors, ids=[doc_id for doc_id, _, _ in changed])
+        if meta_only:
+            groups: Dict[int, list] = {}
+            for doc_id, chunk in meta_only:
+                groups.setdefault(targets[doc_id], []).append((doc_id, chunk))
+            for shard, items in groups.items():
+                store.shards[shard]._collection.update(
+                    ids=[doc_id for doc_id, _ in items],
+                    metadatas=[chunk.metadata for _, chunk in items]
+                )
+            _notify_change("add", [doc_id for doc_id, _ in meta_only], [chunk for _, chunk in meta_only])
+
+        # 新内容写入成功后再删除旧块
+        orphans, moved = [], set()
+        for shard, stale_ids in stale.items():
+            orphans.extend(doc_id for doc_id in stale_ids if doc_id not in targets)
+            _delete_ids(store.shards[shard]._collection, [doc_id for doc_id in stale_ids if doc_id not in targets])
+            moved_ids = [doc_id for doc_id in stale_ids if doc_id in targets]
+            if moved_ids:
+                # 新块已以同一 ID 写入目标分片，不发删除通知（否则关键词索引会删掉新块）
+                store.shards[shard]._collection.delete(ids=moved_ids)
+                moved.update(moved_ids)
+        if moved:
+            # 再发一次 add 通知，丢弃分区缓存中短暂同时包含新旧两份的结果
+            moved_chunks = [(doc_id, chunk) for doc_id, chunk in zip(ids, chunks) if doc_id in moved]
+            _notify_change("add", [doc_id for doc_id, _ in moved_chunks], [chunk for _, chunk in moved_chunks])
+
+    logger.debug(
+        f"upsert 完成: key={key}, 块数 {len(chunks)}, 重新向量化 {len(changed)}, "
+        f"删除孤儿块 {len(orphans)}"
+    )
+    return {
+        "chunks": len(chunks),
+        "embedded": len(changed),
+        "updated": len(meta_only),
+        "unchanged": unchanged,
+        "removed": len(orphans),
+    }
 
 
 def process_text(text: str, metadata: dict = None):
@@ -71,30 +608,50 @@ def process_text(text: str, metadata: dict = None):
     - "semantic": 语义分块（精准，需要额外依赖）
     - "hybrid": 混合策略（根据文本长度自动选择）
     """
+    chunks, vectors = split_text_with_vectors(text, metadata)
+    
+    # 存储到向量库（语义分块已得到的块向量直接使用）
+    if chunks:
+        store_documents(chunks, vectors)
+        logger.debug(f"文本入库完成，块数: {len(chunks)}")
+
+
+def split_text(text: str, metadata: dict = None) -> list:
+    """
+    按 CHUNK_STRATEGY 切分文本（不入库）
+    
+    短文本（< MIN_CHUNK_LENGTH）不分块，直接作为一个文档返回
+    """
+    return split_text_with_vectors(text, metadata)[0]
+
+
+def split_text_with_vectors(text: str, metadata: dict = None) -> Tuple[list, list]:
+    """
+    按 CHUNK_STRATEGY 切分文本，并给出分块时已得到的块向量
+    
+    Returns:
+        (文档列表, 等长的块向量列表)；语义分块的块带向量（入库时无需再次向量化），
+        其余为 None，由 fill_vectors / store_documents 补全
+    """
     strategy = getattr(Config, 'CHUNK_STRATEGY', 'char')
     min_chunk_length = getattr(Config, 'MIN_CHUNK_LENGTH', 300)
     
     # 短文本不分块，直接存储
     if len(text) < min_chunk_length:
-        doc = Document(page_content=text, metadata=metadata or {})
-        vector_store = VectorStore()
-        vector_store.add_documents([doc])
         logger.debug(f"短文本直接存储，长度: {len(text)}")
-        return
+        return [Document(page_content=text, metadata=metadata or {})], [None]
     
     # 根据策略选择分块方式
     if strategy == "semantic":
-        chunks = _semantic_split(text, metadata)
+        chunks, vectors = _semantic_split(text, metadata)
     elif strategy == "hybrid":
-        chunks = _hybrid_split(text, metadata)
+        chunks, vectors = _hybrid_split(text, metadata)
     else:  # 默认 char
         chunks = _char_split(text, metadata)
+        vectors = [None] * len(chunks)
     
-    # 存储到向量库
-    if chunks:
-        vector_store = VectorStore()
-        vector_store.add_documents(chunks)
-        logger.debug(f"文本分块完成，策略: {strategy}, 块数: {len(chunks)}")
+    logger.debug(f"文本分块完成，策略: {strategy}, 块数: {len(chunks)}")
+    return chunks, vectors
 
 
 def _char_split(text: str, metadata: dict = None) -> list:
@@ -104,30 +661,23 @@ def _char_split(text: str, metadata: dict = None) -> list:
     return text_splitter.split_documents([doc])
 
 
-def _semantic_split(text: str, metadata: dict = None) -> list:
-    """语义分块（精准）"""
+def _semantic_split(text: str, metadata: dict = None) -> Tuple[list, list]:
+    """语义分块（精准），返回 (文档列表, 块向量列表)"""
     try:
         from text_splitter import get_semantic_splitter
-        splitter = get_semantic_splitter()
-        doc = Document(page_content=text, metadata=metadata or {})
-        return splitter.split_documents([doc])
-    except ImportError:
-        logger.warning("语义分块依赖未安装，降级到字符分块")
-        return _char_split(text, metadata)
+        return get_semantic_splitter().split_with_vectors(text, metadata)
     except Exception as e:
         logger.warning(f"语义分块失败，降级到字符分块: {e}")
-        return _char_split(text, metadata)
+        chunks = _char_split(text, metadata)
+        return chunks, [None] * len(chunks)
 
 
-def _hybrid_split(text: str, metadata: dict = None) -> list:
-    """混合分块（根据文本长度自动选择）"""
+def _hybrid_split(text: str, metadata: dict = None) -> Tuple[list, list]:
+    """混合分块（根据文本长度自动选择），返回 (文档列表, 块向量列表)"""
     try:
         from text_splitter import get_hybrid_splitter
-        splitter = get_hybrid_splitter()
-        return splitter.split_text(text, metadata)
-    except ImportError:
-        logger.warning("混合分块依赖未安装，降级到字符分块")
-        return _char_split(text, metadata)
+        return get_hybrid_splitter().split_with_vectors(text, metadata)
     except Exception as e:
         logger.warning(f"混合分块失败，降级到字符分块: {e}")
-        return _char_split(text, metadata)
+        chunks = _char_split(text, metadata)
+        return chunks, [None] * len(chunks)